@@ -1,20 +1,90 @@
 #!/usr/bin/env -S uv run
 # /// script
 # dependencies = [
+#     "boto3",
 #     "dateparser",
+#     "numpy",
 # ]
 # ///
 
 # Script to selectively delete old backup files, keeping a specified number of
 # backups based on daily, weekly, monthly, and yearly retention policies.
+# Backups can be in local directories or under S3 prefixes
+# (s3://bucket/prefix/).
 
 import argparse
+import bisect
+import concurrent.futures
+import heapq
+import itertools
+import json
+import os
+import operator
+import random
+import re
 import sys
-from pathlib import Path
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path, PurePosixPath
 from datetime import datetime, timedelta
-import dateparser
 import doctest
 
+# Formats tried when working out the date format of filenames, most specific
+# first. Day first and month first dates are told apart by trying them on a
+# sample of filenames, preferring month first like dateparser does.
+DATE_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%dT%H%M%S",
+    "%Y-%m-%d_%H-%M-%S",
+    "%Y-%m-%d_%H%M%S",
+    "%Y-%m-%d-%H%M%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d_%H-%M",
+    "%Y-%m-%d_%H%M",
+    "%Y%m%dT%H%M%SZ",
+    "%Y%m%dT%H%M%S",
+    "%Y%m%d-%H%M%S",
+    "%Y%m%d_%H%M%S",
+    "%Y%m%d%H%M%S",
+    "%Y%m%d-%H%M",
+    "%Y%m%d_%H%M",
+    "%Y%m%d%H%M",
+    "%Y-%m-%d",
+    "%Y_%m_%d",
+    "%Y.%m.%d",
+    "%Y%m%d",
+    "%m-%d-%Y",
+    "%d-%m-%Y",
+    "%d.%m.%Y",
+]
+
+# strptime directives that can be turned into a simple regex group
+FAST_DIRECTIVES = {
+    "Y": ("year", r"\d{4}"),
+    "m": ("month", r"\d{2}"),
+    "d": ("day", r"\d{2}"),
+    "H": ("hour", r"\d{2}"),
+    "M": ("minute", r"\d{2}"),
+    "S": ("second", r"\d{2}"),
+}
+
+DATE_SAMPLE_SIZE = 100
+
+# The most keys DeleteObjects takes in one request
+S3_DELETE_BATCH_SIZE = 1000
+
+# Integer slot ids for each policy, increasing with time. Weeks are ISO weeks
+# (Monday to Sunday), numbered straight from the day ordinal as day 1 was a
+# Monday, which groups days exactly like ISO year and week but without a
+# calendar lookup.
+SLOT_FUNCTIONS = {
+    "daily": lambda dt: dt.toordinal(),
+    "weekly": lambda dt: (dt.toordinal() - 1) // 7,
+    "monthly": lambda dt: dt.year * 12 + dt.month - 1,
+    "yearly": lambda dt: dt.year,
+}
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -22,7 +92,8 @@ def parse_args():
     )
     parser.add_argument(
         "paths", nargs="*", default=["."],
-        help="List of directories or files (default: current directory)."
+        help="List of directories, files or s3://bucket/prefix/ URLs "
+             "(default: current directory)."
     )
     parser.add_argument("-d", "--keep-daily", type=int, default=7)
     parser.add_argument("-w", "--keep-weekly", type=int, default=4)
@@ -32,6 +103,11 @@ def parse_args():
         "--date-from-filename", action="store_true",
         help="Extract date from filename instead of file mtime."
     )
+    parser.add_argument(
+        "--date-format",
+        help="strptime format of the date in filenames, e.g. %%Y-%%m-%%d "
+             "(default: worked out from the filenames)."
+    )
     parser.add_argument(
         "--filename-prefix", default="",
         help="Prefix to remove from filename before parsing date."
@@ -40,30 +116,233 @@ def parse_args():
         "--filename-suffix", default="",
         help="Suffix to remove from filename before parsing date."
     )
+    parser.add_argument(
+        "--max-bytes", type=parse_size,
+        help="Most space the kept files in each directory can take, e.g. "
+             "500G. If the policy keeps more, the files that fill the "
+             "fewest slots are deleted too, largest first."
+    )
+    parser.add_argument(
+        "--stat-threads", type=int, default=1,
+        help="Stat files with this many threads, which is quicker on "
+             "network filesystems (default: 1)."
+    )
+    parser.add_argument(
+        "-r", "--recursive", action="store_true",
+        help="Treat each directory without subdirectories below the given "
+             "ones as a separate group of files."
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of directories to process at once (default: 1)."
+    )
+    parser.add_argument(
+        "--state",
+        help="File to keep the dates of kept files in, so that later runs "
+             "only need to look at new files."
+    )
     parser.add_argument(
         "-f", "--force", action="store_true",
         help="Actually delete the files."
     )
+    parser.add_argument(
+        "--delete-threads", type=int, default=4,
+        help="Number of files to delete at once (default: 4)."
+    )
+    parser.add_argument(
+        "--max-deletes-per-second", type=float, default=0,
+        help="Limit how quickly files are deleted (default: no limit)."
+    )
+    parser.add_argument(
+        "--endpoint-url",
+        help="S3 endpoint to use for s3:// paths, e.g. a local S3 "
+             "compatible server (default: AWS)."
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true",
         help="Print kept files and why."
     )
     parser.add_argument(
         "--run-tests", action="store_true",
-        help="Run doctests and exit. Add -v for verbose output."
+        help="Run doctests and the --benchmark, and exit. Add -v for verbose "
+             "output."
+    )
+    parser.add_argument(
+        "--benchmark", type=int, nargs="?", const=1000000, default=1000000,
+        help="Number of files --run-tests times the retention engine with "
+             "(default: 1000000, 0 to skip)."
     )
     parser.add_argument(
         "--simulate", type=int, default=0,
-        help="Simulate running retention for N days with the current settings"
+        help="Simulate running retention for N days with the current "
+             "settings. This uses numpy if it's installed, and is slower "
+             "without it."
     )
     parser.add_argument(
         "--simulate-retention-interval", default="daily",
         help="How often to run retention: 'daily', 'weekly', or number of days"
     )
+    parser.add_argument(
+        "--simulate-backup-size", default="1G",
+        help="Size of each simulated backup, e.g. 500M (default: 1G)."
+    )
+    parser.add_argument(
+        "--sweep", action="append", metavar="POLICY=N,N,...",
+        help="Simulate each of these limits for a policy, e.g. daily=7,14. "
+             "Can be given for several policies to simulate every "
+             "combination."
+    )
+    parser.add_argument(
+        "--simulate-output", choices=["log", "summary", "json"],
+        default="log",
+        help="Print what happens each day and a summary (log, the default "
+             "without --sweep), just the summary, or the summary as JSON."
+    )
     return parser.parse_args()
 
 
-def extract_date(args, file):
+def compile_date_format(fmt):
+    """
+    Turn a strptime format into a function that parses a whole string,
+    returning None if it doesn't match. Simple numeric formats are matched
+    with a regex instead of going through strptime.
+
+    >>> parse = compile_date_format('%Y%m%d-%H%M')
+    >>> parse('20250715-0130')
+    datetime.datetime(2025, 7, 15, 1, 30)
+    >>> parse('2025-07-15') is None
+    True
+    >>> compile_date_format('%Y-%m-%d')('2025-02-30') is None
+    True
+    >>> compile_date_format('%d %b %Y')('15 Jul 2025')
+    datetime.datetime(2025, 7, 15, 0, 0)
+    """
+    fields = []
+    pattern = []
+    for literal, directive in re.findall(r"([^%]*)(?:%(.)|$)", fmt):
+        pattern.append(re.escape(literal))
+        if not directive:
+            continue
+        if directive not in FAST_DIRECTIVES or \
+                FAST_DIRECTIVES[directive][0] in fields:
+            def parse_slow(name):
+                try:
+                    return datetime.strptime(name, fmt)
+                except ValueError:
+                    return None
+            return parse_slow
+        field, group = FAST_DIRECTIVES[directive]
+        fields.append(field)
+        pattern.append(f"(?P<{field}>{group})")
+    match = re.compile("".join(pattern) + r"\Z").match
+    # Ask for the groups in the order datetime() takes them, which is quick
+    # as long as the format has a year, month and day
+    order = [f for f, _ in FAST_DIRECTIVES.values() if f in fields]
+    in_order = len(order) > 2 and \
+        order == [f for f, _ in FAST_DIRECTIVES.values()][:len(order)]
+    defaults = {"year": 1900, "month": 1, "day": 1}
+
+    def parse(name):
+        m = match(name)
+        if m is None:
+            return None
+        try:
+            if in_order:
+                return datetime(*map(int, m.group(*order)))
+            values = dict(defaults)
+            values.update((k, int(v)) for k, v in m.groupdict().items())
+            return datetime(**values)
+        except ValueError:
+            return None
+    return parse
+
+
+def infer_date_format(names):
+    """
+    Work out the date format of a sample of names, returning the format
+    that parses the most of them, or None if none of them parse.
+
+    >>> infer_date_format(['2025-07-15', '2025-07-14'])
+    '%Y-%m-%d'
+    >>> infer_date_format(['01-02-2025', '25-12-2024'])
+    '%d-%m-%Y'
+    >>> infer_date_format(['backup']) is None
+    True
+    """
+    best, best_count = None, 0
+    for fmt in DATE_FORMATS:
+        parse = compile_date_format(fmt)
+        count = sum(1 for name in names if parse(name) is not None)
+        if count > best_count:
+            best, best_count = fmt, count
+            if count == len(names):
+                break
+    return best
+
+
+def parse_with_dateparser(name):
+    # dateparser is slow to import, so only do it when it's needed
+    import dateparser
+    return dateparser.parse(name)
+
+
+def filename_date_part(args, file):
+    """
+    >>> class Args:
+    ...     filename_prefix = 'backup_'
+    ...     filename_suffix = '.tar.gz'
+    >>> filename_date_part(Args(), Path('backup_2025-07-15.tar.gz'))
+    '2025-07-15'
+    """
+    prefix = args.filename_prefix
+    suffix = args.filename_suffix
+    name = file.name
+    if suffix and name.endswith(suffix):
+        name = name[:-len(suffix)]
+    else:
+        name = file.stem
+        if suffix and name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if prefix and name.startswith(prefix):
+        name = name[len(prefix):]
+    return name
+
+
+def make_date_parser(args, names, date_format=None):
+    """
+    Return a function to parse dates from filenames, using --date-format,
+    date_format or a format inferred from a sample of the names. Names that
+    don't match the format fall back to dateparser.
+
+    >>> class Args:
+    ...     date_format = None
+    >>> parse = make_date_parser(Args(), ['2025-07-15', '2025-07-14'])
+    >>> parse('2025-07-13'), parse.date_format
+    (datetime.datetime(2025, 7, 13, 0, 0), '%Y-%m-%d')
+    >>> parse('July 12 2025')
+    datetime.datetime(2025, 7, 12, 0, 0)
+    >>> parse.fallbacks
+    1
+    """
+    fmt = getattr(args, 'date_format', None) or date_format
+    if not fmt:
+        step = max(1, len(names) // DATE_SAMPLE_SIZE)
+        fmt = infer_date_format(names[::step][:DATE_SAMPLE_SIZE])
+    fast = fmt and compile_date_format(fmt)
+
+    def parse(name):
+        if fast:
+            dt = fast(name)
+            if dt is not None:
+                return dt
+        parse.fallbacks += 1
+        return parse_with_dateparser(name)
+    parse.date_format = fmt
+    parse.fallbacks = 0
+    return parse
+
+
+def extract_date(args, file, parse=None):
     """
     >>> f = Path('prefix2025-07-15suffix.tar.gz')
     >>> class Args:
@@ -81,19 +360,11 @@ def extract_date(args, file):
     >>> extract_date(Args(), f2).date()
     datetime.date(2025, 7, 15)
     """
-    prefix = args.filename_prefix
-    suffix = args.filename_suffix
     if args.date_from_filename:
-        name = file.name
-        if suffix and name.endswith(suffix):
-            name = name[:-len(suffix)]
-        else:
-            name = file.stem
-            if suffix and name.endswith(suffix):
-                name = name[:-len(suffix)]
-        if prefix and name.startswith(prefix):
-            name = name[len(prefix):]
-        return dateparser.parse(name)
+        name = filename_date_part(args, file)
+        if parse is None:
+            parse = make_date_parser(args, [name])
+        return parse(name)
     return datetime.fromtimestamp(file.stat().st_mtime)
 
 
@@ -108,7 +379,39 @@ def extract_dates(args, files):
     (PosixPath('2025-07-15.txt'), datetime.datetime(2025, 7, 15, 0, 0))
     (PosixPath('2025-07-14.txt'), datetime.datetime(2025, 7, 14, 0, 0))
     """
-    return [(f, extract_date(args, f)) for f in files]
+    return extract_dates_with_format(args, files)[0]
+
+
+def extract_dates_with_format(args, files, date_format=None):
+    """
+    Like extract_dates(), but also returns the date format used for the
+    filenames (None for mtimes). date_format is used if given, rather than
+    working one out from the files.
+
+    >>> class Args:
+    ...     date_from_filename = True
+    ...     date_format = None
+    ...     filename_prefix = ''
+    ...     filename_suffix = ''
+    >>> extract_dates_with_format(Args(), [Path('01-02-2025')], '%d-%m-%Y')
+    ([(PosixPath('01-02-2025'), datetime.datetime(2025, 2, 1, 0, 0))], \
+'%d-%m-%Y')
+    """
+    if not args.date_from_filename:
+        return [(f, extract_date(args, f)) for f in files], None
+    # Files can be streamed in from a directory scan, so the date format is
+    # worked out from the first few
+    files = iter(files)
+    head = list(itertools.islice(files, DATE_SAMPLE_SIZE))
+    parse = make_date_parser(args, [filename_date_part(args, f)
+                                    for f in head], date_format)
+    results = [(f, parse(filename_date_part(args, f)))
+               for f in itertools.chain(head, files)]
+    if results and getattr(args, 'verbose', False):
+        print(f"Date format: {parse.date_format or 'unknown'}, "
+              f"{parse.fallbacks} of {len(results)} parsed with dateparser",
+              file=sys.stderr)
+    return results, parse.date_format
 
 
 def get_limits(args):
@@ -153,6 +456,77 @@ def bucket_key(dt, bucket_type):
         return dt.strftime("%Y")
 
 
+def slot_id(dt, bucket_type):
+    """
+    >>> d = datetime(2025, 7, 15)
+    >>> slot_id(d, 'daily') - slot_id(datetime(2025, 7, 14), 'daily')
+    1
+    >>> slot_id(datetime(2025, 7, 13), 'weekly') + 1 == slot_id(d, 'weekly')
+    True
+    >>> slot_id(datetime(2025, 7, 14), 'weekly') == slot_id(d, 'weekly')
+    True
+    >>> slot_id(datetime(2024, 12, 31), 'monthly') + 1 == slot_id(
+    ...     datetime(2025, 1, 1), 'monthly')
+    True
+    """
+    return SLOT_FUNCTIONS[bucket_type](dt)
+
+
+def newest_first(dates):
+    """
+    Return the indexes of dates from newest to oldest. Dates that are
+    already in order either way round aren't sorted again. Equal dates keep
+    their order, as with a stable sort.
+
+    >>> list(newest_first([3, 2, 2, 1])), list(newest_first([1, 2, 3]))
+    ([0, 1, 2, 3], [2, 1, 0])
+    >>> newest_first([2, 3, 1, 3])
+    [1, 3, 0, 2]
+    """
+    n = len(dates)
+    following = itertools.islice(dates, 1, None)
+    if all(map(operator.ge, dates, following)):
+        return range(n)
+    following = itertools.islice(dates, 1, None)
+    if all(map(operator.lt, dates, following)):
+        return range(n - 1, -1, -1)
+    return sorted(range(n), key=dates.__getitem__, reverse=True)
+
+
+def retention_slots(dates, limits):
+    """
+    Pick which dates to keep for each policy, returning a dict of
+    {policy: {slot id: index into dates}}, newest slot first.
+
+    Dates are scanned newest first in a single pass, working out each slot
+    id once per file and policy. As slot ids only ever go down, a file is in
+    a new slot exactly when its slot id differs from the last one kept, and
+    the scan stops as soon as every policy has all of its slots.
+
+    >>> dates = [datetime(2025, 7, d) for d in (12, 15, 13, 14)]
+    >>> r = retention_slots(dates, {'daily': 2, 'weekly': 2})
+    >>> list(r['daily'].values()), list(r['weekly'].values())
+    ([1, 3], [1, 2])
+    """
+    policies = [(k, SLOT_FUNCTIONS[k], limits[k], {}) for k in limits]
+    result = {k: slots for k, _, _, slots in policies}
+    pending = [p for p in policies if p[2] > 0]
+    last = {k: None for k in limits}
+    for i in newest_first(dates):
+        if not pending:
+            break
+        dt = dates[i]
+        for policy in pending:
+            k, slot_of, limit, slots = policy
+            slot = slot_of(dt)
+            if slot != last[k]:
+                last[k] = slot
+                slots[slot] = i
+                if len(slots) >= limit:
+                    pending = [p for p in pending if p is not policy]
+    return result
+
+
 def collect_retention(files_with_dates, limits):
     """
     >>> files = [
@@ -165,6 +539,19 @@ def collect_retention(files_with_dates, limits):
     >>> sorted(r['daily'].keys())
     ['2025-07-14', '2025-07-15']
     """
+    paths = [f for f, _ in files_with_dates]
+    dates = [dt for _, dt in files_with_dates]
+    slots = retention_slots(dates, limits)
+    # Only the kept files need a readable bucket key
+    return {k: {bucket_key(dates[i], k): paths[i] for i in m.values()}
+            for k, m in slots.items()}
+
+
+def collect_retention_simple(files_with_dates, limits):
+    """
+    The original sort and strftime implementation of collect_retention,
+    kept to check and benchmark the faster one against.
+    """
     bucket_map = {k: {} for k in limits}
     for path, dt in sorted(files_with_dates, key=lambda x: x[1], reverse=True):
         for k in limits:
@@ -174,14 +561,153 @@ def collect_retention(files_with_dates, limits):
     return bucket_map
 
 
-def print_keep_reasons(bucket_map):
+def benchmark_retention(n=1000000, limits=None, verbose=False):
+    """
+    Time collect_retention against collect_retention_simple with n files,
+    one an hour in a random order, and check that they agree. --run-tests
+    runs this with 1M files after the doctests.
+
+    >>> benchmark_retention(5000)['same']
+    True
+    """
+    limits = limits or {'daily': 7, 'weekly': 4, 'monthly': 6, 'yearly': 1}
+    start = datetime(2025, 7, 15)
+    files = [(f"backup-{i}", start - timedelta(hours=i)) for i in range(n)]
+    random.Random(42).shuffle(files)
+    timings = {}
+    results = []
+    for name, func in (('simple', collect_retention_simple),
+                       ('fast', collect_retention)):
+        t = time.perf_counter()
+        results.append(func(files, limits))
+        timings[name] = time.perf_counter() - t
+    timings['speedup'] = timings['simple'] / timings['fast']
+    timings['same'] = results[0] == results[1]
+    if verbose:
+        print(f"{n} files: simple {timings['simple']:.2f}s, "
+              f"fast {timings['fast']:.2f}s, "
+              f"{timings['speedup']:.1f}x faster, same: {timings['same']}")
+    return timings
+
+
+def print_keep_reasons(bucket_map, keep_set=None):
+    """
+    Print why each file is kept. Files the policy keeps that aren't in
+    keep_set have been left out to fit --max-bytes.
+
+    >>> bucket_map = {'daily': {'2025-07-15': 'b', '2025-07-14': 'a'},
+    ...               'weekly': {'2025-W29': 'b'}}
+    >>> print_keep_reasons(bucket_map, {'b'})
+    Delete a: daily 2025-07-14, over --max-bytes
+    Keep b: daily 2025-07-15, weekly 2025-W29
+    """
     reason_map = {}
     for bucket_type, mapping in bucket_map.items():
         for slot, path in mapping.items():
             reason_map.setdefault(path, []).append(f"{bucket_type} {slot}")
 
     for path, reasons in sorted(reason_map.items()):
-        print(f"Keep {path}: {', '.join(reasons)}")
+        if keep_set is None or path in keep_set:
+            print(f"Keep {path}: {', '.join(reasons)}")
+        else:
+            print(f"Delete {path}: {', '.join(reasons)}, over --max-bytes")
+
+
+class ScanStats:
+    """
+    Counts of the system calls made while scanning a directory
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = 0
+        self.files = 0
+        self.stats = 0
+        self.start = time.perf_counter()
+
+    def count_stat(self):
+        with self.lock:
+            self.stats += 1
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        return (f"{self.files} files in {elapsed:.2f}s"
+                f" ({self.directories} directory scans, {self.stats} stats)")
+
+
+class ScannedPath(type(Path())):
+    """
+    A Path found by a directory scan, which keeps the scan's DirEntry so
+    that stat() is only done once per file and is_file() needs no stat at
+    all on most filesystems.
+    """
+    _entry = None
+    _scan_stats = None
+
+    @classmethod
+    def from_entry(cls, entry, scan_stats):
+        path = cls(entry.path)
+        path._entry = entry
+        path._scan_stats = scan_stats
+        return path
+
+    def stat(self, **kwargs):
+        if self._entry is None or kwargs:
+            return super().stat(**kwargs)
+        if self._scan_stats is not None:
+            # DirEntry caches its stat result, so only the first one counts
+            self._scan_stats.count_stat()
+            self._scan_stats = None
+        return self._entry.stat()
+
+
+def scan_directory(path, scan_stats):
+    """
+    Yield a ScannedPath for each file in a directory as it is read
+    """
+    with os.scandir(path) as it:
+        scan_stats.directories += 1
+        for entry in it:
+            # This uses the file type from the directory listing, so only
+            # needs a stat if the filesystem doesn't give one (or for links)
+            if entry.is_file():
+                scan_stats.files += 1
+                yield ScannedPath.from_entry(entry, scan_stats)
+
+
+def try_stat(file):
+    try:
+        file.stat()
+    except OSError:
+        pass
+
+
+def prefetch_stats(files, threads, batch_size=256):
+    """
+    Stat files concurrently, which hides the latency of network filesystems,
+    yielding them in their original order once they have been stat'ed
+    """
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        while True:
+            batch = list(itertools.islice(files, batch_size))
+            if not batch:
+                break
+            # Errors (e.g. a file deleted since the scan) are left for
+            # whatever uses the stat to report
+            list(pool.map(try_stat, batch))
+            yield from batch
+
+
+def scan_files(path, args, scan_stats):
+    """
+    Stream the files in a directory, stat'ing them in parallel if asked to
+    and their modification times or sizes are needed
+    """
+    files = scan_directory(path, scan_stats)
+    if args.stat_threads > 1 and (not args.date_from_filename or
+                                  args.max_bytes):
+        files = prefetch_stats(files, args.stat_threads)
+    return files
 
 
 def get_files_to_keep(files, args):
@@ -197,104 +723,939 @@ def get_files_to_keep(files, args):
     >>> sorted(get_files_to_keep(files, Args()))
     [PosixPath('2025-07-14.txt'), PosixPath('2025-07-15.txt')]
     """
-    files_with_dates = extract_dates(args, files)
+    return keep_from_dates(extract_dates(args, files), args)
+
+
+def keep_from_dates(files_with_dates, args):
     limits = get_limits(args)
     bucket_map = collect_retention(files_with_dates, limits)
     keep_set = set(f for m in bucket_map.values() for f in m.values())
 
+    if getattr(args, "max_bytes", None):
+        keep_set = keep_within_budget(files_with_dates, bucket_map,
+                                      args.max_bytes)
+
     if args.verbose:
-        print_keep_reasons(bucket_map)
+        print_keep_reasons(bucket_map, keep_set)
+
+    return keep_set
+
+
+def file_size(file):
+    try:
+        return file.stat().st_size
+    except OSError:
+        return 0
+
+
+def keep_within_budget(files_with_dates, bucket_map, max_bytes):
+    """
+    Cut down the files kept by the policy until they fit in max_bytes,
+    returning the files to keep. The files that fill the fewest slots go
+    first, largest first and then oldest first, so that as few slots as
+    possible are given up. The newest file is always kept. Prints how much
+    space will be reclaimed, under the longest policy each file was kept
+    for.
 
+    The files are put in a heap, so only the ones that have to go are
+    ever ordered.
+
+    >>> def backup(day, size):
+    ...     return S3Object('b', f'{day}.tar', size, datetime(2025, 7, day))
+    >>> files = [(backup(d, s), datetime(2025, 7, d))
+    ...          for d, s in [(15, 5), (14, 9), (13, 1), (6, 4), (5, 2)]]
+    >>> bucket_map = collect_retention(files, {'daily': 3, 'weekly': 2})
+    >>> import contextlib
+    >>> with contextlib.redirect_stderr(sys.stdout):
+    ...     keep_set = keep_within_budget(files, bucket_map, 10)
+    Keeping 2 files (6 B) of 21 B, budget 10 B, reclaiming:
+      no policy: 2 files (6 B)
+      daily: 1 files (9 B)
+    >>> sorted(f.name for f in keep_set)
+    ['13.tar', '15.tar']
+    """
+    tiers = {}
+    for policy, mapping in bucket_map.items():
+        for f in mapping.values():
+            tiers.setdefault(f, []).append(policy)
+    dates = dict(files_with_dates)
+    sizes = {f: file_size(f) for f, _ in files_with_dates}
+    newest = max(tiers, key=dates.get, default=None)
+    heap = [(len(policies), -sizes[f], dates[f], i, f)
+            for i, (f, policies) in enumerate(tiers.items()) if f != newest]
+    heapq.heapify(heap)
+    kept_size = sum(sizes[f] for f in tiers)
+    reclaimed = {"no policy": [0, 0]}
+    for f in sizes:
+        if f not in tiers:
+            reclaimed["no policy"][0] += 1
+            reclaimed["no policy"][1] += sizes[f]
+    keep_set = set(tiers)
+    while kept_size > max_bytes and heap:
+        *_, f = heapq.heappop(heap)
+        keep_set.discard(f)
+        kept_size -= sizes[f]
+        # The policies are in the order of get_limits(), shortest first
+        count = reclaimed.setdefault(tiers[f][-1], [0, 0])
+        count[0] += 1
+        count[1] += sizes[f]
+
+    print(f"Keeping {len(keep_set)} files ({format_size(kept_size)}) of "
+          f"{format_size(sum(sizes.values()))}, budget "
+          f"{format_size(max_bytes)}, reclaiming:", file=sys.stderr)
+    for policy, (count, size) in reclaimed.items():
+        print(f"  {policy}: {count} files ({format_size(size)})",
+              file=sys.stderr)
+    if kept_size > max_bytes:
+        print("Warning: the newest file alone is over budget",
+              file=sys.stderr)
     return keep_set
 
 
-def process_group(files, args):
-    keep_set = get_files_to_keep(files, args)
-    delete_set = set(files) - keep_set
-    for f in delete_set:
-        if args.force:
+def fingerprint(file):
+    st = file.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+class RetentionState:
+    """
+    Index of the files kept by the last run in each directory, with their
+    size and mtime, dates and slots, and the date format of the filenames.
+    On a repeat run, only the dates of new files have to be worked out, with
+    the same format. If the retention settings have changed (including a
+    --date-format that differs from a directory's), or the state doesn't
+    match the files any more, it is ignored and rebuilt.
+    """
+    version = 2
+
+    def __init__(self, path, args):
+        self.path = path
+        self.lock = threading.Lock()
+        self.policy = {
+            "limits": get_limits(args),
+            "date_from_filename": args.date_from_filename,
+            "filename_prefix": args.filename_prefix,
+            "filename_suffix": args.filename_suffix,
+        }
+        self.directories = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ignoring state file {path}: {e}", file=sys.stderr)
+            return
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            print(f"Ignoring state file {path}: unknown version",
+                  file=sys.stderr)
+        elif data.get("policy") != self.policy:
+            if args.verbose:
+                print("Retention settings changed, rebuilding state",
+                      file=sys.stderr)
+        else:
+            self.directories = data.get("directories", {})
+
+    def known(self, key):
+        """
+        Return {"date_format": format, "files": {filename: entry}} for the
+        files kept last time in a directory, by its storage's state_key(),
+        or None if it wasn't seen
+        """
+        with self.lock:
+            directory = self.directories.get(key)
+            if directory is None:
+                return None
+            return {"date_format": directory.get("date_format"),
+                    "files": dict(directory.get("files", {}))}
+
+    def update(self, key, kept, date_format=None):
+        """
+        Record the files kept in a directory, as (path, date) pairs, and the
+        date format of their names
+        """
+        entries = {}
+        for f, dt in kept:
             try:
-                f.unlink()
-                print(f"Deleted: {f}")
-            except Exception as e:
-                print(f"Failed to delete {f}: {e}", file=sys.stderr)
+                entries[f.name] = {
+                    "fingerprint": fingerprint(f),
+                    "date": dt.isoformat(),
+                    "slots": {k: slot_id(dt, k)
+                              for k in self.policy["limits"]},
+                }
+            except OSError:
+                pass
+        with self.lock:
+            self.directories[key] = {"date_format": date_format,
+                                     "files": entries}
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with self.lock:
+            with open(tmp, "w") as f:
+                json.dump({"version": self.version, "policy": self.policy,
+                           "directories": self.directories}, f)
+            os.replace(tmp, self.path)
+
+
+def known_dates(files, known):
+    """
+    Split files into those with a trusted date from the state and the rest.
+    Returns (files_with_dates, unknown files), or None if the state doesn't
+    match the files, in which case everything has to be worked out again.
+    """
+    trusted = []
+    unknown = []
+    for f in files:
+        entry = known.pop(f.name, None)
+        if entry is None:
+            unknown.append(f)
+            continue
+        try:
+            dt = datetime.fromisoformat(entry["date"])
+            if fingerprint(f) != entry["fingerprint"] or \
+                    entry["slots"] != {k: slot_id(dt, k)
+                                       for k in entry["slots"]}:
+                return None
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+        trusted.append((f, dt))
+    if known:
+        # Files that were kept last time have gone
+        return None
+    return trusted, unknown
+
+
+def process_group(files, args, known=None, storage=None):
+    """
+    Apply the retention policy to a group of files. Returns the files that
+    were kept as (path, date) pairs, the number that couldn't be deleted and
+    the date format of the filenames. known is an entry from a
+    RetentionState, whose dates and date format are used instead of working
+    them out again.
+    """
+    files_with_dates = None
+    date_format = None
+    if known:
+        files = list(files)
+        date_format = known["date_format"]
+        if args.date_format and date_format and \
+                args.date_format != date_format:
+            split = None
+            if args.verbose:
+                print(f"Date format changed from {date_format}, rebuilding",
+                      file=sys.stderr)
         else:
+            split = known_dates(files, known["files"])
+            if split is None and args.verbose:
+                print("State doesn't match the files, rebuilding",
+                      file=sys.stderr)
+        if split is not None:
+            new, date_format = extract_dates_with_format(args, split[1],
+                                                         date_format)
+            files_with_dates = split[0] + new
+            if args.verbose:
+                print(f"State: reused {len(split[0])} dates, worked out "
+                      f"{len(split[1])}", file=sys.stderr)
+    if files_with_dates is None:
+        # files can be a stream from a directory scan, so only go through it
+        # once
+        files_with_dates, date_format = extract_dates_with_format(args,
+                                                                  files)
+    keep_set = keep_from_dates(files_with_dates, args)
+    delete_set = [f for f, _ in files_with_dates if f not in keep_set]
+    failed = 0
+    if args.force:
+        failed = delete_files(delete_set, args, storage)
+    else:
+        for f in delete_set:
             print(f)
+    kept = [(f, dt) for f, dt in files_with_dates if f in keep_set]
+    return kept, failed, date_format
 
 
-def run_simulation(args):
-    backups = []
-    now = datetime.now()
+def process_directory(path, args, state=None, storage=None):
+    """
+    Apply the retention policy to the files in a directory (or S3 prefix),
+    returning the number of failures
+    """
+    storage = storage or LocalStorage()
+    if args.verbose:
+        print(f"\nProcessing directory: {path}", file=sys.stderr)
+    scan_stats = ScanStats()
+    key = state and storage.state_key(path)
+    try:
+        kept, failed, date_format = process_group(
+            storage.scan(path, args, scan_stats), args,
+            state and state.known(key), storage)
+    except storage.errors as e:
+        print(f"Error processing {path}: {e}", file=sys.stderr)
+        return 1
+    if state:
+        state.update(key, kept, date_format)
+    if args.verbose:
+        print(f"Scanned {path}: {scan_stats.report()}", file=sys.stderr)
+    return failed
+
+
+def leaf_directories(path):
+    """
+    Yield the directories below path (or path itself) that have no
+    subdirectories, in order
+    """
+    for dirpath, dirnames, _ in os.walk(path):
+        dirnames.sort()
+        if not dirnames:
+            yield Path(dirpath)
+
+
+class GroupOutput:
+    """
+    Stands in for sys.stdout or sys.stderr while directories are processed
+    in parallel. Each thread's output is collected, so that it can be
+    printed in order once its directory is done.
+    """
+    local = threading.local()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append((self.stream, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return getattr(self.local, "buffer", None) is None and \
+            self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def collect_output(func, *args):
+    """
+    Run func, returning its result and everything it printed
+    """
+    GroupOutput.local.buffer = []
+    try:
+        result = func(*args)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        result = 1
+    finally:
+        output, GroupOutput.local.buffer = GroupOutput.local.buffer, None
+    return result, output
+
+
+def process_directories(directories, args, state=None, storage=None):
+    """
+    Process directories, args.jobs at a time, returning the number of
+    failures. The output for each directory is printed in one piece, in
+    the order the directories were given.
+    """
+    if args.jobs <= 1:
+        return sum(process_directory(d, args, state, storage)
+                   for d in directories)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = GroupOutput(stdout), GroupOutput(stderr)
+    failures = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+            futures = [pool.submit(collect_output, process_directory, d,
+                                   args, state, storage)
+                       for d in directories]
+            for future in futures:
+                failed, output = future.result()
+                failures += failed
+                for stream, text in output:
+                    stream.write(text)
+                stdout.flush()
+                stderr.flush()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return failures
+
+
+def format_size(size):
+    """
+    >>> format_size(1023), format_size(1536), format_size(5 * 1024 ** 3)
+    ('1023 B', '1.5 KiB', '5.0 GiB')
+    """
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if size < 1024 or unit == "TiB":
+            break
+        size /= 1024
+    return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+class RateLimiter:
+    """
+    Spaces out operations so there are at most rate per second across all
+    threads. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self, n=1):
+        """
+        Wait until n more operations can be done
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def delete_file(f, limiter):
+    """
+    Delete a file, returning its size, or the exception if it failed
+    """
+    limiter.wait()
+    try:
+        try:
+            size = f.stat().st_size
+        except OSError:
+            size = 0
+        f.unlink()
+        return size
+    except Exception as e:
+        return e
+
+
+def delete_files(files, args, storage=None):
+    """
+    Delete files with a pool of threads, as each unlink can take a while on
+    network filesystems. Results are printed from one thread as they come
+    in, followed by a summary. Returns the number of failures.
+    """
+    storage = storage or LocalStorage()
+    limiter = RateLimiter(args.max_deletes_per_second)
+    progress = sys.stderr.isatty() and len(files) > 1
+    deleted = failed = reclaimed = 0
+    start = last_progress = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(args.delete_threads) as pool:
+        futures = [pool.submit(storage.delete, batch, limiter)
+                   for batch in storage.batches(files)]
+        results = (r for future in concurrent.futures.as_completed(futures)
+                   for r in future.result())
+        for f, result in results:
+            if progress:
+                # Clear the progress line before printing
+                print("\r\033[K", end="", file=sys.stderr)
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"Failed to delete {f}: {result}", file=sys.stderr)
+            else:
+                deleted += 1
+                reclaimed += result
+                print(f"Deleted: {f}", flush=progress)
+            now = time.monotonic()
+            if progress and (now - last_progress > 0.5 or
+                             deleted + failed == len(files)):
+                last_progress = now
+                rate = (deleted + failed) / max(now - start, 0.001)
+                print(f"Deleting: {deleted + failed}/{len(files)} "
+                      f"({rate:.0f}/s)", end="", file=sys.stderr, flush=True)
+    if progress:
+        print("\r\033[K", end="", file=sys.stderr)
+    if files:
+        print(f"Deleted {deleted} files ({format_size(reclaimed)}), "
+              f"{failed} failed in {time.monotonic() - start:.1f}s",
+              file=sys.stderr)
+    return failed
+
+
+class LocalStorage:
+    """
+    Files in directories on a local (or mounted) filesystem
+    """
+    errors = (OSError,)
+
+    def scan(self, path, args, scan_stats):
+        return scan_files(path, args, scan_stats)
+
+    def leaves(self, path):
+        return leaf_directories(path)
+
+    def state_key(self, path):
+        return os.path.abspath(path)
+
+    def batches(self, files):
+        return ([f] for f in files)
+
+    def delete(self, batch, limiter):
+        return [(f, delete_file(f, limiter)) for f in batch]
+
+
+ObjectStat = namedtuple("ObjectStat", "st_size st_mtime st_mtime_ns")
+
+
+class S3Object:
+    """
+    An object in S3, with as much of the Path interface as retention needs
+
+    >>> o = S3Object('b', 'db/backup_2025-07-15.tar.gz', 10,
+    ...              datetime(2025, 7, 15, 1, 2, 3))
+    >>> str(o)
+    's3://b/db/backup_2025-07-15.tar.gz'
+    >>> o.name, o.stem
+    ('backup_2025-07-15.tar.gz', 'backup_2025-07-15.tar')
+    >>> o.stat().st_size, datetime.fromtimestamp(o.stat().st_mtime)
+    (10, datetime.datetime(2025, 7, 15, 1, 2, 3))
+    """
+
+    def __init__(self, bucket, key, size, last_modified):
+        self.bucket = bucket
+        self.key = key
+        self.name = key.rsplit("/", 1)[-1]
+        mtime = last_modified.timestamp()
+        self._stat = ObjectStat(size, mtime, int(mtime * 1e9))
+
+    @property
+    def stem(self):
+        return PurePosixPath(self.name).stem
+
+    def stat(self):
+        return self._stat
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.key}"
+
+    def __repr__(self):
+        return f"S3Object({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, S3Object) and \
+            (self.bucket, self.key) == (other.bucket, other.key)
+
+    def __lt__(self, other):
+        return (self.bucket, self.key) < (other.bucket, other.key)
+
+    def __hash__(self):
+        return hash((self.bucket, self.key))
+
+
+class S3Storage:
+    """
+    Objects under prefixes in S3, which are treated like directories. A
+    prefix is listed with paged ListObjectsV2 calls, using LastModified as
+    the mtime, and objects are deleted a batch at a time with DeleteObjects
+    rather than a request each.
+    """
+
+    def __init__(self, args):
+        # Only needed for s3:// paths
+        import boto3
+        import botocore.config
+        import botocore.exceptions
+        self.errors = (OSError, botocore.exceptions.BotoCoreError,
+                       botocore.exceptions.ClientError)
+        connections = max(10, args.delete_threads, args.jobs)
+        self.client = boto3.client(
+            "s3", endpoint_url=args.endpoint_url,
+            config=botocore.config.Config(max_pool_connections=connections))
+
+    @staticmethod
+    def split(url):
+        """
+        >>> S3Storage.split('s3://bucket/backups/db')
+        ('bucket', 'backups/db/')
+        >>> S3Storage.split('s3://bucket')
+        ('bucket', '')
+        """
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return bucket, prefix
+
+    def list(self, url):
+        bucket, prefix = self.split(url)
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                       Delimiter="/"):
+            yield bucket, page
+
+    def scan(self, url, args, scan_stats):
+        prefix = self.split(url)[1]
+        for bucket, page in self.list(url):
+            scan_stats.directories += 1
+            for item in page.get("Contents", []):
+                # Skip the empty object some tools make for a "folder"
+                if item["Key"] != prefix:
+                    scan_stats.files += 1
+                    yield S3Object(bucket, item["Key"], item["Size"],
+                                   item["LastModified"])
+
+    def leaves(self, url):
+        subprefixes = [f"s3://{bucket}/{p['Prefix']}"
+                       for bucket, page in self.list(url)
+                       for p in page.get("CommonPrefixes", [])]
+        if not subprefixes:
+            yield self.state_key(url)
+        for p in subprefixes:
+            yield from self.leaves(p)
+
+    def state_key(self, url):
+        return "s3://%s/%s" % self.split(url)
+
+    def batches(self, files):
+        for i in range(0, len(files), S3_DELETE_BATCH_SIZE):
+            yield files[i:i + S3_DELETE_BATCH_SIZE]
+
+    def delete(self, batch, limiter):
+        """
+        Delete a batch of objects from the same bucket, returning (object,
+        size or exception) pairs
+        """
+        limiter.wait(len(batch))
+        try:
+            response = self.client.delete_objects(
+                Bucket=batch[0].bucket,
+                Delete={"Objects": [{"Key": o.key} for o in batch],
+                        "Quiet": True})
+        except Exception as e:
+            return [(o, e) for o in batch]
+        errors = {e["Key"]: OSError(f"{e.get('Code')}: {e.get('Message')}")
+                  for e in response.get("Errors", [])}
+        return [(o, errors.get(o.key, o.stat().st_size)) for o in batch]
+
+
+def is_s3_url(path):
+    return path.startswith("s3://")
+
+
+def parse_size(text):
+    """
+    >>> parse_size('1024'), parse_size('1.5K'), parse_size('2GiB')
+    (1024, 1536, 2147483648)
+    """
+    m = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)(?:i?B)?\s*", text, re.I)
+    if not m:
+        raise ValueError(f"invalid size: {text!r}")
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(
+        m.group(2).upper() or " "))
+
+
+def optional_numpy(use_numpy=True):
+    """
+    Return numpy if it's installed and wanted, otherwise None. It's in the
+    script's dependencies, so is there when run with uv.
+    """
+    if not use_numpy:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def simulation_slots(first, days, np=None):
+    """
+    Slot ids for each policy of the days from ordinal first on, worked out
+    for all days at once with numpy if it's given.
+
+    >>> s = simulation_slots(datetime(2025, 1, 30).toordinal(), 4)
+    >>> [s['monthly'][i] - s['monthly'][0] for i in range(4)]
+    [0, 0, 1, 1]
+    """
+    if np is None:
+        dates = [datetime.fromordinal(first + i) for i in range(days)]
+        return {k: [f(dt) for dt in dates] for k, f in SLOT_FUNCTIONS.items()}
+    ordinals = np.arange(first, first + days, dtype=np.int64)
+    epoch = datetime(1970, 1, 1).toordinal()
+    months = (ordinals - epoch).astype("datetime64[D]") \
+        .astype("datetime64[M]").astype(np.int64) + 1970 * 12
+    return {
+        "daily": ordinals,
+        "weekly": (ordinals - 1) // 7,
+        "monthly": months,
+        "yearly": months // 12,
+    }
+
+
+def expiry_days(slots, limit, days, np=None):
+    """
+    For a backup made on each of days days, the last day that a policy
+    keeps it, given slot ids for one more day than that.
+
+    With a backup every day, every slot has a backup in it, so there is no
+    need to replay retention day by day. A backup that isn't the last of
+    its slot is only kept on the day it is made, as the next day's backup
+    replaces it. The last backup of a slot is kept until the day limit
+    slots later starts.
+    """
+    if np is None:
+        return [bisect.bisect_left(slots, slots[i] + limit) - 1
+                if slots[i] != slots[i + 1] else i for i in range(days)]
+    last = slots[:days] != slots[1:days + 1]
+    ends = np.searchsorted(slots, slots[:days] + limit) - 1
+    return np.where(last, ends, np.arange(days))
+
+
+def simulate_policy(slots, days, limits, interval=1, sizes=1, np=None,
+                    log=None, start=None):
+    """
+    Simulate a daily backup and retention every interval days for days
+    days. A backup is deleted by the first retention run after the last day
+    any policy keeps it, which gives the number and size of backups there
+    are each day without replaying retention. See simulate_retention().
+    """
+    expiries = {k: expiry_days(slots[k], limit, days, np)
+                for k, limit in limits.items() if limit > 0}
+    if np is None:
+        expiry = [max(e) for e in zip(*expiries.values())] if expiries \
+            else [i - 1 for i in range(days)]
+        deleted = [min(days, (e + 1) // interval * interval + interval - 1)
+                   for e in expiry]
+        if not isinstance(sizes, (list, tuple)):
+            sizes = [sizes] * days
+        removed = [0] * (days + 1)
+        removed_size = [0] * (days + 1)
+        for d, size in zip(deleted, sizes):
+            removed[d] += 1
+            removed_size[d] += size
+        gone = list(itertools.accumulate(removed[:days]))
+        gone_size = list(itertools.accumulate(removed_size[:days]))
+        made_size = list(itertools.accumulate(sizes))
+        # Backups kept at the end of each day, and just before retention
+        retained = [t + 1 - g for t, g in enumerate(gone)]
+        retained_size = [m - g for m, g in zip(made_size, gone_size)]
+        before = [r + n for r, n in zip(retained, removed)]
+        before_size = [r + n for r, n in zip(retained_size, removed_size)]
+        steady = retained[-365:]
+        steady_size = retained_size[-365:]
+    else:
+        expiry = np.maximum.reduce(list(expiries.values())) if expiries \
+            else np.arange(days) - 1
+        deleted = np.minimum(days, (expiry + 1) // interval * interval +
+                             interval - 1)
+        sizes = np.broadcast_to(np.asarray(sizes, dtype=np.float64), days)
+        removed = np.bincount(deleted, minlength=days + 1)[:days]
+        removed_size = np.bincount(deleted, weights=sizes,
+                                   minlength=days + 1)[:days]
+        retained = np.arange(1, days + 1) - np.cumsum(removed)
+        retained_size = np.cumsum(sizes) - np.cumsum(removed_size)
+        before = retained + removed
+        before_size = retained_size + removed_size
+        steady = retained[-365:]
+        steady_size = retained_size[-365:]
+    if log:
+        simulation_log(log, start, days, interval, expiries, deleted)
+    return {
+        "limits": dict(limits),
+        "retained": [int(n) for n in retained],
+        "peak_files": int(max(before)),
+        "peak_size": int(max(before_size)),
+        "steady_files": float(sum(steady) / len(steady)),
+        "steady_size": float(sum(steady_size) / len(steady_size)),
+    }
+
+
+def simulation_log(out, start, days, interval, expiries, deleted):
+    """
+    Write what happens on each day of a simulation, like a real run with -v
+    would print
+    """
+    def name(d):
+        return f"backup_{datetime.fromordinal(start + d):%Y-%m-%d}.tar.gz"
+
+    present = []
+    for t in range(days):
+        print(f"# {datetime.fromordinal(start + t):%Y-%m-%d}\n", file=out)
+        print(f"* Create backup: {name(t)}", file=out)
+        present.append(t)
+        if (t + 1) % interval == 0:
+            print("* Run retention\n", file=out)
+            for d in present:
+                if deleted[d] > t:
+                    dt = datetime.fromordinal(start + d)
+                    reasons = [f"{k} {bucket_key(dt, k)}"
+                               for k, e in expiries.items() if e[d] >= t]
+                    print(f"Keep {name(d)}: {', '.join(reasons)}", file=out)
+            for d in present:
+                if deleted[d] <= t:
+                    print(f"Delete {name(d)}", file=out)
+            present = [d for d in present if deleted[d] > t]
+        print(file=out)
+
+
+def simulate_retention(days, limits, interval=1, start=None, sizes=1,
+                       log=None, use_numpy=True):
+    """
+    Simulate making a backup each day for days days, and running retention
+    every interval days. sizes is the size of each backup, or a list of
+    sizes, one for each day. If log is a file, what happens each day is
+    written to it. Returns a dict of:
+
+    retained:     the number of backups kept at the end of each day
+    peak_files:   the most backups there are at once, just before retention
+    peak_size:    their total size at the most
+    steady_files: the average number of backups kept over the last year
+    steady_size:  their average total size
+
+    numpy is used if it is installed, unless use_numpy is False.
+
+    >>> start = datetime(2025, 1, 1).toordinal()
+    >>> limits = {'daily': 7, 'weekly': 4, 'monthly': 6, 'yearly': 1}
+    >>> r = simulate_retention(800, limits, start=start, sizes=10)
+    >>> r['peak_files'], r['peak_size'], round(r['steady_files'], 1)
+    (16, 160, 13.8)
+    >>> all(simulate_retention(400, limits, i, start, use_numpy=numpy)
+    ...     ['retained'] == simulate_retention_simple(400, limits, i, start)
+    ...     for i in (1, 3, 7, 30) for numpy in (True, False))
+    True
+    """
+    start = start or datetime.now().toordinal()
+    np = optional_numpy(use_numpy)
+    slots = simulation_slots(start, days + 1, np)
+    return simulate_policy(slots, days, limits, interval, sizes, np, log,
+                           start)
+
+
+def sweep_retention(days, grid, interval=1, start=None, sizes=1,
+                    use_numpy=True):
+    """
+    Simulate every combination of limits in grid, a dict of {policy: [limit,
+    ...]}, sharing the work that doesn't depend on the limits. Returns a
+    list of simulate_retention() results.
+
+    >>> grid = {'daily': [7, 14], 'weekly': [4], 'monthly': [0, 12]}
+    >>> [(r['limits']['daily'], r['limits']['monthly'], r['peak_files'])
+    ...  for r in sweep_retention(800, grid, 1, 739252)]
+    [(7, 0, 11), (7, 12, 22), (14, 0, 17), (14, 12, 28)]
+    """
+    start = start or datetime.now().toordinal()
+    np = optional_numpy(use_numpy)
+    slots = simulation_slots(start, days + 1, np)
+    policies = list(grid)
+    return [simulate_policy(slots, days, dict(zip(policies, values)),
+                            interval, sizes, np)
+            for values in itertools.product(*grid.values())]
+
+
+def simulate_retention_simple(days, limits, interval=1, start=None):
+    """
+    Simulate retention by running retention_slots() on the backups there are
+    every interval days, returning the number kept at the end of each day.
+    Kept to check simulate_retention() against.
+    """
+    start = start or datetime.now().toordinal()
+    present = []
+    retained = []
+    for t in range(days):
+        present.append(datetime.fromordinal(start + t))
+        if (t + 1) % interval == 0:
+            slots = retention_slots(present, limits)
+            keep = sorted(set(i for m in slots.values() for i in m.values()))
+            present = [present[i] for i in keep]
+        retained.append(len(present))
+    return retained
+
+
+def simulation_interval(value):
+    """
+    >>> simulation_interval('weekly'), simulation_interval('3')
+    (7, 3)
+    """
     try:
-        interval = int(args.simulate_retention_interval)
-        delta = timedelta(days=interval)
+        return int(value)
     except ValueError:
-        delta = {
-            "daily": timedelta(days=1),
-            "weekly": timedelta(weeks=1),
-            "monthly": timedelta(days=30)
-        }.get(args.simulate_retention_interval, timedelta(days=1))
-
-    print(f"# Simulating retention for {args.simulate} days\n")
-    print("* Backups are created daily")
-    print(f"* Retention is run every {delta.days} days\n")
-
-    for i in range(args.simulate):
-        current_day = now + timedelta(days=i)
-        filename = f"backup_{current_day.strftime('%Y-%m-%d')}.tar.gz"
-        print(f"# {current_day.strftime('%Y-%m-%d')}\n")
-        print(f"* Create backup: {filename}")
-
-        backups.append(Path(filename))
-
-        # Simulate retention once per interval
-        if (i + 1) % delta.days == 0:
-            print("* Run retention\n")
-
-            class SimArgs:
-                keep_daily = args.keep_daily
-                keep_weekly = args.keep_weekly
-                keep_monthly = args.keep_monthly
-                keep_yearly = args.keep_yearly
-                date_from_filename = True
-                filename_prefix = "backup_"
-                filename_suffix = ".tar.gz"
-                force = False
-                verbose = True
-
-            keep_set = get_files_to_keep(backups, SimArgs())
-            delete_set = set(backups) - keep_set
-            for f in sorted(delete_set):
-                print(f"Delete {f}")
-                backups.remove(f)
+        return {"daily": 1, "weekly": 7, "monthly": 30}.get(value, 1)
 
+
+def run_simulation(args):
+    interval = simulation_interval(args.simulate_retention_interval)
+    size = parse_size(args.simulate_backup_size)
+    limits = get_limits(args)
+    grid = {k: [limits.get(k, 0)] for k in SLOT_FUNCTIONS}
+    for sweep in args.sweep or []:
+        policy, _, values = sweep.partition("=")
+        if policy not in grid:
+            print(f"Error: Unknown policy in --sweep {sweep}", file=sys.stderr)
+            return 1
+        grid[policy] = [int(v) for v in values.split(",")]
+
+    if not args.sweep and args.simulate_output == "log":
+        print(f"# Simulating retention for {args.simulate} days\n")
+        print("* Backups are created daily")
+        print(f"* Retention is run every {interval} days\n")
+        results = [simulate_retention(args.simulate, limits, interval,
+                                      sizes=size, log=sys.stdout)]
+    else:
+        results = sweep_retention(args.simulate, grid, interval, sizes=size)
+
+    if args.simulate_output == "json":
+        for r in results:
+            del r["retained"]
+        json.dump(results, sys.stdout, indent=2)
         print()
+        return 0
+    print(f"{'daily':>6} {'weekly':>6} {'monthly':>7} {'yearly':>6} "
+          f"{'peak files':>10} {'peak size':>10} "
+          f"{'steady files':>12} {'steady size':>11}")
+    for r in results:
+        limits = r["limits"]
+        print(f"{limits.get('daily', 0):>6} {limits.get('weekly', 0):>6} "
+              f"{limits.get('monthly', 0):>7} {limits.get('yearly', 0):>6} "
+              f"{r['peak_files']:>10} {format_size(r['peak_size']):>10} "
+              f"{r['steady_files']:>12.1f} "
+              f"{format_size(round(r['steady_size'])):>11}")
+    return 0
 
 
 def main():
     args = parse_args()
     if args.run_tests:
         doctest.testmod()
+        if args.benchmark:
+            benchmark_retention(args.benchmark, get_limits(args), verbose=True)
         return
 
     if args.simulate > 0:
-        run_simulation(args)
-        return
+        return run_simulation(args)
 
-    paths = [Path(p) for p in args.paths]
+    if any(is_s3_url(p) for p in args.paths):
+        if not all(is_s3_url(p) for p in args.paths):
+            print("Error: Cannot mix S3 and local paths.", file=sys.stderr)
+            return 1
+        storage = S3Storage(args)
+        paths = args.paths
+    else:
+        storage = LocalStorage()
+        paths = [Path(p) for p in args.paths]
 
-    if all(p.is_dir() for p in paths):
-        for p in paths:
-            files = [f for f in p.iterdir() if f.is_file()]
-            if args.verbose:
-                print(f"\nProcessing directory: {p}", file=sys.stderr)
-            process_group(files, args)
+    if isinstance(storage, S3Storage) or all(p.is_dir() for p in paths):
+        if args.recursive:
+            paths = [d for p in paths for d in storage.leaves(p)]
+        state = args.state and RetentionState(args.state, args)
+        failures = process_directories(paths, args, state, storage)
+        if state:
+            state.save()
     elif all(p.is_file() for p in paths):
-        process_group(paths, args)
+        _, failures, _ = process_group(paths, args)
     else:
         print("Error: Cannot mix files and directories.", file=sys.stderr)
-        return
+        return 1
+    if failures:
+        print(f"{failures} failures", file=sys.stderr)
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -21,55 +21,3023 @@
 """
 S3 interactive shell
 
-This is a simple wrapper around the aws command line tools that will let you
-interact with files in s3 like you would with a shell, using ls/cd and so on.
+This lets you interact with files in s3 like you would with a shell, using
+ls/cd and so on. By default it talks to S3 in-process using boto3, keeping a
+single client (and its connection pool) alive for the whole session. If boto3
+isn't installed, or --backend cli is given, it falls back to wrapping the aws
+command line tools.
 """
 import argparse
+import bz2
 import cmd
+import collections
+import concurrent.futures
+import csv
+import datetime
+import fnmatch
+import functools
+import glob
+import hashlib
 import inspect
+import io
+import json
+import lzma
 import os
+import queue
+import random
+import re
 import readline
 import shlex
+import sqlite3
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import boto3
+    import boto3.s3.transfer
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class BackendError(Exception):
+    pass
+
+
+class PreconditionFailed(BackendError):
+    pass
+
+
+class SelectUnsupported(BackendError):
+    """Raised when S3 Select isn't available for an object
+
+    permanent is False for server errors, which only mean that this query
+    should be run locally rather than that S3 Select doesn't work.
+    """
+
+    def __init__(self, message, permanent=True):
+        BackendError.__init__(self, message)
+        self.permanent = permanent
+
+
+# Errors meaning that S3 Select can't be used at all, rather than that the
+# query was wrong. S3 compatible stores often don't implement it.
+SELECT_UNAVAILABLE = ('NotImplemented', 'XNotImplemented', 'MethodNotAllowed',
+                      'UnsupportedOperation')
+
+# Server errors, after which a query is run locally instead, without giving
+# up on S3 Select for later queries
+SELECT_FAILED = ('InternalError', 'ServiceUnavailable', 'SlowDown', '500',
+                 '501', '502', '503')
+
+
+class NotModified(Exception):
+    """Raised by conditional gets when the object hasn't changed"""
+    pass
+
+
+class UsageError(Exception):
+    pass
+
+
+class ShellArgumentParser(argparse.ArgumentParser):
+    """Argument parser for shell commands that doesn't exit on errors"""
+
+    def __init__(self, prog, **kwargs):
+        kwargs.setdefault('add_help', False)
+        argparse.ArgumentParser.__init__(self, prog=prog, **kwargs)
+
+    def error(self, message):
+        raise UsageError(message)
+
+
+def parse_size(value):
+    """Parse a size with an optional K/M/G/T suffix into bytes
+
+    >>> parse_size('512'), parse_size('8M'), parse_size('1.5k')
+    (512, 8388608, 1536)
+    """
+    value = value.strip().upper().rstrip('B')
+    units = 'KMGT'
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+    return int(value)
+
+
+STREAM_CHUNK = 64 * 1024
+
+# The largest range head and tail fetch at once while looking for lines
+MAX_LINE_WINDOW = 16 * 1024 * 1024
+
+
+def parse_range(value):
+    """Turn START-END, START- or -LENGTH into an HTTP Range header
+
+    >>> parse_range('0-99'), parse_range('100-'), parse_range('-4K')
+    ('bytes=0-99', 'bytes=100-', 'bytes=-4096')
+    """
+    start, sep, end = value.partition('-')
+    if not sep or not (start or end):
+        raise UsageError("Invalid range: %s" % value)
+    return "bytes=%s-%s" % (parse_size(start) if start else '',
+                            parse_size(end) if end else '')
+
+
+def zstd_decompressor():
+    if zstandard is None:
+        raise BackendError("zstandard is not installed, can't decompress "
+                           ".zst files")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# Errors raised by the decompressors for corrupt or truncated data. bz2
+# raises OSError.
+CODEC_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+if zstandard is not None:
+    CODEC_ERRORS += (zstandard.ZstdError,)
+
+# Magic numbers and decompressor factories for the supported formats
+DECOMPRESSORS = [
+    (b'\x1f\x8b', lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    (b'BZh', bz2.BZ2Decompressor),
+    (b'\x28\xb5\x2f\xfd', zstd_decompressor),
+    (b'\xfd7zXZ\x00', lzma.LZMADecompressor),
+]
+
+
+def decompress_chunks(chunks):
+    """Incrementally decompress a stream of chunks
+
+    The format is detected from the magic number at the start of the stream,
+    and uncompressed data is passed through unchanged. Files made of several
+    concatenated compressed streams (e.g. from 'cat a.gz b.gz') are handled.
+
+    >>> import gzip
+    >>> data = gzip.compress(b'hello ') + gzip.compress(b'world')
+    >>> b''.join(decompress_chunks(iter([data[:5], data[5:]])))
+    b'hello world'
+    >>> b''.join(decompress_chunks(iter([b'plain'])))
+    b'plain'
+    >>> try:
+    ...     b''.join(decompress_chunks(iter([b'\\xfd7zXZ\\x00corrupt'])))
+    ... except BackendError as e:
+    ...     print(e)
+    Corrupt compressed data: Corrupt input data
+    """
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 6:
+            break
+    factory = None
+    for magic, f in DECOMPRESSORS:
+        if head.startswith(magic):
+            factory = f
+    if factory is None:
+        if head:
+            yield head
+        for chunk in chunks:
+            yield chunk
+        return
+    d = factory()
+    pending = head
+    while True:
+        while pending:
+            try:
+                data = d.decompress(pending)
+            except CODEC_ERRORS as e:
+                raise BackendError("Corrupt compressed data: %s" % e)
+            if data:
+                yield data
+            if getattr(d, 'eof', False):
+                pending = d.unused_data
+                d = factory()
+            else:
+                pending = b''
+        pending = next(chunks, None)
+        if pending is None:
+            break
+
+
+def iter_lines(chunks):
+    """Split a stream of chunks into lines, without their line endings"""
+    partial = b''
+    for chunk in chunks:
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line
+    if partial:
+        yield partial
+
+
+def parse_time(value, now=None):
+    """Parse a date/time, or an age such as 7d or 12h, into a datetime
+
+    Dates without a timezone are taken to be local time.
+
+    >>> now = datetime.datetime(2025, 7, 15, tzinfo=datetime.timezone.utc)
+    >>> parse_time('2d', now)
+    datetime.datetime(2025, 7, 13, 0, 0, tzinfo=datetime.timezone.utc)
+    >>> parse_time('2025-07-01T12:00+00:00')
+    datetime.datetime(2025, 7, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhdw])$', value)
+    if match:
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        return now - datetime.timedelta(
+            seconds=float(match.group(1)) * units[match.group(2)])
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise UsageError("Invalid date: %s" % value)
+    if dt.tzinfo is None:
+        dt = dt.astimezone()
+    return dt
+
+
+def has_glob(path):
+    return any(c in path for c in '*?[')
+
+
+def glob_stem(path):
+    """Return the part of a path before any wildcards
+
+    Every path the pattern can match starts with the stem.
+
+    >>> glob_stem('logs/2025-*.gz'), glob_stem('logs/a.txt')
+    ('logs/2025-', 'logs/a.txt')
+    """
+    for i, c in enumerate(path):
+        if c in '*?[':
+            return path[:i]
+    return path
+
+
+def human_size(size):
+    """Format a size in bytes using binary units
+
+    >>> human_size(1023), human_size(1536), human_size(5 * 1024 ** 3)
+    ('1023B', '1.5K', '5.0G')
+    """
+    for unit in 'BKMGTP':
+        if size < 1024 or unit == 'P':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return "%d%s" % (size, unit)
+    return "%.1f%s" % (size, unit)
+
+
+def parse_s3url(url):
+    """Split an s3://bucket/key url into (bucket, key)"""
+    bucket, _, key = url[len("s3://"):].partition('/')
+    return bucket, key
+
+
+def s3url(bucket, key=''):
+    return "s3://%s/%s" % (bucket, key)
+
+
+def parent_prefixes(key):
+    """Return the directory prefixes that would list a key
+
+    >>> parent_prefixes('a/b/c.txt')
+    ['', 'a/', 'a/b/']
+    """
+    parts = key.split('/')[:-1]
+    return [''.join(p + '/' for p in parts[:i]) for i in range(len(parts) + 1)]
+
+
+S3Object = collections.namedtuple(
+    'S3Object', 'key size mtime etag storage_class')
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.strptime(
+        value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+
+
+def s3object(d):
+    """Convert a Contents entry from ListObjectsV2 into an S3Object"""
+    return S3Object(d['Key'], d['Size'], parse_timestamp(d['LastModified']),
+                    d.get('ETag', '').strip('"'),
+                    d.get('StorageClass', 'STANDARD'))
+
+
+SQL_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>\d+\.\d*|\.\d+|\d+) |
+    (?P<string>'(?:[^']|'')*') |
+    (?P<quoted>"(?:[^"]|"")*") |
+    (?P<name>[A-Za-z_][A-Za-z0-9_]*) |
+    (?P<op><>|!=|<=|>=|\|\||[-+*/%=<>(),.\[\]])
+    )""", re.X)
+
+SQL_CASTS = {
+    'int': int, 'integer': int, 'bigint': int, 'smallint': int,
+    'float': float, 'real': float, 'double': float, 'decimal': float,
+    'numeric': float, 'string': str, 'varchar': str, 'char': str,
+    'bool': lambda v: str(v).lower() in ('true', '1'),
+    'boolean': lambda v: str(v).lower() in ('true', '1'),
+    'timestamp': lambda v: parse_timestamp(str(v)),
+}
+
+SQL_FUNCTIONS = {
+    'lower': lambda s: s.lower(),
+    'upper': lambda s: s.upper(),
+    'trim': lambda s: s.strip(),
+    'char_length': len,
+    'character_length': len,
+    'substring': lambda s, start, length=None: s[
+        int(start) - 1:length is not None and int(start) - 1 + int(length)
+        or None],
+}
+
+SQL_AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+
+SQL_COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+SQL_ARITHMETIC = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '%': lambda a, b: a % b,
+}
+
+
+def sql_number(value):
+    """Convert a value to a number if it looks like one
+
+    CSV fields are always strings, so comparing them with numbers would
+    otherwise never match.
+
+    >>> sql_number('42'), sql_number('4.5'), sql_number('abc')
+    (42, 4.5, 'abc')
+    """
+    if isinstance(value, str):
+        for convert in (int, float):
+            try:
+                return convert(value)
+            except ValueError:
+                pass
+    return value
+
+
+def sql_coerce(a, b):
+    """Make a pair of values comparable"""
+    if isinstance(a, str) != isinstance(b, str):
+        a, b = sql_number(a), sql_number(b)
+        if isinstance(a, str) != isinstance(b, str):
+            a, b = str(a), str(b)
+    return a, b
+
+
+@functools.lru_cache(maxsize=64)
+def like_regex(pattern):
+    parts = []
+    for c in pattern:
+        parts.append({'%': '.*', '_': '.'}.get(c) or re.escape(c))
+    return re.compile(''.join(parts) + r'\Z', re.S)
+
+
+def sql_lookup(value, name):
+    """Look up a field in a record, case insensitively if need be
+
+    Positional names like _1 also work on records with a header.
+    """
+    if not isinstance(value, dict):
+        return None
+    if name in value:
+        return value[name]
+    lower = name.lower()
+    for k, v in value.items():
+        if k.lower() == lower:
+            return v
+    if re.match(r'^_\d+$', name):
+        values = list(value.values())
+        index = int(name[1:]) - 1
+        if 0 <= index < len(values):
+            return values[index]
+    return None
+
+
+class SelectQuery(object):
+    """A small, streaming evaluator for the S3 Select dialect of SQL
+
+    This is used when S3 Select isn't available. It handles the common subset
+    of it: SELECT * or a list of expressions (which can be aggregates), FROM
+    S3Object with an optional alias, WHERE and LIMIT. Aggregates are computed
+    per file, as they are with S3 Select.
+
+    >>> rows = [{'name': 'bob', 'age': '3'}, {'name': 'amy', 'age': '40'},
+    ...         {'name': 'cat', 'age': '12'}]
+    >>> q = SelectQuery("SELECT s.name FROM S3Object s WHERE s.age > 5 "
+    ...                 "LIMIT 1")
+    >>> list(q.run(rows))
+    [[('name', 'amy')]]
+    >>> q = SelectQuery("select count(*), max(cast(age as int)) from s3object "
+    ...                 "where name like '%a%'")
+    >>> list(q.run(rows))
+    [[('_1', 2), ('_2', 40)]]
+    >>> q = SelectQuery("SELECT UPPER(_1) AS n FROM S3Object "
+    ...                 "WHERE _2 IN ('3', '12') AND NOT _1 = 'cat'")
+    >>> list(q.run(rows))
+    [[('n', 'BOB')]]
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.alias = None
+        self.where = None
+        self.limit = None
+        self.columns = None
+        self.aggregates = []
+        self.results = []
+        tokens = self.tokenize(sql)
+        depth = 0
+        for i, (kind, value) in enumerate(tokens):
+            if kind == 'op' and value in '([':
+                depth += 1
+            elif kind == 'op' and value in ')]':
+                depth -= 1
+            elif depth == 0 and kind == 'name' and value.lower() == 'from':
+                break
+        else:
+            raise UsageError("Missing FROM in query")
+        # The FROM clause is read first so that column references can have
+        # the table alias stripped off
+        self.tokens, self.pos = tokens[i + 1:], 0
+        self.parse_from()
+        if self.keyword('where'):
+            self.where = self.parse_expression()
+        if self.keyword('limit'):
+            self.limit = int(self.take('number'))
+        self.end()
+        self.tokens, self.pos = tokens[:i], 0
+        if not self.keyword('select'):
+            raise UsageError("Query must start with SELECT")
+        self.parse_columns()
+        self.end()
+
+    def tokenize(self, sql):
+        tokens = []
+        pos = 0
+        sql = sql.rstrip().rstrip(';')
+        while pos < len(sql.rstrip()):
+            match = SQL_TOKEN.match(sql, pos)
+            if not match:
+                raise UsageError("Can't parse query at: %s" % sql[pos:])
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == 'number':
+                value = '.' in value and float(value) or int(value)
+            elif kind == 'string':
+                value = value[1:-1].replace("''", "'")
+            elif kind == 'quoted':
+                value = value[1:-1].replace('""', '"')
+            tokens.append((kind, value))
+            pos = match.end()
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def take(self, kind):
+        token_kind, value = self.peek()
+        if token_kind != kind:
+            raise UsageError("Expected %s in query, found %s" % (
+                kind, value is None and 'the end' or repr(value)))
+        self.pos += 1
+        return value
+
+    def keyword(self, *words):
+        kind, value = self.peek()
+        if kind == 'name' and value.lower() in words:
+            self.pos += 1
+            return value.lower()
+        return None
+
+    def op(self, *ops):
+        kind, value = self.peek()
+        if kind == 'op' and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def expect(self, op):
+        if not self.op(op):
+            self.take(op)
+
+    def end(self):
+        if self.pos < len(self.tokens):
+            raise UsageError("Unexpected %r in query" % (
+                self.tokens[self.pos][1],))
+
+    def parse_from(self):
+        if (self.take('name') or '').lower() != 's3object':
+            raise UsageError("Only FROM S3Object is supported")
+        if self.op('['):
+            self.expect('*')
+            self.expect(']')
+        self.keyword('as')
+        kind, value = self.peek()
+        if kind == 'quoted' or (kind == 'name' and
+                                value.lower() not in ('where', 'limit')):
+            self.alias = value.lower()
+            self.pos += 1
+
+    def parse_columns(self):
+        if self.op('*'):
+            return
+        self.columns = []
+        while True:
+            start = self.pos
+            expr = self.parse_expression(aggregates=True)
+            tokens = self.tokens[start:self.pos]
+            name = '_%d' % (len(self.columns) + 1)
+            if all(k in ('name', 'quoted') or v == '.' for k, v in tokens):
+                name = tokens[-1][1]
+            if self.keyword('as'):
+                name = self.take(self.peek()[0] == 'quoted' and 'quoted' or
+                                 'name')
+            self.columns.append((name, expr))
+            if not self.op(','):
+                break
+
+    def parse_expression(self, aggregates=False):
+        self.allow_aggregates = aggregates
+        return self.parse_or()
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.keyword('or'):
+            right = self.parse_and()
+            left = (lambda a, b: lambda r: a(r) or b(r))(left, right)
+        return left
+
+    def parse_and(self):
+        left = self.parse_not()
+        while self.keyword('and'):
+            right = self.parse_not()
+            left = (lambda a, b: lambda r: a(r) and b(r))(left, right)
+        return left
+
+    def parse_not(self):
+        if self.keyword('not'):
+            inner = self.parse_not()
+
+            def negate(r):
+                value = inner(r)
+                return value if value is None else not value
+            return negate
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_sum()
+        op = self.op(*SQL_COMPARISONS)
+        if op:
+            right = self.parse_sum()
+            compare = SQL_COMPARISONS[op]
+
+            def comparison(r):
+                a, b = left(r), right(r)
+                if a is None or b is None:
+                    return None
+                try:
+                    return compare(*sql_coerce(a, b))
+                except TypeError:
+                    return False
+            return comparison
+        if self.keyword('is'):
+            negated = bool(self.keyword('not'))
+            if not self.keyword('null', 'missing'):
+                raise UsageError("Expected NULL after IS")
+            return lambda r: (left(r) is None) != negated
+        negated = bool(self.keyword('not'))
+        if self.keyword('like'):
+            pattern = self.parse_sum()
+
+            def like(r):
+                value, p = left(r), pattern(r)
+                if value is None or p is None:
+                    return None
+                return bool(like_regex(str(p)).match(str(value))) != negated
+            return like
+        if self.keyword('in'):
+            self.expect('(')
+            options = [self.parse_sum()]
+            while self.op(','):
+                options.append(self.parse_sum())
+            self.expect(')')
+
+            def within(r):
+                value = left(r)
+                if value is None:
+                    return None
+                return any(a == b for a, b in (
+                    sql_coerce(value, o(r)) for o in options)) != negated
+            return within
+        if self.keyword('between'):
+            low = self.parse_sum()
+            if not self.keyword('and'):
+                raise UsageError("Expected AND in BETWEEN")
+            high = self.parse_sum()
+
+            def between(r):
+                value, lo, hi = left(r), low(r), high(r)
+                if value is None or lo is None or hi is None:
+                    return None
+                a, lo = sql_coerce(value, lo)
+                b, hi = sql_coerce(value, hi)
+                return (lo <= a and b <= hi) != negated
+            return between
+        if negated:
+            raise UsageError("Expected LIKE, IN or BETWEEN after NOT")
+        return left
+
+    def parse_sum(self):
+        left = self.parse_product()
+        while True:
+            op = self.op('+', '-', '||')
+            if not op:
+                return left
+            right = self.parse_product()
+            if op == '||':
+                left = (lambda a, b: lambda r: None if a(r) is None or
+                        b(r) is None else str(a(r)) + str(b(r)))(left, right)
+            else:
+                left = self.arithmetic(op, left, right)
+
+    def parse_product(self):
+        left = self.parse_unary()
+        while True:
+            op = self.op('*', '/', '%')
+            if not op:
+                return left
+            left = self.arithmetic(op, left, self.parse_unary())
+
+    def arithmetic(self, op, left, right):
+        func = SQL_ARITHMETIC[op]
+
+        def calculate(r):
+            a, b = sql_number(left(r)), sql_number(right(r))
+            if a is None or b is None:
+                return None
+            return func(a, b)
+        return calculate
+
+    def parse_unary(self):
+        if self.op('-'):
+            inner = self.parse_unary()
+            return lambda r: None if inner(r) is None else -sql_number(
+                inner(r))
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value = self.peek()
+        if kind in ('number', 'string'):
+            self.pos += 1
+            return lambda r: value
+        if self.op('('):
+            inner = self.parse_or()
+            self.expect(')')
+            return inner
+        if kind == 'name':
+            word = value.lower()
+            if word in ('null', 'missing'):
+                self.pos += 1
+                return lambda r: None
+            if word in ('true', 'false'):
+                self.pos += 1
+                return lambda r: word == 'true'
+            if self.pos + 1 < len(self.tokens) and \
+                    self.tokens[self.pos + 1] == ('op', '('):
+                self.pos += 2
+                return self.parse_call(word)
+        if kind in ('name', 'quoted'):
+            return self.parse_column()
+        raise UsageError("Unexpected %s in query" % (
+            value is None and 'end' or repr(value)))
+
+    def parse_call(self, name):
+        if name == 'cast':
+            inner = self.parse_or()
+            if not self.keyword('as'):
+                raise UsageError("Expected AS in CAST")
+            type_name = self.take('name').lower()
+            if type_name not in SQL_CASTS:
+                raise UsageError("Unsupported type in CAST: %s" % type_name)
+            self.expect(')')
+            convert = SQL_CASTS[type_name]
+
+            def cast(r):
+                value = inner(r)
+                if value is None:
+                    return None
+                try:
+                    return convert(value)
+                except ValueError:
+                    if convert is int:
+                        return int(float(value))
+                    raise
+            return cast
+        if name in SQL_AGGREGATES:
+            if not self.allow_aggregates:
+                raise UsageError("%s isn't allowed here" % name.upper())
+            self.allow_aggregates = False
+            arg = None
+            if not (name == 'count' and self.op('*')):
+                arg = self.parse_or()
+            self.expect(')')
+            self.allow_aggregates = True
+            index = len(self.aggregates)
+            self.aggregates.append((name, arg))
+            return lambda r: self.results[index]
+        args = []
+        if not self.op(')'):
+            args.append(self.parse_or())
+            while self.op(','):
+                args.append(self.parse_or())
+            self.expect(')')
+        if name == 'coalesce':
+            return lambda r: next(
+                (v for v in (a(r) for a in args) if v is not None), None)
+        if name == 'nullif':
+            return lambda r: None if args[0](r) == args[1](r) else args[0](r)
+        if name not in SQL_FUNCTIONS:
+            raise UsageError("Unsupported function: %s" % name.upper())
+        func = SQL_FUNCTIONS[name]
+
+        def call(r):
+            values = [a(r) for a in args]
+            if values and values[0] is None:
+                return None
+            return func(*values)
+        return call
+
+    def parse_column(self):
+        path = [self.take(self.peek()[0])]
+        while self.op('.'):
+            path.append(self.take(self.peek()[0] == 'quoted' and 'quoted' or
+                                  'name'))
+        if len(path) > 1 and path[0].lower() in (self.alias, 's3object'):
+            path = path[1:]
+        if len(path) == 1:
+            name = path[0]
+            return lambda r: sql_lookup(r, name)
+
+        def column(r):
+            for name in path:
+                r = sql_lookup(r, name)
+            return r
+        return column
+
+    def run(self, records):
+        """Yield the result rows for a stream of records
+
+        Each row is a list of (name, value) pairs.
+        """
+        states = [None] * len(self.aggregates)
+        count = 0
+        for record in records:
+            if self.where is not None and not self.where(record):
+                continue
+            if self.aggregates:
+                for i, (name, arg) in enumerate(self.aggregates):
+                    states[i] = self.accumulate(
+                        name, states[i], arg and arg(record), arg is None)
+                continue
+            if self.columns is None:
+                if isinstance(record, dict):
+                    yield list(record.items())
+                else:
+                    yield [('_1', record)]
+            else:
+                yield [(name, f(record)) for name, f in self.columns]
+            count += 1
+            if self.limit is not None and count >= self.limit:
+                return
+        if self.aggregates:
+            self.results = []
+            for (name, _), state in zip(self.aggregates, states):
+                if name == 'count':
+                    state = state or 0
+                elif name == 'avg' and state is not None:
+                    state = state[0] / state[1]
+                self.results.append(state)
+            yield [(name, f(None)) for name, f in self.columns]
+
+    def accumulate(self, name, state, value, star):
+        if name == 'count':
+            return (state or 0) + (star or value is not None)
+        if value is None:
+            return state
+        value = sql_number(value)
+        if name == 'sum':
+            return value if state is None else state + value
+        if name == 'avg':
+            total, n = state or (0, 0)
+            return (total + value, n + 1)
+        if state is None:
+            return value
+        a, b = sql_coerce(value, state)
+        if name == 'min':
+            return value if a < b else state
+        return value if a > b else state
+
+
+def iter_records(chunks, fmt, header=True, delimiter=',', json_type='lines'):
+    """Parse a stream of (possibly compressed) chunks into records
+
+    CSV rows become dicts keyed by the header, or by _1, _2... if there isn't
+    one. JSON records are returned as they are.
+
+    >>> data = iter([b'name,age\\nbob,3\\n', b'amy,40\\n'])
+    >>> list(iter_records(data, 'csv'))
+    [{'name': 'bob', 'age': '3'}, {'name': 'amy', 'age': '40'}]
+    >>> list(iter_records(iter([b'{"a": 1}\\n{"a": 2}']), 'json'))
+    [{'a': 1}, {'a': 2}]
+    """
+    chunks = decompress_chunks(chunks)
+    if fmt == 'parquet':
+        for record in iter_parquet(chunks):
+            yield record
+        return
+    if fmt == 'json' and json_type == 'document':
+        data = json.loads(b''.join(chunks))
+        for record in isinstance(data, list) and data or [data]:
+            yield record
+        return
+    lines = iter_lines(chunks)
+    if fmt == 'json':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+        return
+    reader = csv.reader((l.rstrip(b'\r').decode(errors='replace')
+                         for l in lines), delimiter=delimiter)
+    names = header and next(reader, None) or []
+    for row in reader:
+        record = collections.OrderedDict(zip(names, row))
+        for i in range(len(names), len(row)):
+            record['_%d' % (i + 1)] = row[i]
+        yield dict(record)
+
+
+def iter_parquet(chunks):
+    """Read the rows of a parquet file, which needs pyarrow"""
+    try:
+        # Only imported when needed, as it's slow to import and optional
+        import pyarrow.parquet
+    except ImportError:
+        raise BackendError("Reading parquet files locally needs pyarrow")
+    # Parquet needs random access, so the file has to be saved first
+    with tempfile.TemporaryFile() as fh:
+        for chunk in chunks:
+            fh.write(chunk)
+        fh.seek(0)
+        for batch in pyarrow.parquet.ParquetFile(fh).iter_batches():
+            for record in batch.to_pylist():
+                yield record
+
+
+def select_format(key):
+    """Guess the format and compression of a file from its name
+
+    >>> select_format('logs/2025-07-01.json.gz')
+    ('json', 'gzip')
+    >>> select_format('data.parquet'), select_format('README')
+    (('parquet', 'none'), ('csv', 'none'))
+    """
+    name = key.lower()
+    compression = 'none'
+    for suffix, c in (('.gz', 'gzip'), ('.bz2', 'bzip2')):
+        if name.endswith(suffix):
+            name, compression = name[:-len(suffix)], c
+    ext = os.path.splitext(name)[1]
+    if ext in ('.json', '.jsonl', '.ndjson'):
+        return 'json', compression
+    if ext == '.parquet':
+        return 'parquet', compression
+    return 'csv', compression
+
+
+def format_row(row, fmt, delimiter=','):
+    """Format a row of (name, value) pairs as a line of output
+
+    >>> format_row([('a', 1), ('b', None), ('c', 'x,y')], 'csv')
+    b'1,,"x,y"\\n'
+    >>> format_row([('a', 1), ('b', None)], 'json')
+    b'{"a": 1, "b": null}\\n'
+    """
+    if fmt == 'json':
+        return (json.dumps(collections.OrderedDict(row), default=str) +
+                '\n').encode()
+    out = io.StringIO()
+    csv.writer(out, delimiter=delimiter, lineterminator='\n').writerow([
+        '' if v is None else isinstance(v, (dict, list)) and json.dumps(v)
+        or v for _, v in row])
+    return out.getvalue().encode()
+
+
+class ListingCache(object):
+    """Size bounded LRU cache of directory listings
+
+    Entries are keyed on (bucket, prefix) and expire after a TTL, which can be
+    overridden for individual prefixes (the longest matching prefix wins).
+    Mutations should call invalidate() with the keys they touched so that only
+    the affected listings are dropped. The cache is shared with the background
+    prefetcher, so all access goes through a lock.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.lock = threading.RLock()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix_ttls = {}
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def ttl_for(self, bucket, prefix):
+        path = "%s/%s" % (bucket, prefix)
+        best = None
+        for p in self.prefix_ttls:
+            if path.startswith(p) and (best is None or len(p) > len(best)):
+                best = p
+        return self.ttl if best is None else self.prefix_ttls[best]
+
+    def set_ttl(self, seconds, bucket=None, prefix=''):
+        if bucket is None:
+            self.ttl = seconds
+        else:
+            self.prefix_ttls["%s/%s" % (bucket, prefix)] = seconds
+
+    def get(self, bucket, prefix):
+        """Return the cached (prefixes, objects) for a prefix, or None"""
+        with self.lock:
+            entry = self.entries.get((bucket, prefix))
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, listing = entry
+            if expires < time.monotonic():
+                del self.entries[(bucket, prefix)]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end((bucket, prefix))
+            self.hits += 1
+            return listing
+
+    def lookup(self, bucket, prefix):
+        """Return (listing, fresh) for a prefix
+
+        Unlike get(), expired listings are returned (with fresh False) rather
+        than dropped, so that they can be used while a new listing is fetched.
+        """
+        with self.lock:
+            entry = self.entries.get((bucket, prefix))
+            if entry is None:
+                self.misses += 1
+                return None, False
+            expires, listing = entry
+            self.entries.move_to_end((bucket, prefix))
+            if expires < time.monotonic():
+                self.expired += 1
+                self.misses += 1
+                return listing, False
+            self.hits += 1
+            return listing, True
+
+    def is_fresh(self, bucket, prefix):
+        """Check for an unexpired listing without touching the stats"""
+        with self.lock:
+            entry = self.entries.get((bucket, prefix))
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def peek(self, bucket, prefix):
+        """Like get(), but without touching the stats or the LRU order
+
+        >>> cache = ListingCache()
+        >>> cache.put('b', 'logs/', (['logs/2025/'], []))
+        >>> cache.peek('b', 'logs/'), cache.peek('b', 'other/')
+        ((['logs/2025/'], []), None)
+        >>> cache.hits, cache.misses
+        (0, 0)
+        """
+        with self.lock:
+            entry = self.entries.get((bucket, prefix))
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def put(self, bucket, prefix, listing):
+        with self.lock:
+            expires = time.monotonic() + self.ttl_for(bucket, prefix)
+            self.entries[(bucket, prefix)] = (expires, listing)
+            self.entries.move_to_end((bucket, prefix))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def drop(self, bucket, prefix):
+        with self.lock:
+            if self.entries.pop((bucket, prefix), None) is not None:
+                self.invalidations += 1
+
+    def invalidate(self, bucket, key):
+        """Drop the listings that a change to key could affect
+
+        This is every listing the key shows up in (its parent directories),
+        and if the key is itself a directory prefix, everything below it.
+        """
+        with self.lock:
+            for prefix in parent_prefixes(key):
+                self.drop(bucket, prefix)
+            if key.endswith('/'):
+                for b, prefix in list(self.entries):
+                    if b == bucket and prefix.startswith(key):
+                        self.drop(b, prefix)
+
+    def invalidate_bucket(self, bucket):
+        with self.lock:
+            for b, prefix in list(self.entries):
+                if b == bucket:
+                    self.drop(b, prefix)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return collections.OrderedDict([
+            ('entries', len(self.entries)),
+            ('max_entries', self.max_entries),
+            ('ttl', self.ttl),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('hit_rate', lookups and float(self.hits) / lookups or 0.0),
+            ('expired', self.expired),
+            ('evictions', self.evictions),
+            ('invalidations', self.invalidations),
+        ])
+
+
+def split_commands(text):
+    r"""Split a script into commands on newlines and unquoted semicolons
+
+    Blank lines and lines starting with # are skipped.
+
+    >>> split_commands('cd logs/; ls\n# comment\nget "a;b"')
+    ['cd logs/', 'ls', 'get "a;b"']
+    """
+    commands = []
+    current = ''
+    quote = None
+    for c in text + '\n':
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in ';\n':
+            current = current.strip()
+            if current and not current.startswith('#'):
+                commands.append(current)
+            current = ''
+            continue
+        current += c
+    return commands
+
+
+def scan_local(root):
+    """Yield (relative path, size, mtime_ns) for every file below root
+
+    Uses os.scandir so that each file is only stat'ed once.
+    """
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            for entry in it:
+                name = rel + entry.name
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(name + '/')
+                elif entry.is_file(follow_symlinks=True):
+                    st = entry.stat()
+                    yield name, st.st_size, st.st_mtime_ns
+
+
+def local_etag(path, part_size=None):
+    """Work out the S3 ETag a local file would have
+
+    Without a part size this is just the MD5 of the file. Objects uploaded in
+    parts have the MD5 of the parts' MD5s instead, followed by the number of
+    parts.
+    """
+    whole = hashlib.md5()
+    parts = []
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(part_size or 1024 * 1024)
+            if not data:
+                break
+            if part_size:
+                parts.append(hashlib.md5(data).digest())
+            else:
+                whole.update(data)
+    if not part_size:
+        return whole.hexdigest()
+    return "%s-%d" % (hashlib.md5(b''.join(parts)).hexdigest(), len(parts))
+
+
+def etag_part_sizes(size, etag, preferred=None):
+    """Guess the part sizes that could have produced a multipart ETag
+
+    >>> etag_part_sizes(20 * 1024 ** 2, 'abc-3', 8 * 1024 ** 2)
+    [8388608, 7340032]
+    >>> etag_part_sizes(100, 'abc')
+    [None]
+    """
+    if '-' not in etag:
+        return [None]
+    count = int(etag.rsplit('-', 1)[1])
+    mb = 1024 * 1024
+    candidates = [preferred, 8 * mb, 16 * mb, 5 * mb, 64 * mb,
+                  -(-size // count // mb) * mb]
+    sizes = []
+    for c in candidates:
+        if c and c not in sizes and -(-size // c) == count:
+            sizes.append(c)
+    return sizes
+
+
+class Manifest(object):
+    """SQLite index of local file ETags
+
+    Entries are keyed on the file's path and part size, and are only used
+    while the file's size and mtime are unchanged, so repeat syncs with
+    --checksum don't need to re-hash files that haven't changed.
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT, part_size INTEGER, "
+            "size INTEGER, mtime_ns INTEGER, etag TEXT, "
+            "PRIMARY KEY (path, part_size))")
+
+    def etag(self, path, size, mtime_ns, part_size=None):
+        """Return the ETag for a local file, hashing it only if needed"""
+        path = os.path.abspath(path)
+        part = part_size or 0
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag FROM files WHERE path = ? AND part_size = ? AND "
+                "size = ? AND mtime_ns = ?",
+                (path, part, size, mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        etag = local_etag(path, part_size)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (path, part, size, mtime_ns, etag))
+        return etag
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+
+def cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 's3shell')
+
+
+def default_manifest():
+    return os.path.join(cache_dir(), 'manifest.sqlite')
+
+
+class ObjectCache(object):
+    """On disk cache of object contents, with LRU eviction
+
+    Each object is stored in a file named after a hash of its bucket and key,
+    next to a .meta file recording its ETag, size and modification time.
+    Entries are only served after revalidating the ETag with S3, and the least
+    recently used entries are removed once the cache grows beyond max_size.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.total = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    def path(self, bucket, key):
+        name = hashlib.sha256(("%s/%s" % (bucket, key)).encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def lookup(self, bucket, key):
+        """Return the cached S3Object for a key, or None"""
+        try:
+            with open(self.path(bucket, key) + '.meta') as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if meta.get('bucket') != bucket or meta.get('key') != key:
+            return None
+        return S3Object(key, meta['size'], parse_timestamp(meta['mtime']),
+                        meta['etag'], meta.get('storage_class', 'STANDARD'))
+
+    def read(self, bucket, key):
+        """Yield the chunks of a cached object, marking it as recently used"""
+        path = self.path(bucket, key)
+        now = time.time()
+        os.utime(path, (now, now))
+        with self.lock:
+            self.hits += 1
+        with open(path, 'rb') as fh:
+            while True:
+                chunk = fh.read(STREAM_CHUNK)
+                if not chunk:
+                    break
+                with self.lock:
+                    self.bytes_served += len(chunk)
+                yield chunk
+
+    def tee(self, bucket, o, chunks):
+        """Pass chunks through while saving them to the cache
+
+        The entry is only added once the whole object has been read, so
+        partial reads (e.g. quitting less early) aren't cached.
+        """
+        with self.lock:
+            self.misses += 1
+        if o.size > self.max_size // 4:
+            # Don't let one big object push everything else out
+            for chunk in chunks:
+                yield chunk
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(bucket, o.key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    yield chunk
+            with open(tmp + '.meta', 'w') as fh:
+                json.dump({'bucket': bucket, 'key': o.key, 'size': o.size,
+                           'etag': o.etag, 'mtime': o.mtime.isoformat(),
+                           'storage_class': o.storage_class}, fh)
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            os.replace(tmp + '.meta', path + '.meta')
+        finally:
+            for f in (tmp, tmp + '.meta'):
+                if os.path.exists(f):
+                    os.remove(f)
+        self.added(o.size - old)
+
+    def entries(self):
+        """Return (mtime, size, path) for every cached object"""
+        results = []
+        if not os.path.isdir(self.directory):
+            return results
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if '.' not in entry.name and entry.is_file():
+                    st = entry.stat()
+                    results.append((st.st_mtime, st.st_size, entry.path))
+        return results
+
+    def added(self, size):
+        with self.lock:
+            if self.total is None:
+                self.total = sum(e[1] for e in self.entries())
+            else:
+                self.total += size
+            if self.total <= self.max_size:
+                return
+            for mtime, size, path in sorted(self.entries()):
+                if self.total <= self.max_size:
+                    break
+                for f in (path, path + '.meta'):
+                    try:
+                        os.remove(f)
+                    except OSError:
+                        pass
+                self.total -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for _, _, path in self.entries():
+                for f in (path, path + '.meta'):
+                    try:
+                        os.remove(f)
+                    except OSError:
+                        pass
+            self.total = 0
+
+    def stats(self):
+        entries = self.entries()
+        return collections.OrderedDict([
+            ('objects', len(entries)),
+            ('object_bytes', sum(e[1] for e in entries)),
+            ('object_max_bytes', self.max_size),
+            ('object_hits', self.hits),
+            ('object_misses', self.misses),
+            ('object_evictions', self.evictions),
+            ('object_served', self.bytes_served),
+        ])
+
+
+def read_chunks(body):
+    """Yield chunks from a file-like object, closing it afterwards"""
+    try:
+        while True:
+            chunk = body.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
+
+
+class Prefetcher(object):
+    """Loads directory listings on background threads
+
+    load(bucket, prefix, children, cancelled) is called for each request.
+    Requests are queued on a bounded priority queue; when the queue is full
+    new requests are dropped. Starting a new set of requests with replace=True
+    cancels everything that is still queued, and tells in-flight loads to stop
+    via their cancelled() callback. A prefix that is still being loaded for
+    an earlier generation is queued again, as that load is being cancelled.
+
+    >>> started, gate, loads = threading.Event(), threading.Event(), []
+    >>> def load(bucket, prefix, children, cancelled):
+    ...     loads.append(prefix)
+    ...     started.set()
+    ...     if len(loads) == 1:
+    ...         gate.wait(5)
+    ...     return not cancelled()
+    >>> p = Prefetcher(load, workers=1)
+    >>> p.request([('b', 'd/', None)])
+    >>> started.wait(5)
+    True
+    >>> p.request([('b', 'd/', None)], replace=True)
+    >>> gate.set()
+    >>> p.wait('b', 'd/', 5)
+    >>> stats = p.stats()
+    >>> loads, stats['prefetch_loaded'], stats['prefetch_cancelled']
+    (['d/', 'd/'], 1, 1)
+    """
+
+    def __init__(self, load, workers=2, max_queue=64):
+        self.load = load
+        self.queue = queue.PriorityQueue(max_queue)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.sequence = 0
+        # (bucket, prefix) -> (generation, event set when it's loaded)
+        self.inflight = {}
+        self.requested = 0
+        self.loaded = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.errors = 0
+        for _ in range(workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, items, replace=False, priority=1):
+        """Queue (bucket, prefix, children) items to be loaded"""
+        with self.lock:
+            if replace:
+                self.generation += 1
+                self.cancel_queued()
+            for item in items:
+                current = self.inflight.get(item[:2])
+                if current is not None and current[0] == self.generation:
+                    continue
+                self.sequence += 1
+                event = threading.Event()
+                try:
+                    self.queue.put_nowait((priority, self.sequence,
+                                           self.generation, item, event))
+                except queue.Full:
+                    self.dropped += 1
+                    continue
+                self.inflight[item[:2]] = (self.generation, event)
+                self.requested += 1
+
+    def cancel_queued(self):
+        while True:
+            try:
+                _, _, _, item, event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.cancelled += 1
+            self.finished(item[:2], event)
+
+    def finished(self, key, event):
+        """Mark a load as done; called with the lock held"""
+        current = self.inflight.get(key)
+        if current is not None and current[1] is event:
+            del self.inflight[key]
+        event.set()
+
+    def wait(self, bucket, prefix, timeout):
+        """Wait for a queued or in-flight load of a prefix to finish"""
+        with self.lock:
+            current = self.inflight.get((bucket, prefix))
+        if current is not None:
+            current[1].wait(timeout)
+
+    def run(self):
+        while True:
+            _, _, generation, item, event = self.queue.get()
+
+            def cancelled(generation=generation):
+                return generation != self.generation
+
+            outcome = 'cancelled'
+            try:
+                if not cancelled():
+                    if self.load(item[0], item[1], item[2], cancelled):
+                        outcome = 'loaded'
+                    elif not cancelled():
+                        outcome = None
+            except BackendError:
+                outcome = 'errors'
+            finally:
+                with self.lock:
+                    if outcome:
+                        setattr(self, outcome, getattr(self, outcome) + 1)
+                    self.finished(item[:2], event)
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('prefetch_requested', self.requested),
+            ('prefetch_loaded', self.loaded),
+            ('prefetch_cancelled', self.cancelled),
+            ('prefetch_dropped', self.dropped),
+            ('prefetch_errors', self.errors),
+        ])
+
+
+# Backend methods that are timed, and the operation they are counted as
+TIMED_OPERATIONS = {
+    'list_pages': 'list',
+    'head': 'head',
+    'get': 'get',
+    'stream': 'get',
+    'download': 'get',
+    'put': 'put',
+    'upload': 'put',
+    'copy': 'copy',
+    'delete': 'delete',
+    'delete_many': 'delete',
+    'select': 'select',
+    'make_bucket': 'bucket',
+    'remove_bucket': 'bucket',
+}
+
+# S3 API calls, for counting the requests boto3 makes behind our backs (e.g.
+# the parts of multipart transfers)
+API_OPERATIONS = {
+    'ListObjectsV2': 'list',
+    'HeadObject': 'head',
+    'GetObject': 'get',
+    'PutObject': 'put',
+    'CreateMultipartUpload': 'put',
+    'UploadPart': 'put',
+    'CompleteMultipartUpload': 'put',
+    'AbortMultipartUpload': 'put',
+    'CopyObject': 'copy',
+    'UploadPartCopy': 'copy',
+    'DeleteObject': 'delete',
+    'DeleteObjects': 'delete',
+    'SelectObjectContent': 'select',
+    'CreateBucket': 'bucket',
+    'DeleteBucket': 'bucket',
+}
+
+
+def percentile(values, p):
+    """Return the p'th percentile of a sorted list, by nearest rank
+
+    >>> percentile([1, 2, 3, 4], 50), percentile([1, 2, 3, 4], 99)
+    (2, 4)
+    >>> percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))
+    return values[int(rank)]
+
+
+class TimedBody(object):
+    """Wraps a streaming body, counting bytes and the time spent reading
+
+    The operation is recorded when the body is closed. Only time spent in
+    read() counts, so a slow consumer (e.g. someone paging through less)
+    doesn't look like a slow endpoint.
+    """
+
+    def __init__(self, metrics, op, body, seconds, details):
+        self.metrics = metrics
+        self.op = op
+        self.body = body
+        self.seconds = seconds
+        self.details = details
+        self.bytes = 0
+        self.error = None
+        self.closed = False
+
+    def read(self, size=-1):
+        start = time.time()
+        try:
+            data = self.body.read(size)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.seconds += time.time() - start
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        try:
+            self.body.close()
+        finally:
+            if not self.closed:
+                self.closed = True
+                self.metrics.record(self.op, self.seconds, self.bytes,
+                                    self.error, **self.details)
+
+
+class Metrics(object):
+    """Registry of timings and counters for backend operations and commands
+
+    Each operation records its latency, the bytes it moved, and the requests
+    and retries it took. Latencies are kept as a bounded random sample, so
+    percentiles can be reported for long sessions without the memory use
+    growing. With a trace file set, every operation is also written to it as
+    a line of JSON, tagged with the command that caused it.
+
+    >>> m = Metrics()
+    >>> for i in range(1, 101):
+    ...     m.record('get', i / 1000.0, 1000)
+    >>> s = m.summary()['operations']['get']
+    >>> s['count'], s['p50_ms'], s['p99_ms'], s['bytes']
+    (100, 50.0, 99.0, 100000)
+    """
+    max_samples = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.trace = None
+        # The last command started, for operations run on worker threads
+        self.command = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.commands = {}
+            self.started = time.time()
+
+    def set_trace(self, filename):
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+            self.trace = filename and open(filename, 'a') or None
+
+    def add(self, table, name, seconds, nbytes=0, error=None, requests=0,
+            retries=0):
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                   'bytes': 0, 'requests': 0, 'retries': 0,
+                                   'samples': []}
+        if seconds is not None:
+            entry['count'] += 1
+            entry['errors'] += error is not None
+            entry['seconds'] += seconds
+            entry['bytes'] += nbytes
+            samples = entry['samples']
+            if len(samples) < self.max_samples:
+                samples.append(seconds)
+            else:
+                i = random.randrange(entry['count'])
+                if i < self.max_samples:
+                    samples[i] = seconds
+        entry['requests'] += requests
+        entry['retries'] += retries
+
+    def write_trace(self, record):
+        record['command'] = getattr(self.local, 'command', None) or \
+            self.command
+        self.trace.write(json.dumps(record, default=str) + '\n')
+        self.trace.flush()
+
+    def record(self, op, seconds, nbytes=0, error=None, requests=0,
+               **details):
+        """Record one backend operation"""
+        with self.lock:
+            self.add(self.operations, op, seconds, nbytes, error, requests)
+            if self.trace is not None:
+                record = {'time': time.time() - seconds, 'op': op,
+                          'seconds': round(seconds, 6), 'bytes': nbytes,
+                          'error': error and str(error) or None}
+                record.update(details)
+                self.write_trace(record)
+
+    def request(self, op, retries=0):
+        """Record a request made by the backend, e.g. a part of an upload"""
+        op = getattr(self.local, 'op', None) or op
+        with self.lock:
+            self.add(self.operations, op, None, requests=1 + retries,
+                     retries=retries)
+
+    def start_command(self, line):
+        self.command = self.local.command = line
+        return time.time()
+
+    def finish_command(self, name, start, failed=False):
+        seconds = time.time() - start
+        with self.lock:
+            self.add(self.commands, name, seconds, error=failed or None)
+            if self.trace is not None:
+                self.write_trace({'time': start, 'op': 'command',
+                                  'seconds': round(seconds, 6),
+                                  'failed': failed})
+        self.local.command = None
+
+    def instrument(self, backend):
+        """Time the operations of a backend by wrapping its methods"""
+        if backend.metrics is self:
+            return
+        backend.metrics = self
+        for method, op in TIMED_OPERATIONS.items():
+            setattr(backend, method, self.timed(
+                op, getattr(backend, method), not backend.counts_requests))
+
+    def timed(self, op, func, count_requests):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(self.local, 'op', None) is not None:
+                # Part of an operation that is already being timed
+                return func(*args, **kwargs)
+            details = {'args': [a for a in args if isinstance(a, str)]}
+            requests = count_requests and 1 or 0
+            nbytes = 0
+            if func.__name__ in ('upload', 'put'):
+                nbytes = os.path.getsize(args[0])
+            elif func.__name__ == 'copy':
+                nbytes = kwargs.get('size') or (args[4:] or [0])[0] or 0
+            elif func.__name__ == 'delete_many':
+                requests = count_requests and -(-len(args[1]) // 1000) or 0
+            self.local.op = op
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except NotModified:
+                # A successful conditional get, the cached copy is current
+                self.record(op, time.time() - start, 0, None, requests,
+                            **details)
+                raise
+            except Exception as e:
+                self.record(op, time.time() - start, 0, e, requests,
+                            **details)
+                raise
+            finally:
+                self.local.op = None
+            seconds = time.time() - start
+            if inspect.isgenerator(result):
+                return self.timed_generator(op, result, count_requests,
+                                            details)
+            if func.__name__ == 'stream':
+                return TimedBody(self, op, result, seconds, details)
+            if func.__name__ == 'get':
+                return result[0], TimedBody(self, op, result[1], seconds,
+                                            details)
+            if func.__name__ == 'download':
+                nbytes = os.path.getsize(args[2])
+            self.record(op, seconds, nbytes, None, requests, **details)
+            return result
+        return wrapper
+
+    def timed_generator(self, op, generator, count_requests, details):
+        """Time a generator, recording each page of a listing separately"""
+        seconds = 0.0
+        nbytes = 0
+        error = None
+        try:
+            while True:
+                self.local.op = op
+                start = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    error = e
+                    raise
+                finally:
+                    self.local.op = None
+                    seconds += time.time() - start
+                if op == 'list':
+                    self.record(op, seconds, 0, None,
+                                count_requests and 1 or 0, **details)
+                    seconds = 0.0
+                elif isinstance(item, bytes):
+                    nbytes += len(item)
+                yield item
+        finally:
+            generator.close()
+            if op != 'list' or error is not None:
+                self.record(op, seconds, nbytes, error,
+                            count_requests and 1 or 0, **details)
+
+    def summary(self):
+        """Return the metrics as a dict, for display or dumping as JSON"""
+        def summarize(table):
+            result = collections.OrderedDict()
+            for name in sorted(table):
+                entry = table[name]
+                samples = sorted(entry['samples'])
+                stats = collections.OrderedDict(
+                    (k, entry[k]) for k in ('count', 'errors', 'requests',
+                                            'retries', 'bytes'))
+                for p in (50, 95, 99):
+                    value = percentile(samples, p)
+                    stats['p%d_ms' % p] = value is not None and round(
+                        value * 1000, 3) or None
+                stats['seconds'] = round(entry['seconds'], 6)
+                stats['bytes_per_second'] = entry['seconds'] and round(
+                    entry['bytes'] / entry['seconds']) or 0
+                result[name] = stats
+            return result
+        with self.lock:
+            return collections.OrderedDict([
+                ('uptime', round(time.time() - self.started, 3)),
+                ('operations', summarize(self.operations)),
+                ('commands', summarize(self.commands)),
+            ])
+
+
+class Backend(object):
+    """Interface for the S3 operations used by the shell
+
+    Listings are returned as (prefixes, objects), where prefixes is a list of
+    common prefixes ("directories") and objects is a list of S3Objects.
+    list_pages() yields these one page at a time so that huge prefixes can be
+    streamed, list() collects every page.
+    """
+    name = None
+    # Whether the backend reports its own requests to the metrics, rather
+    # than each call counting as one request
+    counts_requests = False
+
+    def __init__(self, profile='', endpoint_url=None, debug=False):
+        self.profile = profile
+        self.endpoint_url = endpoint_url
+        self.debug = debug
+        self.metrics = None
+        # Settings for individual (multipart) transfers
+        self.chunk_size = 8 * 1024 * 1024
+        self.part_concurrency = 4
+        # Server side copies of objects bigger than this are done in parallel
+        # parts. CopyObject itself only works up to 5GB.
+        self.copy_threshold = 256 * 1024 * 1024
+        self.copy_part_size = 128 * 1024 * 1024
+
+    def list_pages(self, bucket, prefix, delimiter='/', start_after=None,
+                   page_size=1000):
+        raise NotImplementedError
+
+    def list(self, bucket, prefix, delimiter='/'):
+        prefixes = []
+        objects = []
+        for page_prefixes, page_objects in self.list_pages(
+                bucket, prefix, delimiter):
+            prefixes.extend(page_prefixes)
+            objects.extend(page_objects)
+        return prefixes, objects
+
+    def head(self, bucket, key):
+        """Return the S3Object for a single key"""
+        raise NotImplementedError
+
+    def download(self, bucket, key, filename, callback=None):
+        """Download a key to a local file
+
+        callback, if given, is called with the number of bytes transferred as
+        the download progresses.
+        """
+        raise NotImplementedError
+
+    def upload(self, filename, bucket, key, callback=None):
+        raise NotImplementedError
+
+    def stream(self, bucket, key, byte_range=None):
+        """Open a key for streaming
+
+        Returns a file-like object with read() and close(). byte_range is an
+        HTTP Range header value such as 'bytes=0-99' or 'bytes=-4096'.
+        """
+        raise NotImplementedError
+
+    def get(self, bucket, key, if_none_match=None):
+        """Open a whole object, returning (S3Object, body)
+
+        If if_none_match is given and is still the object's ETag, this raises
+        NotModified instead.
+        """
+        o = self.head(bucket, key)
+        if if_none_match is not None and o.etag == if_none_match:
+            raise NotModified()
+        return o, self.stream(bucket, key)
+
+    def put(self, filename, bucket, key, if_match=None):
+        """Upload a small file in a single request
+
+        With if_match, the upload only happens if the object's ETag is still
+        if_match, otherwise PreconditionFailed is raised.
+        """
+        raise NotImplementedError
+
+    def select(self, bucket, key, expression, input_serialization,
+               output_serialization):
+        """Run an S3 Select query on an object, yielding chunks of results
+
+        The serializations are as for the SelectObjectContent API. Raises
+        SelectUnsupported if S3 Select can't be used.
+        """
+        raise SelectUnsupported("S3 Select isn't supported by this backend")
+
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key, size=None):
+        """Copy an object without it leaving S3
+
+        size, if known, saves looking it up. Returns the ETag of the new
+        object if the backend knows it.
+        """
+        raise NotImplementedError
+
+    def delete(self, bucket, key):
+        raise NotImplementedError
+
+    def delete_many(self, bucket, keys):
+        """Delete up to 1000 keys at once
+
+        Returns a list of (key, error message) for keys that couldn't be
+        deleted.
+        """
+        failures = []
+        for key in keys:
+            try:
+                self.delete(bucket, key)
+            except BackendError as e:
+                failures.append((key, str(e)))
+        return failures
+
+    def make_bucket(self, bucket):
+        raise NotImplementedError
+
+    def remove_bucket(self, bucket):
+        raise NotImplementedError
+
+
+def boto_errors(f):
+    """Turn boto exceptions into BackendErrors"""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as e:
+            raise BackendError(str(e))
+    return wrapper
+
+
+class Boto3Backend(Backend):
+    """In-process backend using a long lived boto3 client"""
+    name = 'boto3'
+    counts_requests = True
+
+    def __init__(self, profile='', endpoint_url=None, debug=False):
+        Backend.__init__(self, profile, endpoint_url, debug)
+        if boto3 is None:
+            raise BackendError("boto3 is not installed")
+        session = boto3.session.Session(profile_name=profile or None)
+        config = botocore.config.Config(
+            max_pool_connections=32,
+            retries={'max_attempts': 5, 'mode': 'standard'})
+        self.client = session.client('s3', endpoint_url=endpoint_url,
+                                     config=config)
+        self.client.meta.events.register('after-call.s3', self.after_call)
+        # Failed selects are run locally, so don't spend long retrying them
+        self.select_client = session.client(
+            's3', endpoint_url=endpoint_url, config=config.merge(
+                botocore.config.Config(
+                    retries={'max_attempts': 2, 'mode': 'standard'})))
+        self.select_client.meta.events.register('after-call.s3',
+                                                self.after_call)
+
+    def after_call(self, http_response, parsed, model, **kwargs):
+        """Count every request made, including retries and multipart parts"""
+        if self.metrics is not None:
+            self.metrics.request(
+                API_OPERATIONS.get(model.name, model.name),
+                parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+    def log(self, op, **params):
+        if self.debug:
+            print("%s %s" % (op, ' '.join(
+                "%s=%s" % (k, v) for k, v in sorted(params.items()))))
+
+    def list_pages(self, bucket, prefix, delimiter='/', start_after=None,
+                   page_size=1000):
+        self.log('list_objects_v2', bucket=bucket, prefix=prefix,
+                 start_after=start_after)
+        params = {'Bucket': bucket, 'Prefix': prefix,
+                  'PaginationConfig': {'PageSize': page_size}}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        if start_after:
+            params['StartAfter'] = start_after
+        paginator = self.client.get_paginator('list_objects_v2')
+        # Errors happen while iterating, so boto_errors can't be used here
+        try:
+            for page in paginator.paginate(**params):
+                yield ([p['Prefix'] for p in page.get('CommonPrefixes', [])],
+                       [s3object(o) for o in page.get('Contents', [])])
+        except (botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError) as e:
+            raise BackendError(str(e))
+
+    def transfer_config(self):
+        return boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.chunk_size,
+            multipart_chunksize=self.chunk_size,
+            max_concurrency=self.part_concurrency)
+
+    @boto_errors
+    def head(self, bucket, key):
+        self.log('head_object', bucket=bucket, key=key)
+        rv = self.client.head_object(Bucket=bucket, Key=key)
+        return S3Object(key, rv['ContentLength'], rv['LastModified'],
+                        rv.get('ETag', '').strip('"'),
+                        rv.get('StorageClass', 'STANDARD'))
+
+    @boto_errors
+    def download(self, bucket, key, filename, callback=None):
+        self.log('download_file', bucket=bucket, key=key, filename=filename)
+        self.client.download_file(bucket, key, filename, Callback=callback,
+                                  Config=self.transfer_config())
+
+    @boto_errors
+    def upload(self, filename, bucket, key, callback=None):
+        self.log('upload_file', filename=filename, bucket=bucket, key=key)
+        self.client.upload_file(filename, bucket, key, Callback=callback,
+                                Config=self.transfer_config())
+
+    @boto_errors
+    def stream(self, bucket, key, byte_range=None):
+        self.log('get_object', bucket=bucket, key=key, range=byte_range)
+        params = {'Bucket': bucket, 'Key': key}
+        if byte_range:
+            params['Range'] = byte_range
+        return self.client.get_object(**params)['Body']
+
+    @boto_errors
+    def get(self, bucket, key, if_none_match=None):
+        self.log('get_object', bucket=bucket, key=key,
+                 if_none_match=if_none_match)
+        params = {'Bucket': bucket, 'Key': key}
+        if if_none_match is not None:
+            params['IfNoneMatch'] = '"%s"' % if_none_match
+        try:
+            rv = self.client.get_object(**params)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                raise NotModified()
+            raise
+        return S3Object(key, rv['ContentLength'], rv['LastModified'],
+                        rv.get('ETag', '').strip('"'),
+                        rv.get('StorageClass', 'STANDARD')), rv['Body']
+
+    @boto_errors
+    def put(self, filename, bucket, key, if_match=None):
+        self.log('put_object', filename=filename, bucket=bucket, key=key,
+                 if_match=if_match)
+        params = {'Bucket': bucket, 'Key': key}
+        if if_match is not None:
+            params['IfMatch'] = '"%s"' % if_match
+        try:
+            with open(filename, 'rb') as fh:
+                rv = self.client.put_object(Body=fh, **params)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('412', 'PreconditionFailed',
+                                               'ConditionalRequestConflict'):
+                raise PreconditionFailed(str(e))
+            raise
+        return rv['ETag'].strip('"')
+
+    def select(self, bucket, key, expression, input_serialization,
+               output_serialization):
+        self.log('select_object_content', bucket=bucket, key=key,
+                 expression=expression)
+        # This is a generator, so can't use boto_errors
+        try:
+            rv = self.select_client.select_object_content(
+                Bucket=bucket, Key=key, Expression=expression,
+                ExpressionType='SQL', InputSerialization=input_serialization,
+                OutputSerialization=output_serialization)
+            for event in rv['Payload']:
+                if 'Records' in event:
+                    yield event['Records']['Payload']
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            status = e.response.get('ResponseMetadata', {}).get(
+                'HTTPStatusCode', 0)
+            if code in SELECT_UNAVAILABLE:
+                raise SelectUnsupported(str(e))
+            if code in SELECT_FAILED or status >= 500:
+                raise SelectUnsupported(str(e), permanent=False)
+            raise BackendError(str(e))
+        except botocore.exceptions.BotoCoreError as e:
+            raise BackendError(str(e))
+
+    @boto_errors
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key, size=None):
+        source = {'Bucket': src_bucket, 'Key': src_key}
+        if size is None:
+            size = self.head(src_bucket, src_key).size
+        if size > self.copy_threshold:
+            return self.multipart_copy(source, size, dst_bucket, dst_key)
+        self.log('copy_object', src=s3url(src_bucket, src_key),
+                 dst=s3url(dst_bucket, dst_key))
+        rv = self.client.copy_object(CopySource=source, Bucket=dst_bucket,
+                                     Key=dst_key)
+        return rv['CopyObjectResult']['ETag'].strip('"')
+
+    def multipart_copy(self, source, size, dst_bucket, dst_key):
+        """Copy an object using parallel UploadPartCopy requests"""
+        self.log('multipart_copy', src=s3url(source['Bucket'], source['Key']),
+                 dst=s3url(dst_bucket, dst_key), size=size)
+        head = self.client.head_object(Bucket=source['Bucket'],
+                                       Key=source['Key'])
+        params = dict((k, head[k]) for k in (
+            'ContentType', 'ContentEncoding', 'ContentDisposition',
+            'ContentLanguage', 'CacheControl', 'Metadata') if k in head)
+        upload_id = self.client.create_multipart_upload(
+            Bucket=dst_bucket, Key=dst_key, **params)['UploadId']
+        # Uploads can have at most 10000 parts
+        part_size = max(self.copy_part_size, -(-size // 10000))
+
+        def copy_part(part):
+            number, start = part
+            end = min(start + part_size, size) - 1
+            rv = self.client.upload_part_copy(
+                Bucket=dst_bucket, Key=dst_key, UploadId=upload_id,
+                PartNumber=number, CopySource=source,
+                CopySourceRange="bytes=%d-%d" % (start, end))
+            return {'PartNumber': number,
+                    'ETag': rv['CopyPartResult']['ETag']}
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.part_concurrency) as pool:
+                parts = list(pool.map(copy_part, enumerate(
+                    range(0, size, part_size), 1)))
+            rv = self.client.complete_multipart_upload(
+                Bucket=dst_bucket, Key=dst_key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=dst_bucket, Key=dst_key, UploadId=upload_id)
+            raise
+        return rv['ETag'].strip('"')
+
+    @boto_errors
+    def delete(self, bucket, key):
+        self.log('delete_object', bucket=bucket, key=key)
+        self.client.delete_object(Bucket=bucket, Key=key)
+
+    @boto_errors
+    def delete_many(self, bucket, keys):
+        self.log('delete_objects', bucket=bucket, count=len(keys))
+        rv = self.client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        return [(e['Key'], "%s: %s" % (e.get('Code'), e.get('Message')))
+                for e in rv.get('Errors', [])]
+
+    @boto_errors
+    def make_bucket(self, bucket):
+        self.log('create_bucket', bucket=bucket)
+        params = {'Bucket': bucket}
+        region = self.client.meta.region_name
+        if region and region != 'us-east-1':
+            params['CreateBucketConfiguration'] = {
+                'LocationConstraint': region}
+        self.client.create_bucket(**params)
+
+    @boto_errors
+    def remove_bucket(self, bucket):
+        self.log('delete_bucket', bucket=bucket)
+        self.client.delete_bucket(Bucket=bucket)
+
+
+class CLIBackend(Backend):
+    """Fallback backend that runs the aws command line tools"""
+    name = 'cli'
+
+    def aws(self, *args):
+        proc = subprocess.run(self.aws_command(*args), stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise BackendError(proc.stderr.decode().strip())
+        return proc.stdout.decode()
+
+    def list_pages(self, bucket, prefix, delimiter='/', start_after=None,
+                   page_size=1000):
+        args = ['s3api', 'list-objects-v2', '--bucket', bucket,
+                '--prefix', prefix, '--max-items', str(page_size),
+                '--output', 'json']
+        if delimiter:
+            args.extend(['--delimiter', delimiter])
+        if start_after:
+            args.extend(['--start-after', start_after])
+        token = None
+        while True:
+            output = self.aws(*(args + (token and [
+                '--starting-token', token] or [])))
+            page = json.loads(output) if output.strip() else {}
+            yield ([p['Prefix'] for p in page.get('CommonPrefixes') or []],
+                   [s3object(o) for o in page.get('Contents') or []])
+            token = page.get('NextToken')
+            if not token:
+                break
+
+    def head(self, bucket, key):
+        rv = json.loads(self.aws('s3api', 'head-object', '--bucket', bucket,
+                                 '--key', key, '--output', 'json'))
+        return S3Object(key, rv['ContentLength'],
+                        parse_timestamp(rv['LastModified']),
+                        rv.get('ETag', '').strip('"'),
+                        rv.get('StorageClass', 'STANDARD'))
+
+    # The cli reads its chunk size from ~/.aws/config, and only reports
+    # progress once each file has finished.
+    def download(self, bucket, key, filename, callback=None):
+        self.aws('s3', 'cp', '--quiet', s3url(bucket, key), filename)
+        if callback:
+            callback(os.path.getsize(filename))
+
+    def upload(self, filename, bucket, key, callback=None):
+        self.aws('s3', 'cp', '--quiet', filename, s3url(bucket, key))
+        if callback:
+            callback(os.path.getsize(filename))
+
+    def aws_command(self, *args):
+        full_cmd = ['aws']
+        if self.profile:
+            full_cmd.extend(['--profile', self.profile])
+        if self.endpoint_url:
+            full_cmd.extend(['--endpoint-url', self.endpoint_url])
+        full_cmd.extend(args)
+        if self.debug:
+            print(' '.join(shlex.quote(a) for a in full_cmd))
+        return full_cmd
+
+    def stream(self, bucket, key, byte_range=None):
+        if not byte_range:
+            return ProcessStream(self.aws_command(
+                's3', 'cp', '--quiet', s3url(bucket, key), '-'))
+        # s3api get-object only writes to a file, so use a temporary one,
+        # which is removed as soon as it has been opened.
+        fd, local_file = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.aws('s3api', 'get-object', '--bucket', bucket, '--key', key,
+                     '--range', byte_range, local_file)
+            return open(local_file, 'rb')
+        finally:
+            os.remove(local_file)
+
+    def put(self, filename, bucket, key, if_match=None):
+        args = ['s3api', 'put-object', '--bucket', bucket, '--key', key,
+                '--body', filename, '--output', 'json']
+        if if_match is not None:
+            args.extend(['--if-match', '"%s"' % if_match])
+        try:
+            rv = json.loads(self.aws(*args))
+        except BackendError as e:
+            if 'PreconditionFailed' in str(e):
+                raise PreconditionFailed(str(e))
+            raise
+        return rv.get('ETag', '').strip('"')
+
+    def select(self, bucket, key, expression, input_serialization,
+               output_serialization):
+        body = ProcessStream(self.aws_command(
+            's3api', 'select-object-content', '--bucket', bucket,
+            '--key', key, '--expression', expression,
+            '--expression-type', 'SQL',
+            '--input-serialization', json.dumps(input_serialization),
+            '--output-serialization', json.dumps(output_serialization),
+            '/dev/stdout'))
+        try:
+            for chunk in read_chunks(body):
+                yield chunk
+        except BackendError as e:
+            if any(code in str(e) for code in SELECT_UNAVAILABLE):
+                raise SelectUnsupported(str(e))
+            if any(code in str(e) for code in SELECT_FAILED):
+                raise SelectUnsupported(str(e), permanent=False)
+            raise
+
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key, size=None):
+        # The cli does multipart copies itself
+        self.aws('s3', 'cp', '--quiet', s3url(src_bucket, src_key),
+                 s3url(dst_bucket, dst_key))
+
+    def delete(self, bucket, key):
+        self.aws('s3', 'rm', '--quiet', s3url(bucket, key))
+
+    def delete_many(self, bucket, keys):
+        output = self.aws('s3api', 'delete-objects', '--bucket', bucket,
+                          '--output', 'json', '--delete', json.dumps({
+                              'Objects': [{'Key': k} for k in keys],
+                              'Quiet': True}))
+        rv = json.loads(output) if output.strip() else {}
+        return [(e['Key'], "%s: %s" % (e.get('Code'), e.get('Message')))
+                for e in rv.get('Errors') or []]
+
+    def make_bucket(self, bucket):
+        self.aws('s3', 'mb', 's3://%s' % bucket)
+
+    def remove_bucket(self, bucket):
+        self.aws('s3', 'rb', 's3://%s' % bucket)
+
+
+class ProcessStream(object):
+    """File-like wrapper around the stdout of a process"""
+
+    def __init__(self, args):
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and size != 0 and self.proc.wait() != 0:
+            raise BackendError(self.proc.stderr.read().decode().strip())
+        return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc.wait()
+
+
+BACKENDS = {
+    'boto3': Boto3Backend,
+    'cli': CLIBackend,
+}
+
+
+def make_backend(name, profile='', endpoint_url=None, debug=False):
+    """Create a backend by name, defaulting to boto3 when it is available"""
+    if name is None:
+        name = boto3 is not None and 'boto3' or 'cli'
+    return BACKENDS[name](profile, endpoint_url, debug)
+
+
+def format_listing(prefixes, objects, base, long_format=False):
+    """Format a listing in the same style as 'aws s3 ls'
+
+    The long format uses human readable sizes and adds the storage class.
+    Names are shown relative to the directory of base, so listing a partial
+    name like 'logs/app' shows 'app.log' rather than '.log'.
+
+    >>> mtime = datetime.datetime(2025, 7, 15, tzinfo=datetime.timezone.utc)
+    >>> objects = [S3Object('logs/foo.txt', 5, mtime, '', 'STANDARD')]
+    >>> for l in format_listing(['logs/foo/'], objects, 'logs/foo'):
+    ...     print(l.split()[-2:])
+    ['PRE', 'foo/']
+    ['5', 'foo.txt']
+    >>> format_listing([], objects, 'logs/foo.txt')[0].split()[-1]
+    'foo.txt'
+    >>> format_listing([], objects, 'logs/')[0].split()[-1]
+    'foo.txt'
+    """
+    base = base[:base.rfind('/') + 1]
+    lines = []
+    for p in prefixes:
+        if long_format:
+            lines.append("%19s %7s %-12s %s" % ('', 'DIR', '', p[len(base):]))
+        else:
+            lines.append("%30s %s" % ("PRE", p[len(base):]))
+    for o in objects:
+        mtime = o.mtime.astimezone().strftime("%Y-%m-%d %H:%M:%S")
+        if long_format:
+            lines.append("%s %7s %-12s %s" % (
+                mtime, human_size(o.size), o.storage_class,
+                o.key[len(base):]))
+        else:
+            lines.append("%s %10d %s" % (mtime, o.size, o.key[len(base):]))
+    return lines
+
+
+class RateLimiter(object):
+    """Token bucket used to cap the bandwidth of all transfers in a session
+
+    A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.available = 0.0
+        self.last = time.monotonic()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.rate, self.available +
+                                 (now - self.last) * self.rate)
+            self.last = now
+            self.available -= amount
+            wait = -self.available / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    """Aggregate progress, throughput and ETA for a set of transfers"""
+
+    def __init__(self, total_files, total_bytes, enabled=True,
+                 stream=sys.stderr, interval=0.5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.enabled = enabled
+        self.stream = stream
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.last_update = 0
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return elapsed and self.bytes / elapsed or 0
+
+    def line(self):
+        rate = self.rate()
+        if not self.total_files:
+            # Totals aren't known up front, e.g. when scanning with du
+            return "%d files, %s, %s/s" % (
+                self.files, human_size(self.bytes), human_size(rate))
+        eta = '-:--:--'
+        if rate and self.total_bytes:
+            eta = format_duration(max(0, self.total_bytes - self.bytes) / rate)
+        return "%d/%d files, %s/%s, %s/s, ETA %s" % (
+            self.files, self.total_files, human_size(self.bytes),
+            human_size(self.total_bytes), human_size(rate), eta)
+
+    def update(self, amount=0, files=0):
+        with self.lock:
+            self.bytes += amount
+            self.files += files
+            now = time.monotonic()
+            if self.enabled and now - self.last_update > self.interval:
+                self.last_update = now
+                self.stream.write("\r\033[K%s" % self.line())
+                self.stream.flush()
+
+    def finish(self):
+        if self.enabled:
+            self.stream.write("\r\033[K")
+        elapsed = time.monotonic() - self.start
+        return "%d files, %s in %s (%s/s)" % (
+            self.files, human_size(self.bytes), format_duration(elapsed),
+            human_size(self.rate()))
+
+
+# Commands that are safe to run concurrently with each other in scripts, as
+# long as they touch different files. cp isn't, as a later copy can read
+# what an earlier one writes.
+PIPELINED_COMMANDS = set(['get', 'put', 'rm'])
+
+
+def paths_overlap(paths, others):
+    """Whether any of two lists of paths could refer to the same file
+
+    Paths stand for everything below them, so one that is a prefix of
+    another overlaps it.
+
+    >>> paths_overlap(['s3://b/logs/'], ['s3://b/logs/a', '/tmp/a'])
+    True
+    >>> paths_overlap(['s3://b/logs/a', '/tmp/a'], ['s3://b/logs/b'])
+    False
+    """
+    return any(p.startswith(o) or o.startswith(p)
+               for p in paths for o in others)
+
+
+class CommandOutput(object):
+    """Stands in for sys.stdout while script commands run concurrently
+
+    Output written by a thread that is collecting is kept, so that it can be
+    printed in command order once the command is done. Other threads write
+    straight through.
+    """
+    local = threading.local()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        chunks = getattr(self.local, 'chunks', None)
+        if chunks is None:
+            return self.stream.write(data)
+        chunks.append(data)
+        return len(data)
+
+    @property
+    def buffer(self):
+        # write_output() writes bytes here
+        if getattr(self.local, 'chunks', None) is None:
+            return getattr(self.stream, 'buffer', None)
+        return self
+
+    def flush(self):
+        if getattr(self.local, 'chunks', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @classmethod
+    def collecting(cls):
+        """Whether output on this thread is being collected"""
+        return getattr(cls.local, 'chunks', None) is not None
+
+    def collect(self, func, *args):
+        """Call func, returning its result and the output it wrote"""
+        self.local.chunks = []
+        try:
+            return func(*args), self.local.chunks
+        finally:
+            self.local.chunks = None
+
+    def replay(self, chunks):
+        for data in chunks:
+            if isinstance(data, bytes):
+                self.stream.flush()
+                self.stream.buffer.write(data)
+            else:
+                self.stream.write(data)
+        self.stream.flush()
+
 
 class s3shell(cmd.Cmd):
 
     def __init__(self, args):
         self.bucket = args.bucket
         self.profile = args.profile
+        self.endpoint_url = args.endpoint_url
         self.cwd = '/'
         self.debug = args.debug
         self.dry_run = args.dry_run
-        self.cache = {}
+        self.backend = make_backend(args.backend, self.profile,
+                                    self.endpoint_url, self.debug)
+        self.concurrency = args.concurrency
+        self.chunk_size = args.chunk_size
+        self.limiter = RateLimiter(args.max_bandwidth)
+        self.metrics = Metrics()
+        if args.trace:
+            self.metrics.set_trace(args.trace)
+        self.configure_backend()
+        self.cache = ListingCache(args.cache_size, args.cache_ttl)
+        self.max_cached_keys = 100000
+        # How many sub-directories to prefetch after a cd or ls, and how long
+        # tab completion waits for a listing that isn't cached yet
+        self.prefetch_children = 8
+        self.completion_wait = 0.3
+        self.visits = collections.Counter()
+        self.object_cache = None
+        # Buckets where S3 Select turned out not to be available
+        self.select_unavailable = set()
+        if args.object_cache_size > 0:
+            self.object_cache = ObjectCache(args.object_cache_dir,
+                                            args.object_cache_size)
+        self.status = threading.local()
+        self.status.failed = False
+        self.manifest_path = args.manifest
+        self.manifest = None
+        self.prefetcher = None
+        if not args.no_prefetch:
+            self.prefetcher = Prefetcher(self.prefetch_listing)
         self.update_prompt()
         # Fix broken completion on filenames with '-' in
         readline.set_completer_delims(
             readline.get_completer_delims().replace('-', ''))
         cmd.Cmd.__init__(self)
 
+    def onecmd(self, line):
+        name = self.parseline(line)[0]
+        if not name or name == 'stats':
+            return self.run_command(line)
+        failed = getattr(self.status, 'failed', False)
+        self.status.failed = False
+        start = self.metrics.start_command(line)
+        try:
+            return self.run_command(line)
+        finally:
+            self.metrics.finish_command(name, start, self.status.failed)
+            self.status.failed = self.status.failed or failed
+
+    def run_command(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except (BackendError, OSError) as e:
+            self.mark_failed()
+            print("Error: %s" % e)
+        except UsageError as e:
+            self.mark_failed()
+            print("Error: %s" % e)
+            self.do_help(self.parseline(line)[0])
+
+    def default(self, line):
+        self.mark_failed()
+        cmd.Cmd.default(self, line)
+
+    def mark_failed(self):
+        """Record that the command running on this thread failed"""
+        self.status.failed = True
+
+    def execute(self, line):
+        """Run a single command, returning whether it succeeded"""
+        self.status.failed = False
+        self.onecmd(line)
+        return not self.status.failed
+
+    def run_script(self, commands, keep_going=False):
+        """Run a list of commands non-interactively
+
+        Consecutive independent commands (e.g. a list of gets) are run
+        concurrently, as long as none of them touch the same files. Returns
+        the exit status: 0 if everything succeeded, otherwise 1. Unless
+        keep_going is set, this stops at the first failure.
+        """
+        status = 0
+        i = 0
+        while i < len(commands):
+            group = [commands[i]]
+            paths = self.command_paths(commands[i])
+            i += 1
+            while paths is not None and i < len(commands):
+                more = self.command_paths(commands[i])
+                if more is None or paths_overlap(paths, more):
+                    break
+                group.append(commands[i])
+                paths.extend(more)
+                i += 1
+            if len(group) == 1:
+                ok = self.execute(group[0])
+            else:
+                ok = self.run_pipelined(group, keep_going)
+            if not ok:
+                status = 1
+                if not keep_going:
+                    break
+        return status
+
+    def command_paths(self, line):
+        """Return the local and remote paths a script command reads or writes
+
+        Remote paths are s3:// urls and local ones are absolute, and globs
+        are cut short at the first wildcard so that they cover every file
+        they can match. Returns None for commands that can't be run
+        concurrently.
+        """
+        name, arg, _ = self.parseline(line)
+        if name not in PIPELINED_COMMANDS:
+            return None
+        parser = ShellArgumentParser(name)
+        parser.add_argument('-r', action='store_true')
+        parser.add_argument('-d', dest='dest')
+        parser.add_argument('-j', type=int)
+        parser.add_argument('filenames', nargs='+')
+        try:
+            args = parser.parse_args(shlex.split(arg))
+            paths = []
+            for filename in args.filenames:
+                stem = glob_stem(filename)
+                name_stem = os.path.basename(stem.rstrip('/'))
+                if name == 'put':
+                    paths.append(os.path.abspath(os.path.expanduser(stem)))
+                    dest = args.dest or self.s3url()
+                    if not dest.endswith('/'):
+                        dest += '/'
+                    paths.append(s3url(*self.split_path(dest + name_stem)))
+                else:
+                    paths.append(s3url(*self.split_path(stem)))
+                if name == 'get':
+                    paths.append(os.path.abspath(os.path.join(
+                        args.dest or '.', name_stem)))
+        except (UsageError, BackendError, ValueError):
+            # Let the command report the problem when it runs on its own
+            return None
+        return paths
+
+    def run_pipelined(self, commands, keep_going=False):
+        """Run commands concurrently, printing their output in order
+
+        Unless keep_going is set, commands that haven't started by the time
+        an earlier one fails are cancelled.
+        """
+        ok = True
+        output = CommandOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.concurrency) as pool:
+                futures = [pool.submit(output.collect, self.execute, c)
+                           for c in commands]
+                for future in futures:
+                    if future.cancelled():
+                        continue
+                    succeeded, chunks = future.result()
+                    output.replay(chunks)
+                    if not succeeded:
+                        ok = False
+                        if not keep_going:
+                            for f in futures:
+                                f.cancel()
+        finally:
+            sys.stdout = output.stream
+        return ok
+
     def filename_complete(self, text, line, begidx, endidx, dir_only=False):
-        url = self.s3url()
-        if url not in self.cache:
-            # Run an ls to find out files if we don't have them in cache
-            output = self.aws_s3("ls %s" % url, display_output=False)
-            self.update_completion_cache(output, url)
-        matches = [i for i in self.cache[url]['dirs'] if i.startswith(text)]
+        # readline splits on /, so find the directory part of the whole word
+        # being completed, e.g. 'logs/2025/' when completing 'logs/2025/0'.
+        word = line[:begidx].split(' ')[-1]
+        try:
+            bucket, prefix = self.split_path(self.full_path(word))
+            listing = self.completion_listing(bucket, prefix)
+        except BackendError:
+            return []
+        if listing is None:
+            return []
+        prefixes, objects = listing
+        matches = [p[len(prefix):] for p in prefixes
+                   if p[len(prefix):].startswith(text)]
         if not dir_only:
-            matches.extend([i for i in self.cache[url]['files'] if
-                            i.startswith(text)])
+            matches.extend([o.key[len(prefix):] for o in objects
+                            if o.key[len(prefix):].startswith(text)])
         return matches
 
-    def update_completion_cache(self, output, url):
-        # Update the autocomplete cache
-        self.cache[url] = {'dirs': [], 'files': []}
-        for line in output.split('\n'):
-            filename = line[31:].strip()
-            if filename.endswith('/'):
-                self.cache[url]['dirs'].append(filename)
+    def completion_listing(self, bucket, prefix):
+        """Get a listing for tab completion without blocking for long
+
+        Whatever is in the cache is used, even if it has expired, with a
+        refresh queued in the background. If nothing is cached, this waits
+        briefly for the prefetcher and then gives up.
+        """
+        if self.prefetcher is None:
+            return self.list_dir(bucket, prefix)
+        listing, fresh = self.cache.lookup(bucket, prefix)
+        if not fresh:
+            self.prefetcher.request([(bucket, prefix, 0)], priority=0)
+        if listing is None:
+            self.prefetcher.wait(bucket, prefix, self.completion_wait)
+            listing, _ = self.cache.lookup(bucket, prefix)
+        return listing
+
+    def prefetch_listing(self, bucket, prefix, children, cancelled):
+        """Load a listing into the cache for the prefetcher
+
+        If children is set, also queue that many of the most likely
+        sub-directories: the most visited ones first, then in name order.
+        Returns whether anything was loaded.
+        """
+        loaded = False
+        if not self.cache.is_fresh(bucket, prefix):
+            listing = ([], [])
+            for prefixes, objects in self.backend.list_pages(bucket, prefix):
+                if cancelled():
+                    return False
+                listing[0].extend(prefixes)
+                listing[1].extend(objects)
+                if len(listing[0]) + len(listing[1]) > self.max_cached_keys:
+                    return False
+            self.cache.put(bucket, prefix, listing)
+            loaded = True
+        if children:
+            listing, _ = self.cache.lookup(bucket, prefix)
+            if listing is not None:
+                likely = sorted(listing[0], key=lambda p: (
+                    -self.visits[(bucket, p)], p))[:children]
+                self.prefetcher.request([(bucket, p, 0) for p in likely])
+        return loaded
+
+    def warm(self, bucket, prefix):
+        """Prefetch a directory, its parent and likely sub-directories"""
+        if self.prefetcher is None:
+            return
+        items = [(bucket, prefix, self.prefetch_children)]
+        if prefix:
+            parent = prefix[:prefix.rstrip('/').rfind('/') + 1]
+            items.append((bucket, parent, 0))
+        self.prefetcher.request(items, replace=True)
+
+    def list_dir(self, bucket, prefix, refresh=False):
+        """Return the listing for a prefix, from the cache if possible"""
+        listing = None
+        if not refresh:
+            listing = self.cache.get(bucket, prefix)
+        if listing is None:
+            listing = self.backend.list(bucket, prefix)
+            self.cache.put(bucket, prefix, listing)
+        return listing
+
+    def configure_backend(self):
+        self.backend.chunk_size = self.chunk_size
+        self.metrics.instrument(self.backend)
+
+    def expand_remote(self, patterns, recursive=False):
+        """Expand remote paths, globs and (with recursive) directories
+
+        Returns a list of (bucket, S3Object, relative name) tuples. The
+        relative name is the path to use when copying the object somewhere
+        else, e.g. 'dir/sub/file' for 'dir/' when recursive.
+        """
+        return list(self.iter_remote(patterns, recursive))
+
+    def iter_remote(self, patterns, recursive=False):
+        """Generator version of expand_remote
+
+        Recursive listings are streamed rather than collected first.
+        """
+        for pattern in patterns:
+            bucket, key = self.split_path(pattern)
+            dirname = key[:key.rstrip('/').rfind('/') + 1]
+            if has_glob(key):
+                prefixes, objects = self.list_dir(bucket, dirname)
+                for o in objects:
+                    if fnmatch.fnmatchcase(o.key, key):
+                        yield bucket, o, o.key[len(dirname):]
+                if recursive:
+                    for p in prefixes:
+                        if fnmatch.fnmatchcase(p.rstrip('/'), key):
+                            for r in self.expand_prefix(bucket, p, dirname):
+                                yield r
+            elif recursive and (key == '' or key.endswith('/')):
+                for r in self.expand_prefix(bucket, key, dirname):
+                    yield r
             else:
-                self.cache[url]['files'].append(filename)
+                # Without a trailing slash, a recursive path could be a
+                # directory or a single file
+                found = False
+                if recursive:
+                    for r in self.expand_prefix(bucket, key + '/', dirname):
+                        found = True
+                        yield r
+                if not found:
+                    o = self.backend.head(bucket, key)
+                    yield bucket, o, os.path.basename(key)
+
+    def expand_prefix(self, bucket, prefix, base):
+        """Yield (bucket, S3Object, relative name) for keys below a prefix"""
+        for _, objects in self.backend.list_pages(bucket, prefix,
+                                                  delimiter=''):
+            for o in objects:
+                if not o.key.endswith('/'):
+                    yield bucket, o, o.key[len(base):]
+
+    def run_bounded(self, func, items, jobs=None):
+        """Run func over items in a thread pool, yielding results in order
+        of completion
+
+        Yields (item, result, error) tuples, where error is a BackendError if
+        func raised one. Items are consumed lazily, with at most twice the
+        number of workers in flight, so items can be a generator producing
+        millions of entries.
+        """
+        jobs = jobs or self.concurrency
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            pending = {}
+            items = iter(items)
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < jobs * 2:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(func, item)] = item
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        yield item, future.result(), None
+                    except BackendError as e:
+                        yield item, None, e
+
+    def expand_local(self, patterns, recursive=False):
+        """Expand local paths, globs and directories
+
+        Returns a list of (local path, size, relative name) tuples.
+        """
+        results = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(os.path.expanduser(pattern))) \
+                if has_glob(pattern) else [os.path.expanduser(pattern)]
+            if not matches or not os.path.exists(matches[0]):
+                raise UsageError("No such file: %s" % pattern)
+            for path in matches:
+                if os.path.isdir(path):
+                    if not recursive:
+                        print("Skipping directory %s (use -r)" % path)
+                        continue
+                    base = os.path.dirname(os.path.normpath(path))
+                    for root, dirs, files in os.walk(path):
+                        dirs.sort()
+                        for f in sorted(files):
+                            full = os.path.join(root, f)
+                            results.append((
+                                full, os.path.getsize(full),
+                                os.path.relpath(full, base).replace(
+                                    os.sep, '/')))
+                else:
+                    results.append((path, os.path.getsize(path),
+                                    os.path.basename(path)))
+        return results
+
+    def run_transfers(self, jobs, concurrency=None):
+        """Run (label, size, func) transfer jobs through a thread pool
+
+        Each func is called with a progress callback that it should call with
+        the number of bytes transferred. Returns the list of labels that
+        failed.
+        """
+        # Progress lines from commands running side by side in a script
+        # would overwrite each other
+        progress = Progress(len(jobs), sum(size for _, size, _ in jobs),
+                            enabled=sys.stderr.isatty() and
+                            not CommandOutput.collecting())
+
+        def callback(amount):
+            self.limiter.consume(amount)
+            progress.update(amount)
+
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(
+                concurrency or self.concurrency) as pool:
+            futures = dict((pool.submit(func, callback), label)
+                           for label, _, func in jobs)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    progress.update(files=1)
+                except (BackendError, OSError) as e:
+                    failures.append(futures[future])
+                    self.mark_failed()
+                    print("\rFailed: %s: %s" % (futures[future], e))
+        summary = progress.finish()
+        if len(jobs) > 1 or failures:
+            print("Transferred %s%s" % (summary, failures and
+                                        ", %d failed" % len(failures) or ''))
+        return failures
+
+    def walk(self, bucket, prefix, jobs=None, errors=None):
+        """Yield (prefix, objects) pages for everything below a prefix
+
+        Rather than one long serial listing, each level is listed with a
+        delimiter and sub-prefixes are listed in parallel as they are found.
+        Pages are yielded as soon as they arrive; the order is arbitrary.
+        Prefixes that can't be listed are reported and skipped, and added to
+        errors as (prefix, error) if it is given, so that callers that need
+        a complete listing can tell it isn't.
+        """
+        results = queue.Queue(maxsize=64)
+        stop = threading.Event()
+        lock = threading.Lock()
+        state = {'pending': 1}
+        pool = concurrent.futures.ThreadPoolExecutor(jobs or self.concurrency)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def list_prefix(p):
+            try:
+                for prefixes, objects in self.backend.list_pages(bucket, p):
+                    if stop.is_set():
+                        break
+                    for sub in prefixes:
+                        with lock:
+                            state['pending'] += 1
+                        pool.submit(list_prefix, sub)
+                    put((p, objects))
+            except BackendError as e:
+                put((p, e))
+            finally:
+                with lock:
+                    state['pending'] -= 1
+                    finished = state['pending'] == 0
+                if finished:
+                    put(None)
+
+        pool.submit(list_prefix, prefix)
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                if isinstance(item[1], BackendError):
+                    self.mark_failed()
+                    print("Error listing %s: %s" % (
+                        s3url(bucket, item[0]), item[1]))
+                    if errors is not None:
+                        errors.append(item)
+                    continue
+                yield item
+        finally:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def display_path(self, bucket, key):
+        """Return the shortest path that refers to a key from the cwd"""
+        if bucket != self.bucket:
+            return s3url(bucket, key)
+        if key.startswith(self.cwd[1:]):
+            return key[len(self.cwd) - 1:]
+        return '/' + key
 
     def emptyline(self):
         # Don't do anything when a blank command is entered.
@@ -78,24 +3046,12 @@ class s3shell(cmd.Cmd):
     def update_prompt(self):
         self.prompt = "%s%s> " % (self.bucket, self.cwd)
 
-    def aws_s3(self, cmd, display_output=True):
-        if self.bucket == '':
-            print("No bucket selected")
+    def mutate(self, description, func, *args):
+        """Run a modifying backend operation, honoring dry run mode"""
+        if self.dry_run:
+            print("(dry run) %s" % description)
             return
-        profile_str = ''
-        if self.profile != '':
-            profile_str = "--profile %s" % (self.profile)
-        full_cmd = "aws %s s3 %s" % (profile_str, cmd)
-        if self.debug:
-            print(full_cmd)
-        if not self.dry_run:
-            try:
-                output = subprocess.check_output(full_cmd, shell=True)
-            except subprocess.CalledProcessError as e:
-                output = e.output
-            if display_output:
-                sys.stdout.write(output.decode())
-            return output.decode()
+        return func(*args)
 
     def s3url(self, dirname=None):
         if dirname is None:
@@ -108,14 +3064,146 @@ class s3shell(cmd.Cmd):
         else:
             return "%s%s" % (self.s3url(), filename)
 
-    def download_temp(self, filename):
-        local_file = tempfile.mkstemp()
-        self.aws_s3("cp %s %s" % (self.full_path(filename), local_file[1]))
-        return local_file[1]
+    def split_path(self, filename):
+        """Return the (bucket, key) for a filename relative to the cwd"""
+        path = self.full_path(filename)
+        if path.startswith("/"):
+            path = self.s3url(path)
+        bucket, key = parse_s3url(path)
+        if not bucket:
+            raise BackendError("No bucket selected")
+        return bucket, key
+
+    def open_object(self, bucket, key, cache=False):
+        """Open a whole object, returning (S3Object, chunk generator)
+
+        With cache, if the object cache has a copy, it is revalidated with a
+        conditional get and served from disk if it's still current. Otherwise
+        the object is streamed from S3 and saved to the cache on the way
+        through. Only files that are likely to be looked at again (by cat,
+        less and edit) are cached, so that scans like zgrep don't push them
+        out.
+        """
+        cache = cache and self.object_cache is not None
+        cached = None
+        if cache:
+            cached = self.object_cache.lookup(bucket, key)
+        try:
+            o, body = self.backend.get(bucket, key,
+                                       cached and cached.etag or None)
+        except NotModified:
+            return cached, self.object_cache.read(bucket, key)
+        chunks = read_chunks(body)
+        if cache:
+            chunks = self.object_cache.tee(bucket, o, chunks)
+        return o, chunks
+
+    def copy_plan(self, sources, dest, recursive=False):
+        """Yield (src bucket, S3Object, dst bucket, dst key) for a copy
+
+        As with 'aws s3 cp', a destination ending in / is a directory and the
+        source filename is appended to it. Copying several files, globs or
+        directories always treats the destination as a directory.
+        """
+        dst_bucket, dst_key = self.split_path(dest)
+        if not (recursive or len(sources) > 1 or has_glob(sources[0]) or
+                dst_key == '' or dst_key.endswith('/')):
+            bucket, key = self.split_path(sources[0])
+            yield bucket, self.backend.head(bucket, key), dst_bucket, dst_key
+            return
+        if dst_key and not dst_key.endswith('/'):
+            dst_key += '/'
+        if recursive:
+            for source in sources:
+                bucket, key = self.split_path(source)
+                if bucket == dst_bucket and (key == '' or dst_key.startswith(
+                        key.rstrip('/') + '/')):
+                    raise UsageError("Can't copy %s into itself" % source)
+        for bucket, o, name in self.iter_remote(sources, recursive):
+            yield bucket, o, dst_bucket, dst_key + name
+
+    def copy_object(self, task):
+        """Copy an object from a copy plan, returning whether the copy was
+        verified"""
+        src_bucket, o, dst_bucket, dst_key = task
+        if (src_bucket, o.key) == (dst_bucket, dst_key):
+            raise BackendError("source and destination are the same")
+        etag = self.backend.copy(src_bucket, o.key, dst_bucket, dst_key,
+                                 o.size)
+        if etag and etag == o.etag:
+            return True
+        return self.backend.head(dst_bucket, dst_key).size == o.size
+
+    def copy_files(self, line, move=False):
+        name = move and 'mv' or 'cp'
+        parser = ShellArgumentParser(name)
+        parser.add_argument('-r', dest='recursive', action='store_true')
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        if len(args.filenames) < 2:
+            raise UsageError("Missing filename")
+        plan = self.copy_plan(args.filenames[:-1], args.filenames[-1],
+                              args.recursive)
+        if self.dry_run:
+            for src_bucket, o, dst_bucket, dst_key in plan:
+                print("(dry run) copy %s to %s" % (
+                    s3url(src_bucket, o.key), s3url(dst_bucket, dst_key)))
+                if move:
+                    print("(dry run) delete %s" % s3url(src_bucket, o.key))
+            return
+        progress = Progress(0, 0, enabled=sys.stderr.isatty())
+        failed = 0
+        dirs = set()
+        to_delete = collections.defaultdict(list)
+        deletes = []
+        with concurrent.futures.ThreadPoolExecutor(2) as delete_pool:
+            for task, verified, error in self.run_bounded(
+                    self.copy_object, plan, args.jobs):
+                src_bucket, o, dst_bucket, dst_key = task
+                if error is not None or not verified:
+                    self.mark_failed()
+                    failed += 1
+                    print("\rFailed to copy %s: %s" % (
+                        s3url(src_bucket, o.key),
+                        error or "copy could not be verified"))
+                    continue
+                progress.update(o.size, 1)
+                dirs.add((dst_bucket, dst_key[:dst_key.rfind('/') + 1]))
+                if move:
+                    # Only delete sources once their copies are verified
+                    batch = to_delete[src_bucket]
+                    batch.append(o.key)
+                    if len(batch) >= 1000:
+                        deletes.append((src_bucket, batch, delete_pool.submit(
+                            self.backend.delete_many, src_bucket, batch)))
+                        to_delete[src_bucket] = []
+            for bucket, batch in to_delete.items():
+                if batch:
+                    deletes.append((bucket, batch, delete_pool.submit(
+                        self.backend.delete_many, bucket, batch)))
+            for bucket, batch, future in deletes:
+                try:
+                    failures = future.result()
+                except BackendError as e:
+                    failures = [(key, str(e)) for key in batch]
+                for key, message in failures:
+                    failed += 1
+                    self.mark_failed()
+                    print("Failed to delete %s: %s" % (s3url(bucket, key),
+                                                       message))
+                dirs.update((bucket, k[:k.rfind('/') + 1]) for k in batch)
+        for bucket, d in dirs:
+            self.cache.invalidate(bucket, d)
+        summary = progress.finish()
+        if progress.files > 1 or failed:
+            print("%s %s%s" % (move and "Moved" or "Copied", summary,
+                               failed and ", %d failed" % failed or ''))
 
     def do_debug(self, line):
         """Toggle debug mode"""
         self.debug = not self.debug
+        self.backend.debug = self.debug
         print("Debug mode: %s" % (self.debug and "On" or "Off"))
 
     def do_dry_run(self, line):
@@ -133,7 +3221,11 @@ class s3shell(cmd.Cmd):
         """
         if line != '':
             self.profile = line
-        print("Profile set to: %s" % line)
+            self.backend = make_backend(self.backend.name, self.profile,
+                                        self.endpoint_url, self.debug)
+            self.configure_backend()
+            self.cache.clear()
+        print("Profile set to: %s" % self.profile)
 
     def do_bucket(self, line):
         """Change the current bucket name
@@ -150,15 +3242,169 @@ class s3shell(cmd.Cmd):
     def do_ls(self, line):
         """List the contents of the current directory in S3.
 
-        Usage: ls
+        Usage: ls [-l] [--limit N] [--start-after KEY] [PATH]
+
+        Results are printed a page at a time as they arrive, so listing a
+        prefix with millions of keys starts straight away. -l shows human
+        readable sizes and storage classes.
         """
-        if not line:
-            output = self.aws_s3("ls %s" % self.s3url())
-            self.update_completion_cache(output, self.s3url())
-        else:
-            parts = shlex.split(line)
-            filename = parts[0]
-            output = self.aws_s3("ls %s" % self.full_path(filename))
+        parser = ShellArgumentParser('ls')
+        parser.add_argument('-l', dest='long_format', action='store_true')
+        parser.add_argument('--limit', type=int)
+        parser.add_argument('--start-after')
+        parser.add_argument('path', nargs='?')
+        args = parser.parse_args(shlex.split(line))
+        bucket, prefix = self.split_path(args.path or self.s3url())
+        start_after = None
+        if args.start_after:
+            start_after = self.split_path(args.start_after)[1]
+        # Only cache complete listings, and stop caching once a listing gets
+        # too big so that memory use stays bounded.
+        cacheable = args.limit is None and start_after is None
+        listing = ([], [])
+        remaining = args.limit
+        for prefixes, objects in self.backend.list_pages(
+                bucket, prefix, start_after=start_after,
+                page_size=min(1000, remaining or 1000)):
+            if remaining is not None:
+                prefixes = prefixes[:remaining]
+                objects = objects[:remaining - len(prefixes)]
+                remaining -= len(prefixes) + len(objects)
+            for l in format_listing(prefixes, objects, prefix,
+                                    args.long_format):
+                print(l)
+            sys.stdout.flush()
+            if cacheable:
+                listing[0].extend(prefixes)
+                listing[1].extend(objects)
+                if len(listing[0]) + len(listing[1]) > self.max_cached_keys:
+                    cacheable = False
+                    listing = ([], [])
+            if remaining is not None and remaining <= 0:
+                break
+        if cacheable:
+            self.cache.put(bucket, prefix, listing)
+        if prefix == '' or prefix.endswith('/'):
+            self.warm(bucket, prefix)
+
+    def do_find(self, line):
+        """Search for files below a directory
+
+        Usage: find [PATH] [-name GLOB] [-newer DATE] [-older DATE]
+                    [-size [+-]SIZE] [-storage-class CLASS] [-l] [-j JOBS]
+
+        DATE is either a date/time such as 2025-07-01 or 2025-07-01T12:00, or
+        an age such as 30m, 12h or 7d. -size +N matches files larger than N,
+        -N smaller than N and N exactly N bytes, with K/M/G suffixes allowed.
+        -l shows the size, date and storage class of each file. Sub-directories
+        are listed in parallel by JOBS workers and results are printed as they
+        are found, so they aren't in any particular order.
+        """
+        parts = shlex.split(line)
+        tests = []
+        path = None
+        long_format = False
+        jobs = None
+        while parts:
+            arg = parts.pop(0)
+            if arg == '-l':
+                long_format = True
+                continue
+            if not arg.startswith('-') or arg == '-':
+                if path is not None:
+                    raise UsageError("Only one path can be given")
+                path = arg
+                continue
+            if not parts:
+                raise UsageError("Missing value for %s" % arg)
+            value = parts.pop(0)
+            if arg == '-name':
+                tests.append(lambda o, v=value: fnmatch.fnmatchcase(
+                    o.key.rstrip('/').rsplit('/', 1)[-1], v))
+            elif arg == '-newer':
+                tests.append(lambda o, v=parse_time(value): o.mtime > v)
+            elif arg == '-older':
+                tests.append(lambda o, v=parse_time(value): o.mtime < v)
+            elif arg == '-size':
+                try:
+                    size = parse_size(value.lstrip('+-'))
+                except ValueError:
+                    raise UsageError("Invalid size: %s" % value)
+                if value.startswith('+'):
+                    tests.append(lambda o, v=size: o.size > v)
+                elif value.startswith('-'):
+                    tests.append(lambda o, v=size: o.size < v)
+                else:
+                    tests.append(lambda o, v=size: o.size == v)
+            elif arg == '-storage-class':
+                tests.append(lambda o, v=value.upper(): o.storage_class == v)
+            elif arg == '-j':
+                jobs = int(value)
+            else:
+                raise UsageError("Unknown option: %s" % arg)
+        dest = path or self.s3url()
+        if not dest.endswith('/'):
+            dest += '/'
+        bucket, prefix = self.split_path(dest)
+        for _, objects in self.walk(bucket, prefix, jobs):
+            for o in objects:
+                if all(test(o) for test in tests):
+                    name = self.display_path(bucket, o.key)
+                    if long_format:
+                        print("%s %7s %-12s %s" % (
+                            o.mtime.astimezone().strftime("%Y-%m-%d %H:%M:%S"),
+                            human_size(o.size), o.storage_class, name))
+                    else:
+                        print(name)
+            sys.stdout.flush()
+
+    def complete_find(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx,
+                                      dir_only=True)
+
+    def do_du(self, line):
+        """Show the total size of files below a directory
+
+        Usage: du [-h] [-s] [--depth N] [-j JOBS] [PATH]
+
+        Shows the size and number of files in each directory down to depth N
+        below PATH (default 1), followed by the total. -s only shows the
+        total, and -h uses human readable sizes. Sub-directories are listed in
+        parallel by JOBS workers.
+        """
+        parser = ShellArgumentParser('du')
+        parser.add_argument('-h', dest='human', action='store_true')
+        parser.add_argument('-s', dest='summary', action='store_true')
+        parser.add_argument('--depth', type=int, default=1)
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('path', nargs='?')
+        args = parser.parse_args(shlex.split(line))
+        depth = 0 if args.summary else args.depth
+        dest = args.path or self.s3url()
+        if not dest.endswith('/'):
+            dest += '/'
+        bucket, prefix = self.split_path(dest)
+        sizes = collections.defaultdict(int)
+        counts = collections.defaultdict(int)
+        progress = Progress(0, 0, enabled=sys.stderr.isatty())
+        for p, objects in self.walk(bucket, prefix, args.jobs):
+            size = sum(o.size for o in objects)
+            # Every object in a page shares the same parent directory
+            dirs = p[len(prefix):].split('/')[:-1]
+            for i in range(min(len(dirs), depth) + 1):
+                d = prefix + ''.join(part + '/' for part in dirs[:i])
+                sizes[d] += size
+                counts[d] += len(objects)
+            progress.update(size, len(objects))
+        progress.finish()
+        for d in sorted(d for d in sizes if d != prefix) + [prefix]:
+            size = args.human and human_size(sizes[d]) or sizes[d]
+            print("%s\t%d\t%s" % (size, counts[d],
+                                   self.display_path(bucket, d) or '.'))
+
+    def complete_du(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx,
+                                      dir_only=True)
 
     def do_lls(self, line):
         """Run ls locally
@@ -180,7 +3426,7 @@ class s3shell(cmd.Cmd):
         if line == '':
             self.cwd = '/'
         elif line.startswith('/'):
-            self.cwd = line
+            self.cwd = line.rstrip('/') + '/'
         else:
             parts = line.split('/')
             cwd = self.cwd[1:].split('/')
@@ -200,9 +3446,19 @@ class s3shell(cmd.Cmd):
             if not self.cwd.endswith('/'):
                 self.cwd = '%s/' % self.cwd
         self.update_prompt()
+        if self.bucket:
+            prefix = self.cwd[1:]
+            self.visits[(self.bucket, prefix)] += 1
+            parent = prefix[:prefix.rstrip('/').rfind('/') + 1]
+            listing = self.cache.peek(self.bucket, parent) if prefix \
+                else None
+            if listing is not None and prefix not in listing[0]:
+                print("Warning: %s doesn't exist" % self.cwd)
+            self.warm(self.bucket, prefix)
 
     def complete_cd(self, text, line, begidx, endidx):
-        return self.filename_complete(text, line, begidx, endidx, dir_only=True)
+        return self.filename_complete(text, line, begidx, endidx,
+                                      dir_only=True)
 
     def do_lcd(self, line):
         """Change the current local directory.
@@ -220,29 +3476,153 @@ class s3shell(cmd.Cmd):
         """Print the current local working directory"""
         print(os.getcwd())
 
+    def write_output(self, data):
+        """Write bytes to stdout, even if stdout has been replaced"""
+        buf = getattr(sys.stdout, 'buffer', None)
+        if buf is not None:
+            sys.stdout.flush()
+            buf.write(data)
+        else:
+            sys.stdout.write(data.decode(errors='replace'))
+
+    def iter_chunks(self, filename, byte_range=None, cache=False):
+        """Stream the contents of a file in chunks
+
+        Whole files go through the object cache if cache is set, ranges are
+        always fetched.
+        """
+        bucket, key = self.split_path(filename)
+        if byte_range:
+            chunks = read_chunks(self.backend.stream(bucket, key, byte_range))
+        else:
+            chunks = self.open_object(bucket, key, cache)[1]
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+
     def do_cat(self, line):
         """Display the contents of a file stored in S3
 
-        Usage: cat FILENAME
+        Usage: cat [--range START-END] FILENAME...
+
+        Files are streamed straight to the terminal. With --range only part of
+        the file is fetched; START-, and -LENGTH (the last LENGTH bytes) work
+        too.
         """
-        if not line:
-            print("Error: Missing filename")
-            self.do_help('cat')
-            return
-        parts = shlex.split(line)
-        filename = parts[0]
-        local_file = self.download_temp(filename)
-        with open(local_file) as fh:
-            print(fh.read())
-        os.remove(local_file)
+        parser = ShellArgumentParser('cat')
+        parser.add_argument('--range', type=parse_range)
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        try:
+            for filename in args.filenames:
+                for chunk in self.iter_chunks(filename, args.range,
+                                              cache=True):
+                    self.write_output(chunk)
+        finally:
+            sys.stdout.flush()
 
     def complete_cat(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
 
+    def do_head(self, line):
+        """Display the first lines of a file stored in S3
+
+        Usage: head [-n LINES] [-c BYTES] FILENAME
+
+        This uses range requests to fetch just the start of the file, growing
+        the range until it has enough lines.
+        """
+        parser = ShellArgumentParser('head')
+        parser.add_argument('-n', dest='lines', type=int, default=10)
+        parser.add_argument('-c', dest='bytes', type=parse_size)
+        parser.add_argument('filename')
+        args = parser.parse_args(shlex.split(line))
+        bucket, key = self.split_path(args.filename)
+        # Ranges of empty objects can't be satisfied, so check the size
+        size = self.backend.head(bucket, key).size
+        if args.bytes is not None:
+            if args.bytes > 0 and size:
+                self.do_cat("--range 0-%d %s" % (
+                    args.bytes - 1, shlex.quote(args.filename)))
+            return
+        remaining = args.lines
+        offset = 0
+        window = STREAM_CHUNK
+        while remaining > 0 and offset < size:
+            end = min(offset + window, size)
+            chunks = self.iter_chunks(args.filename,
+                                      "bytes=%d-%d" % (offset, end - 1))
+            try:
+                for chunk in chunks:
+                    pos = 0
+                    while remaining > 0:
+                        pos = chunk.find(b'\n', pos) + 1
+                        if not pos:
+                            break
+                        remaining -= 1
+                    self.write_output(chunk[:pos] if remaining <= 0
+                                      else chunk)
+                    if remaining <= 0:
+                        break
+            finally:
+                chunks.close()
+            offset = end
+            window = min(window * 4, MAX_LINE_WINDOW)
+        sys.stdout.flush()
+
+    def complete_head(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_tail(self, line):
+        """Display the last lines of a file stored in S3
+
+        Usage: tail [-n LINES] [-c BYTES] FILENAME
+
+        This uses range requests to fetch just the end of the file, growing
+        the range until it has enough lines.
+        """
+        parser = ShellArgumentParser('tail')
+        parser.add_argument('-n', dest='lines', type=int, default=10)
+        parser.add_argument('-c', dest='bytes', type=parse_size)
+        parser.add_argument('filename')
+        args = parser.parse_args(shlex.split(line))
+        bucket, key = self.split_path(args.filename)
+        # Ranges of empty objects can't be satisfied, so check the size
+        size = self.backend.head(bucket, key).size
+        if args.bytes is not None:
+            if args.bytes > 0 and size:
+                self.do_cat("--range -%d %s" % (
+                    args.bytes, shlex.quote(args.filename)))
+            return
+        if args.lines <= 0 or not size:
+            return
+        window = STREAM_CHUNK
+        while True:
+            window = min(window, size)
+            data = b''.join(self.iter_chunks(args.filename,
+                                             "bytes=-%d" % window))
+            # The last line might not end in a newline
+            lines = data.rstrip(b'\n').count(b'\n') + 1
+            if lines > args.lines or window >= size:
+                break
+            window *= 4
+        if window < size or lines > args.lines:
+            data = b'\n'.join(data.rstrip(b'\n').split(b'\n')[-args.lines:])
+            data += b'\n'
+        self.write_output(data)
+        sys.stdout.flush()
+
+    def complete_tail(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
     def do_less(self, line):
         """Display the contents of a file stored in S3 with less
 
         Usage: less FILENAME
+
+        The file is streamed into less as it downloads.
         """
         if not line:
             print("Error: Missing filename")
@@ -250,9 +3630,326 @@ class s3shell(cmd.Cmd):
             return
         parts = shlex.split(line)
         filename = parts[0]
-        local_file = self.download_temp(filename)
-        os.system('less "%s"' % local_file)
-        os.remove(local_file)
+        self.page(self.iter_chunks(filename, cache=True))
+
+    def do_zcat(self, line):
+        """Display the decompressed contents of files stored in S3
+
+        Usage: zcat FILENAME...
+
+        gzip, bzip2, xz and zstd (if the zstandard module is installed) files
+        are decompressed as they stream in. Other files are shown as is.
+        """
+        parser = ShellArgumentParser('zcat')
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        try:
+            for filename in args.filenames:
+                for chunk in decompress_chunks(self.iter_chunks(filename)):
+                    self.write_output(chunk)
+        finally:
+            sys.stdout.flush()
+
+    def complete_zcat(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_zless(self, line):
+        """Display the decompressed contents of a file stored in S3 with less
+
+        Usage: zless FILENAME
+        """
+        parser = ShellArgumentParser('zless')
+        parser.add_argument('filename')
+        args = parser.parse_args(shlex.split(line))
+        self.page(decompress_chunks(self.iter_chunks(args.filename)))
+
+    def complete_zless(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_zgrep(self, line):
+        """Search (possibly compressed) files stored in S3
+
+        Usage: zgrep [-i] [-v] [-c] [-m NUM] [-j JOBS] PATTERN FILENAME...
+
+        Filenames can be globs. Files are decompressed as they stream in and
+        are searched in parallel by JOBS workers (default: the transfer
+        concurrency). Matching lines are printed as they are found, prefixed
+        with the filename when searching more than one file.
+
+        -i  Ignore case
+        -v  Show lines that don't match
+        -c  Only show a count of matching lines per file
+        -m  Stop after NUM matching lines in total
+        """
+        parser = ShellArgumentParser('zgrep')
+        parser.add_argument('-i', dest='ignore_case', action='store_true')
+        parser.add_argument('-v', dest='invert', action='store_true')
+        parser.add_argument('-c', dest='count', action='store_true')
+        parser.add_argument('-m', dest='max_count', type=int)
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('pattern')
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        try:
+            regex = re.compile(args.pattern.encode(),
+                               args.ignore_case and re.I or 0)
+        except re.error as e:
+            raise UsageError("Invalid pattern: %s" % e)
+        files = [s3url(bucket, o.key) for bucket, o, _ in
+                 self.expand_remote(args.filenames)]
+        show_names = len(files) > 1
+        results = queue.Queue(maxsize=1000)
+        stop = threading.Event()
+        lock = threading.Lock()
+        state = {'matches': 0}
+
+        def search(url):
+            if stop.is_set():
+                return
+            count = 0
+            chunks = self.iter_chunks(url)
+            try:
+                for l in iter_lines(decompress_chunks(chunks)):
+                    if stop.is_set():
+                        break
+                    if bool(regex.search(l)) == args.invert:
+                        continue
+                    with lock:
+                        if args.max_count is not None and \
+                                state['matches'] >= args.max_count:
+                            stop.set()
+                            break
+                        state['matches'] += 1
+                        if state['matches'] == args.max_count:
+                            stop.set()
+                    count += 1
+                    if not args.count:
+                        results.put((url, l))
+            finally:
+                chunks.close()
+            if args.count:
+                results.put((url, count))
+
+        def run():
+            try:
+                with concurrent.futures.ThreadPoolExecutor(
+                        args.jobs or self.concurrency) as pool:
+                    futures = dict((pool.submit(search, f), f)
+                                   for f in files)
+                    for future in concurrent.futures.as_completed(futures):
+                        try:
+                            future.result()
+                        except (BackendError, OSError) as e:
+                            results.put((futures[future], e))
+            finally:
+                # Always wake up the main thread, even if something
+                # unexpected went wrong
+                results.put(None)
+
+        runner = threading.Thread(target=run, daemon=True)
+        runner.start()
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                url, value = item
+                name = show_names and "%s:" % url or ''
+                if isinstance(value, Exception):
+                    self.mark_failed()
+                    print("zgrep: %s: %s" % (url, value))
+                elif args.count:
+                    print("%s%d" % (name, value))
+                else:
+                    print("%s%s" % (name, value.decode(errors='replace')))
+        finally:
+            # Let the workers finish if we were interrupted
+            stop.set()
+            while runner.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def complete_zgrep(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def do_select(self, line):
+        """Query CSV, JSON or Parquet files with SQL, using S3 Select
+
+        Usage: select [-H] [-j JOBS] [--format csv|json|parquet]
+                      [--compression none|gzip|bzip2] [--output csv|json]
+                      [--no-header] [--delimiter CHAR] [--json-type TYPE]
+                      [--local] "SQL" FILENAME...
+
+        Only the matching rows are sent back by S3, e.g.:
+
+            select "SELECT s.name FROM S3Object s WHERE s.age > '30'" a.csv
+
+        Filenames can be globs or directories, in which case every file below
+        them is queried. Files are queried in parallel by JOBS workers and
+        the rows are printed as they arrive, prefixed with the filename with
+        -H. A LIMIT applies to the total number of rows printed.
+
+        The format and compression are guessed from the filename if not given.
+        CSV files are assumed to have a header row unless --no-header is
+        given. --json-type is 'lines' (the default) or 'document'. The output
+        defaults to CSV for CSV files and JSON lines otherwise.
+
+        Where S3 Select isn't available the files are downloaded and queried
+        locally instead, which supports the common subset of the SQL. --local
+        forces this.
+        """
+        parser = ShellArgumentParser('select')
+        parser.add_argument('-H', dest='with_filename', action='store_true')
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('--format', choices=['csv', 'json', 'parquet'])
+        parser.add_argument('--compression',
+                            choices=['none', 'gzip', 'bzip2'])
+        parser.add_argument('--output', choices=['csv', 'json'])
+        parser.add_argument('--no-header', action='store_true')
+        parser.add_argument('--delimiter')
+        parser.add_argument('--json-type', choices=['lines', 'document'],
+                            default='lines')
+        parser.add_argument('--local', action='store_true')
+        parser.add_argument('sql')
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        try:
+            query = SelectQuery(args.sql)
+            limit = query.limit
+        except UsageError as e:
+            if args.local:
+                raise
+            # S3 Select understands more SQL than the local evaluator, so
+            # only complain if we end up needing it
+            query, limit = e, None
+        files = ((bucket, o) for bucket, o, _ in
+                 self.iter_remote(args.filenames, recursive=True)
+                 if not o.key.endswith('/'))
+        show_names = args.with_filename
+        results = queue.Queue(maxsize=1000)
+        stop = threading.Event()
+
+        def select(item):
+            bucket, o = item
+            if stop.is_set():
+                return
+            url = s3url(bucket, o.key)
+            fmt, compression = select_format(o.key)
+            fmt = args.format or fmt
+            compression = args.compression or compression
+            output = args.output or (fmt == 'csv' and 'csv' or 'json')
+            delimiter = args.delimiter or (
+                o.key.split('.gz')[0].endswith('.tsv') and '\t' or ',')
+            started = False
+            if not args.local and bucket not in self.select_unavailable:
+                input_serialization = {
+                    'CompressionType': compression.upper()}
+                if fmt == 'csv':
+                    input_serialization['CSV'] = {
+                        'FileHeaderInfo': args.no_header and 'NONE' or 'USE',
+                        'FieldDelimiter': delimiter}
+                elif fmt == 'json':
+                    input_serialization['JSON'] = {
+                        'Type': args.json_type.upper()}
+                else:
+                    input_serialization = {'Parquet': {}}
+                output_serialization = output == 'csv' and {
+                    'CSV': {'FieldDelimiter': delimiter}} or {
+                    'JSON': {'RecordDelimiter': '\n'}}
+                chunks = self.backend.select(
+                    bucket, o.key, args.sql, input_serialization,
+                    output_serialization)
+                try:
+                    for l in iter_lines(chunks):
+                        started = True
+                        if stop.is_set():
+                            break
+                        if l:
+                            results.put((url, l + b'\n'))
+                    return
+                except SelectUnsupported as e:
+                    if started:
+                        raise
+                    if e.permanent:
+                        self.select_unavailable.add(bucket)
+                finally:
+                    chunks.close()
+            if isinstance(query, UsageError):
+                raise query
+            chunks = self.iter_chunks(url)
+            try:
+                records = iter_records(chunks, fmt, not args.no_header,
+                                       delimiter, args.json_type)
+                for row in SelectQuery(args.sql).run(records):
+                    if stop.is_set():
+                        break
+                    results.put((url, format_row(row, output, delimiter)))
+            except (ValueError, TypeError, csv.Error, EOFError,
+                    zlib.error) as e:
+                raise BackendError("Can't query file: %s" % e)
+            finally:
+                chunks.close()
+
+        def run():
+            try:
+                for item, _, error in self.run_bounded(
+                        select, files, args.jobs):
+                    if error is not None:
+                        results.put((s3url(item[0], item[1].key), error))
+            except (BackendError, UsageError, OSError) as e:
+                results.put((' '.join(args.filenames), e))
+            finally:
+                results.put(None)
+
+        runner = threading.Thread(target=run, daemon=True)
+        runner.start()
+        printed = 0
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                url, value = item
+                if isinstance(value, Exception):
+                    self.mark_failed()
+                    print("select: %s: %s" % (url, value))
+                    continue
+                if limit is not None and printed >= limit:
+                    stop.set()
+                    continue
+                if show_names:
+                    value = ("%s:" % url).encode() + value
+                self.write_output(value)
+                printed += 1
+        finally:
+            stop.set()
+            while runner.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def complete_select(self, text, line, begidx, endidx):
+        return self.filename_complete(text, line, begidx, endidx)
+
+    def page(self, chunks):
+        """Pipe chunks of output through less"""
+        pager = subprocess.Popen(['less'], stdin=subprocess.PIPE)
+        try:
+            for chunk in chunks:
+                pager.stdin.write(chunk)
+        except BrokenPipeError:
+            # less was quit before the end of the file
+            pass
+        finally:
+            chunks.close()
+            try:
+                pager.stdin.close()
+            except BrokenPipeError:
+                pass
+            pager.wait()
 
     def complete_less(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
@@ -260,16 +3957,14 @@ class s3shell(cmd.Cmd):
     def do_cp(self, line):
         """Copy files (remotely)
 
-        Usage: cp FILENAME1 FILENAME2
+        Usage: cp [-r] [-j JOBS] FILENAME... DESTINATION
+
+        Sources can be globs, and -r copies directories. Files can be copied
+        between buckets. The copies happen entirely within S3, JOBS at a time
+        (default: the transfer concurrency), with big files copied in
+        parallel parts.
         """
-        parts = shlex.split(line)
-        if len(parts) < 2:
-            print("Error: Missing filename")
-            self.do_help('cp')
-            return
-        self.aws_s3("cp %s" % ' '.join([
-            "'%s'" % self.full_path(p) for p in parts]))
-        self.cache = {} # Naively clear cache
+        self.copy_files(line)
 
     def complete_cp(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
@@ -277,66 +3972,176 @@ class s3shell(cmd.Cmd):
     def do_mv(self, line):
         """Move/rename files (remotely)
 
-        Usage: cp FILENAME1 FILENAME2
+        Usage: mv [-r] [-j JOBS] FILENAME... DESTINATION
+
+        This works like cp, with the sources deleted in batches once their
+        copies have been verified.
         """
-        parts = shlex.split(line)
-        if len(parts) < 2:
-            print("Error: Missing filename")
-            self.do_help('mv')
-            return
-        self.aws_s3("mv %s" % ' '.join([
-            "'%s'" % self.full_path(p) for p in parts]))
-        self.cache = {} # Naively clear cache
+        self.copy_files(line, move=True)
 
     def complete_mv(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
 
     def do_rm(self, line):
-        """Delete a file from S3
+        """Delete files from S3
+
+        Usage: rm [-r] [-j JOBS] FILENAME...
 
-        Usage: rm FILENAME
+        Filenames can be globs, and -r deletes everything below a directory.
+        Keys are deleted in batches of up to 1000 per request, with JOBS
+        batches (default: the transfer concurrency) running at once.
         """
-        if not line:
-            print("Error: Missing filename")
-            self.do_help('rm')
+        parser = ShellArgumentParser('rm')
+        parser.add_argument('-r', dest='recursive', action='store_true')
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        batches = self.delete_batches(args.filenames, args.recursive)
+        if self.dry_run:
+            for n, (bucket, keys) in enumerate(batches, 1):
+                print("(dry run) batch %d: delete %d keys from s3://%s" % (
+                    n, len(keys), bucket))
+                for key in keys:
+                    print("    %s" % key)
             return
-        parts = shlex.split(line)
-        filename = parts[0]
-        self.aws_s3("rm '%s'" % self.full_path(filename))
-        self.cache = {} # Naively clear cache
+        deleted = failed = 0
+        dirs = set()
+        for (bucket, keys), failures, error in self.run_bounded(
+                lambda batch: self.backend.delete_many(*batch), batches,
+                args.jobs):
+            if error is not None:
+                failures = [(key, str(error)) for key in keys]
+            for key, message in failures:
+                self.mark_failed()
+                print("Failed to delete %s: %s" % (s3url(bucket, key),
+                                                   message))
+            failed += len(failures)
+            deleted += len(keys) - len(failures)
+            dirs.update((bucket, k[:k.rfind('/') + 1]) for k in keys)
+        for bucket, d in dirs:
+            self.cache.invalidate(bucket, d)
+        if deleted + failed > 1 or failed:
+            print("Deleted %d objects%s" % (
+                deleted, failed and ", %d failed" % failed or ''))
+
+    def delete_batches(self, patterns, recursive=False, batch_size=1000):
+        """Yield (bucket, keys) batches of keys to delete
+
+        Recursive deletes are streamed from the listing, so batches start
+        going out before the whole prefix has been listed.
+        """
+        batch_bucket = None
+        batch = []
+        for bucket, key in self.iter_delete_keys(patterns, recursive):
+            if batch and (bucket != batch_bucket or len(batch) >= batch_size):
+                yield batch_bucket, batch
+                batch = []
+            batch_bucket = bucket
+            batch.append(key)
+        if batch:
+            yield batch_bucket, batch
+
+    def iter_delete_keys(self, patterns, recursive):
+        for pattern in patterns:
+            bucket, key = self.split_path(pattern)
+            if has_glob(key):
+                dirname = key[:key.rfind('/') + 1]
+                prefixes, objects = self.list_dir(bucket, dirname)
+                for o in objects:
+                    if fnmatch.fnmatchcase(o.key, key):
+                        yield bucket, o.key
+                if recursive:
+                    for p in prefixes:
+                        if fnmatch.fnmatchcase(p.rstrip('/'), key):
+                            for k in self.iter_keys(bucket, p):
+                                yield bucket, k
+            elif recursive:
+                if key == '':
+                    raise UsageError("Refusing to delete a whole bucket")
+                found = False
+                for k in self.iter_keys(bucket, key.rstrip('/') + '/'):
+                    found = True
+                    yield bucket, k
+                if not found and not key.endswith('/'):
+                    # Not a directory, so delete it as a file
+                    yield bucket, key
+            else:
+                yield bucket, key
+
+    def iter_keys(self, bucket, prefix):
+        """Yield every key below a prefix, including directory markers"""
+        for _, objects in self.backend.list_pages(bucket, prefix,
+                                                  delimiter=''):
+            for o in objects:
+                yield o.key
 
     def complete_rm(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
 
     def do_get(self, line):
-        """Download a file from S3
+        """Download files from S3
 
-        Usage: get FILENAME
+        Usage: get [-r] [-d LOCALDIR] FILENAME...
+
+        Filenames can be globs, and with -r directories are downloaded
+        recursively. Files are downloaded in parallel into the current local
+        directory, or LOCALDIR if given.
         """
-        if not line:
-            print("Error: Missing filename")
-            self.do_help('get')
-            return
-        parts = shlex.split(line)
-        filename = parts[0]
-        self.aws_s3("cp '%s' ." % (self.full_path(filename)))
+        parser = ShellArgumentParser('get')
+        parser.add_argument('-r', dest='recursive', action='store_true')
+        parser.add_argument('-d', dest='dest', default='.')
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        jobs = []
+        for bucket, o, name in self.expand_remote(args.filenames,
+                                                  args.recursive):
+            local_file = os.path.join(args.dest, *name.split('/'))
+            if self.dry_run:
+                print("(dry run) download %s to %s" % (s3url(bucket, o.key),
+                                                       local_file))
+                continue
+            jobs.append((s3url(bucket, o.key), o.size, functools.partial(
+                self.download_file, bucket, o.key, local_file)))
+        self.run_transfers(jobs)
+
+    def download_file(self, bucket, key, local_file, callback=None):
+        dirname = os.path.dirname(local_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.backend.download(bucket, key, local_file, callback)
 
     def complete_get(self, text, line, begidx, endidx):
         return self.filename_complete(text, line, begidx, endidx)
 
     def do_put(self, line):
-        """Upload a file to S3
+        """Upload files to S3
+
+        Usage: put [-r] [-d DIRECTORY] FILENAME...
 
-        Usage: put FILENAME
+        Filenames can be globs, and with -r directories are uploaded
+        recursively. Files are uploaded in parallel into the current remote
+        directory, or DIRECTORY if given.
         """
-        if not line:
-            print("Error: Missing filename")
-            self.do_help('put')
-            return
-        parts = shlex.split(line)
-        filename = parts[0]
-        self.aws_s3("cp '%s' '%s'" % (filename, self.s3url()))
-        self.cache = {} # Naively clear cache
+        parser = ShellArgumentParser('put')
+        parser.add_argument('-r', dest='recursive', action='store_true')
+        parser.add_argument('-d', dest='dest')
+        parser.add_argument('filenames', nargs='+')
+        args = parser.parse_args(shlex.split(line))
+        dest = args.dest or self.s3url()
+        if not dest.endswith('/'):
+            dest += '/'
+        bucket, prefix = self.split_path(dest)
+        jobs = []
+        for path, size, name in self.expand_local(args.filenames,
+                                                  args.recursive):
+            key = prefix + name
+            if self.dry_run:
+                print("(dry run) upload %s to %s" % (path, s3url(bucket, key)))
+                continue
+            jobs.append((path, size, functools.partial(
+                self.backend.upload, path, bucket, key)))
+        self.run_transfers(jobs)
+        self.cache.invalidate(bucket, prefix)
 
     def do_vi(self, line):
         """Alias for edit"""
@@ -352,7 +4157,9 @@ class s3shell(cmd.Cmd):
         Usage: edit FILENAME
 
         This uses the $EDITOR environment variable to determine the editor to
-        use, or defaults to 'vi' if the editor isn't set.
+        use, or defaults to 'vi' if the editor isn't set. The file is only
+        uploaded if its contents changed, and not if someone else has changed
+        it in S3 in the meantime.
         """
         if not line:
             print("Error: Missing filename")
@@ -360,17 +4167,37 @@ class s3shell(cmd.Cmd):
             return
         parts = shlex.split(line)
         filename = parts[0]
-        local_file = self.download_temp(filename)
-        previous_modtime = os.stat(local_file).st_mtime
+        bucket, key = self.split_path(filename)
+        o, chunks = self.open_object(bucket, key, cache=True)
+        fd, local_file = tempfile.mkstemp(
+            suffix='-' + os.path.basename(key))
+        original = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as fh:
+            for chunk in chunks:
+                original.update(chunk)
+                fh.write(chunk)
         editor = 'vi'
         if 'EDITOR' in os.environ and os.environ['EDITOR'] != '':
             editor = os.environ['EDITOR']
         os.system('"%s" "%s"' % (editor, local_file))
-        if os.stat(local_file).st_mtime != previous_modtime:
-            # File was modified, let's upload it
-            self.aws_s3("cp '%s' '%s'" % (local_file, self.full_path(filename)))
-        else:
+        edited = hashlib.sha256()
+        with open(local_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(STREAM_CHUNK), b''):
+                edited.update(chunk)
+        if edited.digest() == original.digest():
             print("File wasn't modified. Not uploading.")
+            os.remove(local_file)
+            return
+        try:
+            self.mutate("upload %s to %s" % (local_file, s3url(bucket, key)),
+                        self.backend.put, local_file, bucket, key, o.etag)
+        except PreconditionFailed:
+            self.mark_failed()
+            print("Error: %s was changed by someone else while you were "
+                  "editing it. Not uploading, your changes are in %s" % (
+                      s3url(bucket, key), local_file))
+            return
+        self.cache.invalidate(bucket, key)
         os.remove(local_file)
 
     def complete_edit(self, text, line, begidx, endidx):
@@ -386,13 +4213,330 @@ class s3shell(cmd.Cmd):
         """Make a new bucket"""
         parts = shlex.split(line)
         bucket_name = parts[0]
-        self.aws_s3("mb 's3://%s'" % bucket_name)
+        self.mutate("make bucket %s" % bucket_name,
+                    self.backend.make_bucket, bucket_name)
 
     def do_rb(self, line):
         """Make a new bucket"""
         parts = shlex.split(line)
         bucket_name = parts[0]
-        self.aws_s3("rb 's3://%s'" % bucket_name)
+        self.mutate("remove bucket %s" % bucket_name,
+                    self.backend.remove_bucket, bucket_name)
+        self.cache.invalidate_bucket(bucket_name)
+
+    def do_sync(self, line):
+        """Make a remote directory match a local one, or the other way round
+
+        Usage: sync [--down] [--delete] [--checksum] [-j JOBS] LOCAL REMOTE
+
+        By default LOCAL is uploaded to REMOTE; with --down, REMOTE is
+        downloaded to LOCAL. Both sides are listed at the same time, and only
+        files that are missing or differ are transferred, JOBS at a time.
+
+        Files differ if their sizes differ or the source is newer. With
+        --checksum, files of the same size are compared by ETag instead, with
+        the ETags of local files kept in a manifest so that unchanged files
+        aren't hashed again (this won't match objects encrypted with KMS).
+        --delete removes files from the destination that aren't in the
+        source. If any of REMOTE can't be listed, nothing is transferred or
+        deleted.
+        """
+        parser = ShellArgumentParser('sync')
+        parser.add_argument('--down', action='store_true')
+        parser.add_argument('--delete', action='store_true')
+        parser.add_argument('--checksum', action='store_true')
+        parser.add_argument('-j', dest='jobs', type=int)
+        parser.add_argument('local')
+        parser.add_argument('remote')
+        args = parser.parse_args(shlex.split(line))
+        local_root = os.path.expanduser(args.local)
+        remote = args.remote if args.remote.endswith('/') \
+            else args.remote + '/'
+        bucket, prefix = self.split_path(remote)
+        if not os.path.isdir(local_root):
+            if not args.down:
+                raise UsageError("%s isn't a directory" % args.local)
+            os.makedirs(local_root)
+
+        # List both sides at the same time
+        local_files = {}
+        local_errors = []
+
+        def list_local():
+            try:
+                for name, size, mtime_ns in scan_local(local_root):
+                    local_files[name] = (size, mtime_ns)
+            except OSError as e:
+                local_errors.append(e)
+
+        scanner = threading.Thread(target=list_local)
+        scanner.start()
+        remote_files = {}
+        remote_errors = []
+        for _, objects in self.walk(bucket, prefix, args.jobs,
+                                    remote_errors):
+            for o in objects:
+                if not o.key.endswith('/'):
+                    remote_files[o.key[len(prefix):]] = o
+        scanner.join()
+        if local_errors:
+            raise local_errors[0]
+        if remote_errors:
+            # Files missing from the listing would look like they had been
+            # deleted, or had never been uploaded
+            raise BackendError("Couldn't list all of %s, not syncing" %
+                               s3url(bucket, prefix))
+
+        changed = self.sync_diff(local_root, local_files, remote_files,
+                                 args.down, args.checksum, args.jobs)
+        if args.down:
+            extra = sorted(set(local_files) - set(remote_files))
+        else:
+            extra = sorted(set(remote_files) - set(local_files))
+
+        jobs = []
+        for name in changed:
+            local_file = os.path.join(local_root, *name.split('/'))
+            if args.down:
+                o = remote_files[name]
+                jobs.append((s3url(bucket, o.key), o.size, functools.partial(
+                    self.sync_download, bucket, o, local_file)))
+            else:
+                jobs.append((local_file, local_files[name][0],
+                             functools.partial(self.backend.upload,
+                                               local_file, bucket,
+                                               prefix + name)))
+        if self.dry_run:
+            for label, _, _ in jobs:
+                print("(dry run) %s %s" % (args.down and "download" or
+                                           "upload", label))
+            if args.delete:
+                for name in extra:
+                    print("(dry run) delete %s" % (
+                        args.down and os.path.join(local_root, name) or
+                        s3url(bucket, prefix + name)))
+            return
+        failures = self.run_transfers(jobs, args.jobs)
+        deleted = 0
+        if args.delete and extra:
+            if args.down:
+                for name in extra:
+                    path = os.path.join(local_root, *name.split('/'))
+                    try:
+                        os.remove(path)
+                        deleted += 1
+                    except OSError as e:
+                        self.mark_failed()
+                        print("Failed to delete %s: %s" % (path, e))
+            else:
+                keys = [prefix + name for name in extra]
+                batches = [(bucket, keys[i:i + 1000])
+                           for i in range(0, len(keys), 1000)]
+                for (_, batch), failed, error in self.run_bounded(
+                        lambda b: self.backend.delete_many(*b), batches,
+                        args.jobs):
+                    if error is not None:
+                        failed = [(key, str(error)) for key in batch]
+                    for key, message in failed:
+                        self.mark_failed()
+                        print("Failed to delete %s: %s" % (
+                            s3url(bucket, key), message))
+                    deleted += len(batch) - len(failed)
+        if not args.down:
+            self.cache.invalidate(bucket, prefix)
+        print("%d files checked, %d transferred, %d deleted%s" % (
+            len(set(local_files) | set(remote_files)),
+            len(jobs) - len(failures), deleted,
+            failures and ", %d failed" % len(failures) or ''))
+
+    def sync_diff(self, local_root, local_files, remote_files, down,
+                  checksum, jobs=None):
+        """Return the names of files that need to be transferred"""
+        source = down and remote_files or local_files
+        changed = []
+        to_hash = []
+        for name in sorted(source):
+            if name not in local_files or name not in remote_files:
+                changed.append(name)
+                continue
+            size, mtime_ns = local_files[name]
+            o = remote_files[name]
+            if size != o.size:
+                changed.append(name)
+            elif checksum:
+                to_hash.append(name)
+            else:
+                local_mtime = mtime_ns / 1e9
+                remote_mtime = o.mtime.timestamp()
+                newer = down and remote_mtime - local_mtime or \
+                    local_mtime - remote_mtime
+                if newer >= 1:
+                    changed.append(name)
+        if to_hash:
+            if self.manifest is None:
+                self.manifest = Manifest(self.manifest_path)
+
+            def compare(name):
+                size, mtime_ns = local_files[name]
+                etag = remote_files[name].etag
+                path = os.path.join(local_root, *name.split('/'))
+                try:
+                    for part_size in etag_part_sizes(size, etag,
+                                                     self.chunk_size):
+                        if self.manifest.etag(path, size, mtime_ns,
+                                              part_size) == etag:
+                            return False
+                except OSError:
+                    pass
+                return True
+
+            for name, differs, error in self.run_bounded(compare, to_hash,
+                                                         jobs):
+                if differs or error is not None:
+                    changed.append(name)
+            self.manifest.commit()
+        return changed
+
+    def sync_download(self, bucket, o, local_file, callback=None):
+        """Download a file, giving it the object's modification time"""
+        self.download_file(bucket, o.key, local_file, callback)
+        mtime = o.mtime.timestamp()
+        os.utime(local_file, (mtime, mtime))
+
+    def do_transfer(self, line):
+        """Show or change the settings used for get and put
+
+        Usage: transfer [concurrency N] [chunksize SIZE] [bandwidth SIZE]
+
+        concurrency is the number of files transferred at once, chunksize the
+        multipart part size and bandwidth a cap (per second) on the combined
+        rate of all transfers, with 0 meaning unlimited. Sizes can use K/M/G
+        suffixes.
+        """
+        parts = shlex.split(line)
+        if len(parts) % 2:
+            raise UsageError("Missing value for %s" % parts[-1])
+        for setting, value in zip(parts[::2], parts[1::2]):
+            if setting == 'concurrency':
+                self.concurrency = int(value)
+            elif setting == 'chunksize':
+                self.chunk_size = parse_size(value)
+            elif setting == 'bandwidth':
+                self.limiter.rate = parse_size(value)
+            else:
+                raise UsageError("Unknown setting: %s" % setting)
+        self.configure_backend()
+        print("concurrency %d, chunksize %s, bandwidth %s" % (
+            self.concurrency, human_size(self.chunk_size),
+            self.limiter.rate and human_size(self.limiter.rate) + '/s'
+            or 'unlimited'))
+
+    def do_cache(self, line):
+        """Show or manage the directory listing cache
+
+        Usage: cache stats
+               cache clear
+               cache ttl SECONDS [DIRECTORY]
+
+        With a directory, the ttl only applies to listings of that directory
+        and anything below it.
+        """
+        parts = shlex.split(line)
+        if not parts or parts[0] == 'stats':
+            stats = self.cache.stats()
+            if self.prefetcher is not None:
+                stats.update(self.prefetcher.stats())
+            if self.object_cache is not None:
+                stats.update(self.object_cache.stats())
+            for k, v in stats.items():
+                if isinstance(v, float):
+                    v = "%.1f%%" % (v * 100)
+                print("%-18s %s" % (k, v))
+        elif parts[0] == 'clear':
+            self.cache.clear()
+            if self.object_cache is not None:
+                self.object_cache.clear()
+            print("Cache cleared")
+        elif parts[0] == 'ttl' and len(parts) in (2, 3):
+            if len(parts) == 3:
+                bucket, prefix = self.split_path(parts[2])
+                self.cache.set_ttl(float(parts[1]), bucket, prefix)
+            else:
+                self.cache.set_ttl(float(parts[1]))
+        else:
+            print("Error: Unknown cache command")
+            self.do_help('cache')
+
+    def do_stats(self, line):
+        """Show how long S3 operations and commands are taking
+
+        Usage: stats [reset]
+               stats json [FILENAME]
+               stats trace FILENAME|off
+
+        Shows the number of operations, requests and retries along with the
+        p50/p95/p99 latencies and throughput of each kind of S3 operation,
+        followed by the same for each command. Comparing the two shows whether
+        time is going on S3 or locally. 'json' dumps everything as JSON,
+        to a file if one is given. 'trace' writes every operation to a file
+        as a line of JSON, tagged with the command that caused it.
+        """
+        parts = shlex.split(line)
+        if parts and parts[0] == 'reset' and len(parts) == 1:
+            self.metrics.reset()
+            return
+        summary = self.metrics.summary()
+        stats = self.cache.stats()
+        summary['caches'] = collections.OrderedDict([
+            ('listing_hits', stats['hits']),
+            ('listing_misses', stats['misses'])])
+        if self.object_cache is not None:
+            stats = self.object_cache.stats()
+            summary['caches']['object_hits'] = stats['object_hits']
+            summary['caches']['object_misses'] = stats['object_misses']
+        if not parts:
+            self.print_stats(summary)
+        elif parts[0] == 'json' and len(parts) <= 2:
+            data = json.dumps(summary, indent=2)
+            if len(parts) == 2:
+                with open(os.path.expanduser(parts[1]), 'w') as fh:
+                    fh.write(data + '\n')
+            else:
+                print(data)
+        elif parts[0] == 'trace' and len(parts) == 2:
+            if parts[1] == 'off':
+                self.metrics.set_trace(None)
+            else:
+                self.metrics.set_trace(os.path.expanduser(parts[1]))
+        else:
+            raise UsageError("Unknown stats command")
+
+    def print_stats(self, summary):
+        def ms(value):
+            return value is None and '-' or "%.1fms" % value
+        if summary['operations']:
+            print("%-10s %7s %6s %8s %7s %9s %9s %9s %9s %10s" % (
+                'operation', 'count', 'errors', 'requests', 'retries', 'p50',
+                'p95', 'p99', 'bytes', 'rate'))
+            for name, s in summary['operations'].items():
+                rate = s['bytes_per_second'] and "%s/s" % human_size(
+                    s['bytes_per_second']) or '-'
+                print("%-10s %7d %6d %8d %7d %9s %9s %9s %9s %10s" % (
+                    name, s['count'], s['errors'], s['requests'],
+                    s['retries'], ms(s['p50_ms']), ms(s['p95_ms']),
+                    ms(s['p99_ms']), human_size(s['bytes']), rate))
+            print()
+        if summary['commands']:
+            print("%-10s %7s %6s %9s %9s %9s %9s" % (
+                'command', 'count', 'errors', 'p50', 'p95', 'p99', 'total'))
+            for name, s in summary['commands'].items():
+                print("%-10s %7d %6d %9s %9s %9s %9s" % (
+                    name, s['count'], s['errors'], ms(s['p50_ms']),
+                    ms(s['p95_ms']), ms(s['p99_ms']),
+                    "%.2fs" % s['seconds']))
+            print()
+        for name, value in summary['caches'].items():
+            print("%-18s %s" % (name, value))
 
     def do_EOF(self, line):
         """Exit the program with ^D"""
@@ -423,12 +4567,72 @@ class s3shell(cmd.Cmd):
             cmd.Cmd.do_help(self, arg)
 
 
-if __name__ == '__main__':
+def make_parser():
     parser = argparse.ArgumentParser(description='S3 interactive shell')
     parser.add_argument('--profile', default='')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--dry-run', action='store_true')
     parser.add_argument('--bucket', default='')
-    args = parser.parse_args()
-    c = s3shell(args)
-    c.cmdloop("S3 Shell\nProfile: %s" % args.profile)
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='How to talk to S3 (default: boto3 if it is '
+                        'installed, otherwise the aws cli)')
+    parser.add_argument('--endpoint-url',
+                        help='Use a different S3 endpoint, e.g. a local S3 '
+                        'compatible server')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of files to transfer at once')
+    parser.add_argument('--chunk-size', type=parse_size, default='8M',
+                        help='Multipart chunk size for transfers')
+    parser.add_argument('--max-bandwidth', type=parse_size, default='0',
+                        help='Cap on combined transfer bandwidth per second '
+                        '(0 for unlimited)')
+    parser.add_argument('--cache-ttl', type=float, default=300,
+                        help='Seconds to cache directory listings for')
+    parser.add_argument('--cache-size', type=int, default=1000,
+                        help='Maximum number of directory listings to cache')
+    parser.add_argument('--trace',
+                        help='Write a trace of every S3 operation to this '
+                        'file, as lines of JSON')
+    parser.add_argument('--object-cache-dir',
+                        default=os.path.join(cache_dir(), 'objects'),
+                        help='Where to cache the contents of files that are '
+                        'viewed or edited')
+    parser.add_argument('--object-cache-size', type=parse_size, default='1G',
+                        help='Maximum size of the object cache (0 to disable)')
+    parser.add_argument('--manifest', default=default_manifest(),
+                        help='Where sync keeps the checksums of local files')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help="Don't load directory listings in the background")
+    parser.add_argument('-c', dest='commands',
+                        help='Run commands (separated by ; or newlines) '
+                        'and exit')
+    parser.add_argument('--script',
+                        help='Run commands from a file (- for stdin) and exit')
+    parser.add_argument('--keep-going', action='store_true',
+                        help="Don't stop at the first failed command")
+    return parser
+
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+    batch = args.commands is not None or args.script is not None
+    if batch:
+        # Nothing to tab complete, so don't bother prefetching
+        args.no_prefetch = True
+    try:
+        c = s3shell(args)
+    except BackendError as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+    if batch:
+        commands = []
+        if args.script == '-':
+            commands.extend(split_commands(sys.stdin.read()))
+        elif args.script is not None:
+            with open(args.script) as fh:
+                commands.extend(split_commands(fh.read()))
+        if args.commands is not None:
+            commands.extend(split_commands(args.commands))
+        sys.exit(c.run_script(commands, args.keep_going))
+    c.cmdloop("S3 Shell\nProfile: %s\nBackend: %s" % (
+        args.profile, c.backend.name))
@@ -0,0 +1,341 @@
+#!/usr/bin/env -S uv run
+# /// script
+# dependencies = [
+#     "boto3",
+#     "moto[server]",
+# ]
+# ///
+"""
+Benchmark s3shell against a local S3 stand-in
+
+This starts an in-process moto server, seeds it with synthetic buckets (lots
+of small objects, a few huge ones and a deep prefix tree), and then drives
+s3shell commands through onecmd() just as the interactive shell would. Each
+scenario is run in its own process for every backend and concurrency setting,
+so the peak RSS reported is that of the scenario alone.
+
+Results are printed as a table and saved as JSON, so that runs from different
+versions can be compared with --compare:
+
+    ./s3shell_bench.py --output before.json
+    ./s3shell_bench.py --output after.json --compare before.json
+
+The numbers measure s3shell's own overhead (listing, completion, transfer
+scheduling, etc.) rather than S3, as moto answers much faster than S3 does.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import s3shell  # noqa: E402
+
+SCENARIOS = ['ls', 'complete', 'get', 'put', 'get-huge', 'put-huge', 'cat',
+             'rm']
+
+
+def parse_list(value, convert=str):
+    return [convert(v) for v in value.split(',') if v]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark s3shell against a local S3 stand-in')
+    parser.add_argument('--backends', type=parse_list,
+                        help='Backends to benchmark (default: every backend '
+                        'that is available)')
+    parser.add_argument('--concurrency', type=lambda v: parse_list(v, int),
+                        default=[1, 8, 32],
+                        help='Comma separated concurrency settings to try '
+                        '(default: 1,8,32)')
+    parser.add_argument('--scenarios', type=parse_list, default=SCENARIOS,
+                        help='Scenarios to run (default: %s)' %
+                        ','.join(SCENARIOS))
+    parser.add_argument('--small-count', type=int, default=2000,
+                        help='Number of small objects')
+    parser.add_argument('--small-size', type=s3shell.parse_size,
+                        default='4K', help='Size of the small objects')
+    parser.add_argument('--huge-count', type=int, default=2,
+                        help='Number of huge objects')
+    parser.add_argument('--huge-size', type=s3shell.parse_size,
+                        default='64M', help='Size of the huge objects')
+    parser.add_argument('--tree-depth', type=int, default=4,
+                        help='Depth of the prefix tree')
+    parser.add_argument('--tree-fanout', type=int, default=4,
+                        help='Sub-directories per directory in the tree')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='How many times to repeat the ls and cat '
+                        'scenarios')
+    parser.add_argument('--quick', action='store_true',
+                        help='Use a small data set, for checking that the '
+                        'benchmark works')
+    parser.add_argument('--output', default='s3shell_bench.json',
+                        help='Where to save the results')
+    parser.add_argument('--compare',
+                        help='Results from an earlier run to compare with')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.quick:
+        args.small_count = 200
+        args.huge_size = 8 * 1024 * 1024
+        args.tree_depth = 3
+        args.repeat = 5
+    return args
+
+
+def free_port():
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def available_backends():
+    backends = ['boto3']
+    if shutil.which('aws'):
+        backends.append('cli')
+    return backends
+
+
+def tree_prefixes(depth, fanout, prefix='tree/'):
+    """Return every directory in a prefix tree, parents first"""
+    prefixes = [prefix]
+    if depth > 0:
+        for i in range(fanout):
+            prefixes.extend(tree_prefixes(depth - 1, fanout,
+                                          '%sd%d/' % (prefix, i)))
+    return prefixes
+
+
+def put_objects(client, bucket, keys, body, workers=16):
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda k: client.put_object(
+            Bucket=bucket, Key=k, Body=body), keys))
+
+
+def seed(client, args, workdir):
+    """Create the synthetic buckets"""
+    client.create_bucket(Bucket='bench')
+    put_objects(client, 'bench', ['small/%06d' % i
+                                  for i in range(args.small_count)],
+                os.urandom(args.small_size))
+    keys = []
+    for prefix in tree_prefixes(args.tree_depth, args.tree_fanout):
+        keys.extend('%sfile%d' % (prefix, i) for i in range(3))
+    put_objects(client, 'bench', keys, b'x')
+    huge = os.path.join(workdir, 'huge')
+    with open(huge, 'wb') as fh:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.huge_size // len(block)):
+            fh.write(block)
+    for i in range(args.huge_count):
+        client.upload_file(huge, 'bench', 'huge/%d' % i)
+    os.remove(huge)
+
+
+def make_shell(endpoint_url, backend, concurrency, workdir):
+    args = s3shell.make_parser().parse_args([
+        '--bucket', 'bench', '--backend', backend,
+        '--endpoint-url', endpoint_url, '--concurrency', str(concurrency),
+        '--object-cache-size', '0', '--no-prefetch',
+        '--manifest', os.path.join(workdir, 'manifest.sqlite')])
+    return s3shell.s3shell(args)
+
+
+def run_scenario(job):
+    """Run one scenario in this process, returning its results"""
+    import boto3
+    workdir = tempfile.mkdtemp(prefix='s3shell_bench-')
+    client = boto3.client('s3', endpoint_url=job['endpoint_url'])
+    shell = make_shell(job['endpoint_url'], job['backend'],
+                       job['concurrency'], workdir)
+    scenario = job['scenario']
+    repeat = job['repeat']
+    commands = []
+    ops = 0
+    nbytes = 0
+
+    if scenario == 'ls':
+        for _ in range(repeat):
+            commands.extend(['cache clear', 'ls small/'])
+        ops = repeat
+    elif scenario == 'complete':
+        prefixes = tree_prefixes(job['tree_depth'], job['tree_fanout'])
+        ops = len(prefixes)
+    elif scenario in ('get', 'get-huge'):
+        prefix = scenario == 'get' and 'small/' or 'huge/'
+        commands = ['get -r -d %s %s' % (workdir, prefix)]
+        ops = scenario == 'get' and job['small_count'] or job['huge_count']
+        nbytes = scenario == 'get' and job['small_count'] * \
+            job['small_size'] or job['huge_count'] * job['huge_size']
+    elif scenario in ('put', 'put-huge'):
+        local = os.path.join(workdir, 'upload')
+        os.mkdir(local)
+        count = scenario == 'put' and job['small_count'] or job['huge_count']
+        size = scenario == 'put' and job['small_size'] or job['huge_size']
+        for i in range(count):
+            with open(os.path.join(local, '%06d' % i), 'wb') as fh:
+                fh.write(os.urandom(size))
+        commands = ['put -r -d %s/ %s' % (scenario, local)]
+        ops = count
+        nbytes = count * size
+    elif scenario == 'cat':
+        keys = ['small/%06d' % i for i in range(min(repeat * 10,
+                                                    job['small_count']))]
+        commands = ['cat %s' % k for k in keys]
+        ops = len(keys)
+        nbytes = len(keys) * job['small_size']
+    elif scenario == 'rm':
+        keys = ['rm-%s-%d/%06d' % (job['backend'], job['concurrency'], i)
+                for i in range(job['small_count'])]
+        put_objects(client, 'bench', keys, b'x')
+        commands = ['rm -r %s/' % keys[0].split('/')[0]]
+        ops = len(keys)
+
+    errors = 0
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        if scenario == 'complete':
+            for prefix in prefixes:
+                line = 'cd ' + prefix
+                if not shell.filename_complete('', line, len(line),
+                                               len(line)):
+                    errors += 1
+        for command in commands:
+            if not shell.execute(command):
+                errors += 1
+    seconds = time.time() - start
+
+    if scenario in ('put', 'put-huge'):
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            shell.execute('rm -r %s/' % scenario)
+    shutil.rmtree(workdir, ignore_errors=True)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes rather than kilobytes
+        peak //= 1024
+    return {
+        'backend': job['backend'],
+        'concurrency': job['concurrency'],
+        'scenario': scenario,
+        'ops': ops,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'ops_per_sec': round(ops / seconds, 2) if seconds else None,
+        'bytes': nbytes,
+        'mb_per_sec': round(nbytes / seconds / 1024 / 1024, 2)
+        if seconds and nbytes else None,
+        'peak_rss_kb': peak,
+    }
+
+
+def print_results(results, previous=None):
+    baseline = {}
+    for r in previous or []:
+        baseline[(r['backend'], r['concurrency'], r['scenario'])] = r
+    print("%-8s %5s %-9s %7s %9s %10s %9s %11s %8s" % (
+        'backend', 'conc', 'scenario', 'ops', 'seconds', 'ops/sec', 'MB/s',
+        'peak RSS', 'change'))
+    for r in results:
+        old = baseline.get((r['backend'], r['concurrency'], r['scenario']))
+        change = ''
+        if old and old.get('ops_per_sec') and r['ops_per_sec']:
+            change = "%+.1f%%" % (
+                (r['ops_per_sec'] / old['ops_per_sec'] - 1) * 100)
+        print("%-8s %5d %-9s %7d %9.3f %10s %9s %11s %8s" % (
+            r['backend'], r['concurrency'], r['scenario'], r['ops'],
+            r['seconds'], r['ops_per_sec'], r['mb_per_sec'] or '-',
+            s3shell.human_size(r['peak_rss_kb'] * 1024), change))
+        if r['errors']:
+            print("    %d errors" % r['errors'])
+
+
+def main():
+    args = parse_args()
+    if args.run:
+        print(json.dumps(run_scenario(json.loads(args.run))))
+        return
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit("Unknown scenario: %s" % scenario)
+    backends = args.backends or available_backends()
+
+    # Fake credentials, so nothing can reach a real account
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+    })
+    os.environ.pop('AWS_PROFILE', None)
+    from moto.server import ThreadedMotoServer
+    import boto3
+    # Don't log every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                verbose=False)
+    server.start()
+    endpoint_url = 'http://127.0.0.1:%d' % port
+    workdir = tempfile.mkdtemp(prefix='s3shell_bench-')
+    results = []
+    try:
+        print("Seeding buckets...", file=sys.stderr)
+        seed(boto3.client('s3', endpoint_url=endpoint_url), args, workdir)
+        for backend in backends:
+            for concurrency in args.concurrency:
+                for scenario in args.scenarios:
+                    print("Running %s with %s, concurrency %d" % (
+                        scenario, backend, concurrency), file=sys.stderr)
+                    job = {
+                        'endpoint_url': endpoint_url,
+                        'backend': backend,
+                        'concurrency': concurrency,
+                        'scenario': scenario,
+                        'repeat': args.repeat,
+                        'small_count': args.small_count,
+                        'small_size': args.small_size,
+                        'huge_count': args.huge_count,
+                        'huge_size': args.huge_size,
+                        'tree_depth': args.tree_depth,
+                        'tree_fanout': args.tree_fanout,
+                    }
+                    output = subprocess.check_output([
+                        sys.executable, os.path.abspath(__file__),
+                        '--run', json.dumps(job)])
+                    results.append(json.loads(output.splitlines()[-1]))
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)['results']
+    print_results(results, previous)
+    with open(args.output, 'w') as fh:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {k: v for k, v in vars(args).items()
+                         if k not in ('run', 'output', 'compare')},
+            'results': results,
+        }, fh, indent=2)
+    print("Results saved to %s" % args.output, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env -S uv run
+# /// script
+# dependencies = [
+#     "boto3",
+#     "moto[server]",
+# ]
+# ///
+"""
+Smoke tests for s3shell against a local S3 stand-in
+
+Every backend (boto3, and the aws cli if it is installed) is run against an
+in-process moto server, both directly and through shell commands, so that
+regressions in the backends or the commands built on them show up without a
+real account. The pure helpers are covered by the doctests in s3shell.py.
+Run with:
+
+    ./test_s3shell.py
+    python -m doctest s3shell.py
+"""
+import contextlib
+import gzip
+import io
+import itertools
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import s3shell  # noqa: E402
+
+server = None
+endpoint_url = None
+bucket_ids = itertools.count()
+
+
+def setUpModule():
+    global server, endpoint_url
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise unittest.SkipTest("moto isn't installed")
+    # Fake credentials, so nothing can reach a real account
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'test',
+        'AWS_SECRET_ACCESS_KEY': 'test',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+    })
+    os.environ.pop('AWS_PROFILE', None)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with contextlib.closing(socket.socket()) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port,
+                                verbose=False)
+    server.start()
+    endpoint_url = 'http://127.0.0.1:%d' % port
+
+
+def tearDownModule():
+    if server is not None:
+        server.stop()
+
+
+class MotoTestCase(unittest.TestCase):
+    """Gives each test a fresh bucket and local directory"""
+    backend_name = None
+
+    def setUp(self):
+        import boto3
+        self.bucket = 'test-%s-%d' % (self.backend_name, next(bucket_ids))
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client.create_bucket(Bucket=self.bucket)
+        self.tmp = tempfile.mkdtemp(prefix='test_s3shell-')
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def put_object(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def get_object(self, key):
+        return self.client.get_object(Bucket=self.bucket,
+                                      Key=key)['Body'].read()
+
+    def keys(self):
+        rv = self.client.list_objects_v2(Bucket=self.bucket)
+        return sorted(o['Key'] for o in rv.get('Contents', []))
+
+    def local_file(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+
+class BackendTests(object):
+    """Tests of the Backend interface, run for each backend"""
+
+    def setUp(self):
+        MotoTestCase.setUp(self)
+        self.backend = s3shell.make_backend(self.backend_name,
+                                            endpoint_url=endpoint_url)
+
+    def test_list(self):
+        for key in ['a.txt', 'dir/b.txt', 'dir/sub/c.txt']:
+            self.put_object(key, b'x')
+        prefixes, objects = self.backend.list(self.bucket, '')
+        self.assertEqual(prefixes, ['dir/'])
+        self.assertEqual([o.key for o in objects], ['a.txt'])
+        prefixes, objects = self.backend.list(self.bucket, 'dir/')
+        self.assertEqual(prefixes, ['dir/sub/'])
+        self.assertEqual([(o.key, o.size) for o in objects],
+                         [('dir/b.txt', 1)])
+        _, objects = self.backend.list(self.bucket, '', delimiter='')
+        self.assertEqual(len(objects), 3)
+
+    def test_list_pages(self):
+        for i in range(5):
+            self.put_object('k%d' % i, b'x')
+        pages = list(self.backend.list_pages(self.bucket, '', page_size=2))
+        self.assertEqual([len(objects) for _, objects in pages], [2, 2, 1])
+
+    def test_head(self):
+        self.put_object('a.txt', b'hello')
+        o = self.backend.head(self.bucket, 'a.txt')
+        self.assertEqual((o.key, o.size), ('a.txt', 5))
+        self.assertTrue(o.etag)
+        self.assertRaises(s3shell.BackendError, self.backend.head,
+                          self.bucket, 'missing')
+
+    def test_get_and_stream(self):
+        self.put_object('a.txt', b'hello world')
+        o, body = self.backend.get(self.bucket, 'a.txt')
+        try:
+            self.assertEqual(body.read(), b'hello world')
+        finally:
+            body.close()
+        self.assertRaises(s3shell.NotModified, self.backend.get,
+                          self.bucket, 'a.txt', o.etag)
+        body = self.backend.stream(self.bucket, 'a.txt', 'bytes=-5')
+        try:
+            self.assertEqual(body.read(), b'world')
+        finally:
+            body.close()
+
+    def test_put(self):
+        path = self.local_file('a.txt', b'one')
+        etag = self.backend.put(path, self.bucket, 'a.txt')
+        self.assertEqual(self.get_object('a.txt'), b'one')
+        path = self.local_file('a.txt', b'two')
+        self.backend.put(path, self.bucket, 'a.txt', if_match=etag)
+        self.assertEqual(self.get_object('a.txt'), b'two')
+        self.assertRaises(s3shell.PreconditionFailed, self.backend.put,
+                          path, self.bucket, 'a.txt', if_match=etag)
+
+    def test_upload_and_download(self):
+        data = os.urandom(100000)
+        path = self.local_file('up', data)
+        self.backend.upload(path, self.bucket, 'dir/up')
+        self.assertEqual(self.get_object('dir/up'), data)
+        target = os.path.join(self.tmp, 'down')
+        transferred = []
+        self.backend.download(self.bucket, 'dir/up', target,
+                              transferred.append)
+        with open(target, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(sum(transferred), len(data))
+        self.assertRaises(s3shell.BackendError, self.backend.download,
+                          self.bucket, 'missing', target)
+
+    def test_copy(self):
+        self.put_object('a.txt', b'hello')
+        self.backend.copy(self.bucket, 'a.txt', self.bucket, 'b.txt')
+        self.assertEqual(self.get_object('b.txt'), b'hello')
+
+    def test_delete(self):
+        for key in ['a', 'b', 'c', 'd']:
+            self.put_object(key, b'x')
+        self.backend.delete(self.bucket, 'a')
+        self.assertEqual(self.backend.delete_many(self.bucket, ['b', 'c']),
+                         [])
+        self.assertEqual(self.keys(), ['d'])
+
+    def test_buckets(self):
+        bucket = self.bucket + '-new'
+        self.backend.make_bucket(bucket)
+        self.assertEqual(self.backend.list(bucket, ''), ([], []))
+        self.backend.remove_bucket(bucket)
+        self.assertRaises(s3shell.BackendError, self.backend.list,
+                          bucket, '')
+
+
+class ShellTests(object):
+    """Shell commands run against each backend"""
+
+    def setUp(self):
+        MotoTestCase.setUp(self)
+        args = s3shell.make_parser().parse_args([
+            '--bucket', self.bucket, '--backend', self.backend_name,
+            '--endpoint-url', endpoint_url, '--no-prefetch',
+            '--object-cache-dir', os.path.join(self.tmp, 'cache'),
+            '--manifest', os.path.join(self.tmp, 'manifest.sqlite')])
+        self.shell = s3shell.s3shell(args)
+
+    def run_command(self, line, timeout=60):
+        """Run a command, returning whether it worked and its output
+
+        Commands are run on a thread, so that one that hangs fails the test
+        rather than the whole run.
+        """
+        out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        result = []
+
+        def run():
+            with contextlib.redirect_stdout(out):
+                result.append(self.shell.execute(line))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "%r didn't finish" % line)
+        out.flush()
+        return result[0], out.buffer.getvalue().decode()
+
+    def run_script(self, commands):
+        out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with contextlib.redirect_stdout(out):
+            status = self.shell.run_script(commands)
+        out.flush()
+        return status, out.buffer.getvalue().decode()
+
+    def names(self, output):
+        return [l.split()[-1] for l in output.splitlines()]
+
+    def test_ls(self):
+        for key in ['file.txt', 'foo.txt', 'foo/a', 'dir/foo.txt']:
+            self.put_object(key, b'x')
+        ok, output = self.run_command('ls')
+        self.assertTrue(ok)
+        self.assertEqual(self.names(output),
+                         ['dir/', 'foo/', 'file.txt', 'foo.txt'])
+        self.assertEqual(self.names(self.run_command('ls foo')[1]),
+                         ['foo/', 'foo.txt'])
+        self.assertEqual(self.names(self.run_command('ls file.txt')[1]),
+                         ['file.txt'])
+        self.assertEqual(self.names(self.run_command('ls dir/fo')[1]),
+                         ['foo.txt'])
+
+    def test_cd(self):
+        self.put_object('dir/a', b'x')
+        self.assertTrue(self.run_command('ls')[0])
+        cache = self.shell.cache
+        counts = (cache.hits, cache.misses)
+        self.assertEqual(self.run_command('cd dir'), (True, ''))
+        self.assertEqual(self.run_command('cd ..'), (True, ''))
+        ok, output = self.run_command('cd missing')
+        self.assertIn("/missing/ doesn't exist", output)
+        self.assertEqual((cache.hits, cache.misses), counts)
+
+    def test_cat_and_zcat(self):
+        self.put_object('a.txt', b'plain\n')
+        self.put_object('a.gz', gzip.compress(b'zipped\n'))
+        self.assertEqual(self.run_command('cat a.txt'), (True, 'plain\n'))
+        self.assertEqual(self.run_command('zcat a.gz a.txt'),
+                         (True, 'zipped\nplain\n'))
+
+    def test_object_cache(self):
+        self.put_object('a.txt', b'plain\n')
+        self.put_object('a.gz', gzip.compress(b'zipped\n'))
+        cache = self.shell.object_cache
+        for line in ['zcat a.gz', 'zgrep zipped a.gz', 'head a.txt']:
+            self.assertTrue(self.run_command(line)[0])
+        self.assertEqual(cache.stats()['objects'], 0)
+        self.assertEqual(self.run_command('cat a.txt'), (True, 'plain\n'))
+        self.assertEqual(self.run_command('cat a.txt'), (True, 'plain\n'))
+        stats = cache.stats()
+        self.assertEqual((stats['objects'], stats['object_hits']), (1, 1))
+
+    def test_corrupt_compressed_files(self):
+        self.put_object('bad.xz', b'\xfd7zXZ\x00' + b'garbage' * 100)
+        self.put_object('good.gz', gzip.compress(b'match\n'))
+        ok, output = self.run_command('zcat bad.xz')
+        self.assertFalse(ok)
+        self.assertIn('Corrupt compressed data', output)
+        ok, output = self.run_command('zgrep match bad.xz good.gz')
+        self.assertFalse(ok)
+        self.assertIn('s3://%s/good.gz:match' % self.bucket, output)
+        self.assertIn('zgrep: s3://%s/bad.xz' % self.bucket, output)
+
+    def test_head_and_tail(self):
+        lines = ''.join('%d %s\n' % (i, 'x' * 100) for i in range(2000))
+        self.put_object('big', lines.encode())
+        self.put_object('empty', b'')
+        self.assertEqual(self.run_command('head -n 3 big')[1],
+                         ''.join(lines.splitlines(True)[:3]))
+        self.assertEqual(self.run_command('head -n 1500 big')[1],
+                         ''.join(lines.splitlines(True)[:1500]))
+        self.assertEqual(self.run_command('tail -n 2 big')[1],
+                         ''.join(lines.splitlines(True)[-2:]))
+        for line in ['head empty', 'tail empty', 'head -c 5 empty',
+                     'tail -c 5 empty']:
+            self.assertEqual(self.run_command(line), (True, ''))
+
+    def test_get_and_put(self):
+        self.put_object('dir/a.txt', b'hello')
+        dest = os.path.join(self.tmp, 'got')
+        self.assertTrue(self.run_command('get -d %s dir/a.txt' % dest)[0])
+        with open(os.path.join(dest, 'a.txt'), 'rb') as fh:
+            self.assertEqual(fh.read(), b'hello')
+        path = self.local_file('b.txt', b'world')
+        self.assertTrue(self.run_command('put -d up %s' % path)[0])
+        self.assertEqual(self.get_object('up/b.txt'), b'world')
+
+    def test_rm(self):
+        for key in ['a', 'b', 'dir/c']:
+            self.put_object(key, b'x')
+        self.assertTrue(self.run_command('rm a')[0])
+        self.assertTrue(self.run_command('rm -r dir/')[0])
+        self.assertEqual(self.keys(), ['b'])
+
+    def test_script(self):
+        self.put_object('a', b'x')
+        for i in range(10):
+            self.put_object('f%d' % i, b'line %d\n' % i)
+        status, output = self.run_script(
+            ['cp a b', 'cp b c'] + ['head -n 1 f%d' % i for i in range(10)])
+        self.assertEqual(status, 0)
+        self.assertEqual(output, ''.join('line %d\n' % i for i in range(10)))
+        self.assertEqual(self.get_object('c'), b'x')
+
+    def test_script_conflicts(self):
+        paths = [self.local_file('f%d' % i, b'%d' % i) for i in range(5)]
+        # A put and a later rm of the same key must run in order
+        commands = []
+        for path in paths:
+            commands.extend(['put -d up/ %s' % path,
+                             'rm up/%s' % os.path.basename(path)])
+        self.assertEqual(self.run_script(commands)[0], 0)
+        self.assertEqual(self.keys(), [])
+        # The last of several puts to the same key wins
+        os.mkdir(os.path.join(self.tmp, 'other'))
+        other = self.local_file('other/f0', b'other')
+        self.assertEqual(self.run_script(
+            ['put -d up/ %s' % paths[0], 'put -d up/ %s' % other,
+             'put -d up/ %s' % paths[1]])[0], 0)
+        self.assertEqual(self.get_object('up/f0'), b'other')
+        self.assertIsNone(self.shell.command_paths('cp a b'))
+        self.assertEqual(self.shell.command_paths('rm -r logs/2025-*'),
+                         ['s3://%s/logs/2025-' % self.bucket])
+
+    def test_cp(self):
+        for key in ['a', 'dir/b', 'dir/sub/c']:
+            self.put_object(key, key.encode())
+        self.assertTrue(self.run_command('cp -r dir/ copy/')[0])
+        self.assertEqual(self.get_object('copy/dir/sub/c'), b'dir/sub/c')
+        ok, output = self.run_command('cp -r dir/ dir/sub/')
+        self.assertFalse(ok)
+        self.assertIn("into itself", output)
+        ok, output = self.run_command('cp -r / backup/')
+        self.assertFalse(ok)
+        self.assertIn("into itself", output)
+
+    def test_cp_bucket(self):
+        self.put_object('a', b'a')
+        self.put_object('dir/b', b'b')
+        other = self.bucket + '-other'
+        self.client.create_bucket(Bucket=other)
+        ok, output = self.run_command('cp -r s3://%s/ s3://%s/backup/' % (
+            self.bucket, other))
+        self.assertTrue(ok, output)
+        rv = self.client.list_objects_v2(Bucket=other)
+        self.assertEqual(sorted(o['Key'] for o in rv['Contents']),
+                         ['backup/a', 'backup/dir/b'])
+
+    def test_dry_run(self):
+        self.put_object('a.txt', b'hello')
+        self.shell.dry_run = True
+        dest = os.path.join(self.tmp, 'got')
+        ok, output = self.run_command('get -d %s a.txt' % dest)
+        self.assertTrue(ok)
+        self.assertIn("(dry run) download", output)
+        self.assertFalse(os.path.exists(dest))
+        self.assertTrue(self.run_command('rm a.txt')[0])
+        self.assertEqual(self.keys(), ['a.txt'])
+
+    def test_sync(self):
+        self.put_object('d/x.txt', b'x')
+        self.put_object('d/y.txt', b'y')
+        local = os.path.join(self.tmp, 'local')
+        ok, output = self.run_command('sync --down %s d/' % local)
+        self.assertTrue(ok, output)
+        self.assertEqual(sorted(os.listdir(local)), ['x.txt', 'y.txt'])
+        self.client.delete_object(Bucket=self.bucket, Key='d/x.txt')
+        self.assertTrue(self.run_command(
+            'sync --down --delete %s d/' % local)[0])
+        self.assertEqual(os.listdir(local), ['y.txt'])
+
+    def test_sync_incomplete_listing(self):
+        self.put_object('d/x.txt', b'x')
+        self.put_object('d/sub/y.txt', b'y')
+        local = os.path.join(self.tmp, 'local')
+        self.assertTrue(self.run_command('sync --down %s d/' % local)[0])
+        list_pages = self.shell.backend.list_pages
+
+        def failing_list_pages(bucket, prefix, *args, **kwargs):
+            if prefix == 'd/sub/':
+                raise s3shell.BackendError("listing failed")
+            return list_pages(bucket, prefix, *args, **kwargs)
+
+        self.shell.backend.list_pages = failing_list_pages
+        ok, output = self.run_command('sync --down --delete %s d/' % local)
+        self.assertFalse(ok)
+        self.assertIn("not syncing", output)
+        self.assertTrue(os.path.exists(os.path.join(local, 'sub', 'y.txt')))
+
+
+class Boto3BackendTests(BackendTests, MotoTestCase):
+    backend_name = 'boto3'
+
+
+class Boto3ShellTests(ShellTests, MotoTestCase):
+    backend_name = 'boto3'
+
+
+@unittest.skipUnless(shutil.which('aws'), "the aws cli isn't installed")
+class CLIBackendTests(BackendTests, MotoTestCase):
+    backend_name = 'cli'
+
+
+@unittest.skipUnless(shutil.which('aws'), "the aws cli isn't installed")
+class CLIShellTests(ShellTests, MotoTestCase):
+    backend_name = 'cli'
+
+
+if __name__ == '__main__':
+    unittest.main()